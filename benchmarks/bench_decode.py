@@ -0,0 +1,74 @@
+"""图片解密吞吐量对比：jmcomic 默认的线程内解密 vs 共享进程池解密
+
+用法：python benchmarks/bench_decode.py [--images 120] [--threads 30] [--workers 0]
+
+两种方式都用同样数量的下载线程并发处理同一批合成图片，只比较解密阶段。
+多核机器上进程池方式应随核心数提升；单核机器上两者接近。
+"""
+import argparse
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+# 在模块顶层加载 dc-jm.py，spawn 方式启动的子进程重新导入本脚本时也能找到它
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)  # dc-jm.py 从 jm_workers 导入进程池任务
+spec = importlib.util.spec_from_file_location('dc_jm', os.path.join(ROOT, 'dc-jm.py'))
+dc_jm = importlib.util.module_from_spec(spec)
+sys.modules['dc_jm'] = dc_jm
+spec.loader.exec_module(dc_jm)
+
+
+def make_images(count, width, height):
+    from PIL import Image
+    images = []
+    for i in range(count):
+        img = Image.effect_noise((width, height), 30 + i % 20).convert('RGB')
+        buffer = BytesIO()
+        img.save(buffer, 'JPEG', quality=85)
+        images.append(buffer.getvalue())
+    return images
+
+
+def run(label, images, threads, out_dir, decode):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(
+            lambda item: decode(item[1], 10, os.path.join(out_dir, f"{label}_{item[0]:04d}.jpg")),
+            enumerate(images),
+        ))
+    elapsed = time.perf_counter() - started
+    print(f"{label:<10} {len(images) / elapsed:8.1f} 张/秒  ({elapsed:.2f}s)")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--images', type=int, default=120)
+    parser.add_argument('--threads', type=int, default=30, help='下载线程数，对应 option.yml 中的 image')
+    parser.add_argument('--workers', type=int, default=0, help='进程池大小，0 为CPU核心数')
+    parser.add_argument('--width', type=int, default=1080)
+    parser.add_argument('--height', type=int, default=1600)
+    args = parser.parse_args()
+
+    print(f"生成 {args.images} 张 {args.width}x{args.height} 测试图片...")
+    images = make_images(args.images, args.width, args.height)
+    pool = dc_jm.ProcessPool(workers=args.workers)
+    print(f"CPU核心: {os.cpu_count()}，下载线程: {args.threads}，进程池: {pool.workers}，在途上限: {pool.max_in_flight}")
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        threaded = run('threaded', images, args.threads, out_dir, dc_jm.decode_jm_image)
+        # 先启动进程池，不把进程创建时间算进去
+        pool.get_executor().submit(os.getpid).result()
+        pooled = run('pooled', images, args.threads, out_dir,
+                     lambda data, num, path: pool.run_bounded(dc_jm.decode_jm_image, data, num, path))
+        pool.shutdown()
+    print(f"加速比: {threaded / pooled:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
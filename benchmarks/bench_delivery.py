@@ -0,0 +1,253 @@
+"""文件发送路径微基准：send_file_smart / send_large_file
+
+用法：python benchmarks/bench_delivery.py [--sizes 1,8,25,100,500] [--limit-mb 10] [--mbps 0] [--rate-limit 0] [--actual-limit-mb 0]
+
+把假的 followup 作为接收端，按块读完每个附件（可限制上传带宽），并可模拟：
+- 速率限制：按 --bucket-limit / --bucket-window 模拟followup路由的限额，响应头交给上传调度器；
+  超出限额或按 --rate-limit 的概率返回429，像 discord.py 一样等待后重置文件重新上传
+- 413：--actual-limit-mb 小于 --limit-mb 时，超过实际限制的附件被拒绝，走学习上传限制、重新分片的流程
+
+每种文件大小在新的进程中运行，输出首个分片送达时间、总耗时、内存峰值（RSS增量和Python堆峰值）、
+生成zip分片（CRC和zip头）的CPU时间、发送的消息数和429重传次数。
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from types import SimpleNamespace
+
+# 在模块顶层加载 dc-jm.py，spawn 方式启动的子进程重新导入本脚本时也能找到它
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)  # dc-jm.py 从 jm_workers 导入进程池任务
+spec = importlib.util.spec_from_file_location('dc_jm', os.path.join(ROOT, 'dc-jm.py'))
+dc_jm = importlib.util.module_from_spec(spec)
+sys.modules['dc_jm'] = dc_jm
+spec.loader.exec_module(dc_jm)
+
+import discord
+from yarl import URL
+
+MB = 1024 * 1024
+
+
+class FakeMessage:
+    next_id = 1
+
+    def __init__(self, attachments):
+        self.id = FakeMessage.next_id
+        FakeMessage.next_id += 1
+        self.channel = SimpleNamespace(id=1)
+        self.attachments = attachments
+
+
+class FakeFollowup:
+    """模拟Discord接收附件：按带宽读完文件，按配置返回429或413"""
+
+    def __init__(self, sink):
+        self.sink = sink
+
+    async def send(self, content=None, embed=None, embeds=None, file=None, **kwargs):
+        return await self.sink.send(file)
+
+
+class FakeSink:
+    def __init__(self, args, started):
+        self.args = args
+        self.started = started
+        self.rng = random.Random(args.seed)
+        self.bytes_per_second = args.mbps * MB / 8
+        self.actual_limit = int(args.actual_limit_mb * MB) if args.actual_limit_mb else None
+        self.messages = 0
+        self.files = 0
+        self.rate_limited = 0
+        self.rejected = 0
+        self.first_file = None
+        self.window_end = 0  # 模拟的followup路由限额：每 bucket_window 秒 bucket_limit 条消息
+        self.window_used = 0
+
+    async def receive(self, file):
+        size = 0
+        while True:
+            block = file.fp.read(MB)
+            if not block:
+                return size
+            size += len(block)
+            if self.bytes_per_second:
+                await asyncio.sleep(len(block) / self.bytes_per_second)
+
+    async def respond(self, status, headers):
+        """像真实请求一样把响应头交给上传调度器的 trace 回调"""
+        await dc_jm.bot.upload_scheduler.on_request_end(None, None, SimpleNamespace(
+            method='POST',
+            url=URL('https://discord.com/api/v10/webhooks/1/bench-token'),
+            response=SimpleNamespace(status=status, headers=headers),
+        ))
+
+    def take_bucket(self):
+        """占用一次路由限额，返回 (状态码, 响应头)"""
+        now = time.perf_counter()
+        if now >= self.window_end:
+            self.window_end = now + self.args.bucket_window
+            self.window_used = 0
+        reset_after = f"{self.window_end - now:.3f}"
+        if self.args.bucket_limit and self.window_used >= self.args.bucket_limit:
+            return 429, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset-After': reset_after, 'Retry-After': reset_after}
+        self.window_used += 1
+        if self.rng.random() < self.args.rate_limit:
+            retry_after = f"{self.args.retry_after:.3f}"
+            return 429, {'X-RateLimit-Reset-After': retry_after, 'Retry-After': retry_after}
+        remaining = max(self.args.bucket_limit - self.window_used, 0) if self.args.bucket_limit else 1000
+        return 200, {'X-RateLimit-Remaining': str(remaining), 'X-RateLimit-Reset-After': reset_after}
+
+    async def send(self, file):
+        self.messages += 1
+        while True:
+            size = await self.receive(file) if file is not None else 0
+            status, headers = self.take_bucket()
+            await self.respond(status, headers)
+            if status != 429:
+                break
+            # discord.py 收到429后等待 retry_after，重置文件位置再发一次
+            self.rate_limited += 1
+            await asyncio.sleep(float(headers['Retry-After']))
+            if file is not None:
+                file.reset()
+        if file is None:
+            return FakeMessage([])
+        if self.actual_limit and size > self.actual_limit:
+            self.rejected += 1
+            raise discord.HTTPException(SimpleNamespace(status=413, reason='Payload Too Large'),
+                                        {'code': 40005, 'message': 'Request entity too large'})
+        self.files += 1
+        if self.first_file is None:
+            self.first_file = time.perf_counter() - self.started
+        return FakeMessage([SimpleNamespace(url=f"https://cdn.example/attachments/{FakeMessage.next_id}/{file.filename}")])
+
+
+class FakeInteraction:
+    def __init__(self, filesize_limit, followup):
+        self.user = SimpleNamespace(id=1)
+        self.guild_id = 1
+        self.guild = None
+        self.filesize_limit = filesize_limit
+        self.application_id = 1
+        self.token = 'bench-token'
+        self.followup = followup
+
+
+def instrument_zip_parts():
+    """统计生成zip分片的CPU时间：构造（CRC）在文件IO线程池中，读取zip头在上传时"""
+    cpu = [0.0]
+
+    class TimedZipPartStream(dc_jm.ZipPartStream):
+        def __init__(self, *args, **kwargs):
+            started = time.thread_time()
+            super().__init__(*args, **kwargs)
+            cpu[0] += time.thread_time() - started
+
+        def readinto(self, buffer):
+            started = time.thread_time()
+            try:
+                return super().readinto(buffer)
+            finally:
+                cpu[0] += time.thread_time() - started
+
+    dc_jm.ZipPartStream = TimedZipPartStream
+    return cpu
+
+
+def run_case(path, args):
+    """在独立进程中发送一个文件，返回各项指标"""
+    zip_cpu = instrument_zip_parts()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cpu_before = time.process_time()
+    tracemalloc.start()
+
+    async def send():
+        started = time.perf_counter()
+        sink = FakeSink(args, started)
+        interaction = FakeInteraction(int(args.limit_mb * MB), FakeFollowup(sink))
+        success, message = await dc_jm.send_file_smart(interaction, path, os.path.basename(path))
+        return sink, success, message, time.perf_counter() - started
+
+    sink, success, message, elapsed = asyncio.run(send())
+    _, heap_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'size_mb': os.path.getsize(path) / MB,
+        'success': success,
+        'message': message,
+        'first_part_seconds': sink.first_file,
+        'total_seconds': elapsed,
+        'cpu_seconds': time.process_time() - cpu_before,
+        'zip_cpu_seconds': zip_cpu[0],
+        'rss_peak_delta_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024,
+        'heap_peak_mb': heap_peak / MB,
+        'messages': sink.messages,
+        'files': sink.files,
+        'rate_limited': sink.rate_limited,
+        'rejected': sink.rejected,
+    }
+
+
+def make_file(directory, size_mb):
+    path = os.path.join(directory, f"bench_{size_mb:g}MB.pdf")
+    with open(path, 'wb') as f:
+        remaining = int(size_mb * MB)
+        while remaining > 0:
+            block = os.urandom(min(MB, remaining))
+            f.write(block)
+            remaining -= len(block)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1,8,25,100,500', help='文件大小列表（MB），逗号分隔')
+    parser.add_argument('--limit-mb', type=float, default=10, help='interaction.filesize_limit（MB）')
+    parser.add_argument('--actual-limit-mb', type=float, default=0, help='接收端实际接受的大小，小于 --limit-mb 时模拟413')
+    parser.add_argument('--mbps', type=float, default=0, help='上传带宽（Mbps），0为不限')
+    parser.add_argument('--rate-limit', type=float, default=0, help='每次上传额外随机收到429的概率')
+    parser.add_argument('--retry-after', type=float, default=0.5, help='随机429要求等待的秒数')
+    parser.add_argument('--bucket-limit', type=int, default=5, help='followup路由每个窗口允许的消息数，0为不限')
+    parser.add_argument('--bucket-window', type=float, default=2, help='followup路由限额的窗口长度（秒）')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='把结果写入该JSON文件')
+    args = parser.parse_args()
+    sizes = [float(size) for size in args.sizes.split(',')]
+
+    print(f"上传限制 {args.limit_mb:g}MB，实际限制 {args.actual_limit_mb or args.limit_mb:g}MB，"
+          f"带宽 {'不限' if not args.mbps else f'{args.mbps:g}Mbps'}，429概率 {args.rate_limit:.0%}")
+    print(f"{'大小':>8}{'首个分片':>10}{'总耗时':>9}{'CPU':>8}{'zip CPU':>9}{'RSS增量':>9}{'堆峰值':>8}{'消息':>6}{'附件':>6}{'429':>5}{'413':>5}")
+    results = []
+    with tempfile.TemporaryDirectory(prefix='jm-delivery-') as directory:
+        for size in sizes:
+            path = make_file(directory, size)
+            # 每种大小用新进程，内存峰值互不影响
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                result = executor.submit(run_case, path, args).result()
+            os.remove(path)
+            results.append(result)
+            first = f"{result['first_part_seconds']:.2f}s" if result['first_part_seconds'] is not None else '-'
+            print(f"{size:>6g}MB{first:>10}{result['total_seconds']:>8.2f}s{result['cpu_seconds']:>7.2f}s"
+                  f"{result['zip_cpu_seconds']:>8.2f}s{result['rss_peak_delta_mb']:>7.0f}MB{result['heap_peak_mb']:>6.1f}MB"
+                  f"{result['messages']:>6}{result['files']:>6}{result['rate_limited']:>5}{result['rejected']:>5}")
+            if not result['success']:
+                print(f"  发送失败: {result['message']}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
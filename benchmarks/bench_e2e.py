@@ -0,0 +1,499 @@
+"""端到端基准测试：本地模拟JM站点 + 模拟Discord交互，驱动真实的命令处理流程
+
+用法：python benchmarks/bench_e2e.py [--requests 20] [--pages 40] [--concurrency 4] [--latency 0.02] [--fail-rate 0.02] [--jmr 0.25]
+
+- 模拟站点在独立进程中运行，提供合成的本子/章节数据和图片，可配置页数、章节数、响应延迟、
+  图片请求失败率和不存在的ID比例；图片ID在混淆阈值之上，下载后会走真实的解密流程
+- 机器人在临时目录中运行（复制 dc-jm.py，按仓库中的配置生成 bot_config.json / option.yml），
+  不读写仓库中的 pdf/、picture/ 和缓存索引
+- 通过假的 Interaction 调用 /jm 和 /jmr 的真实处理函数，上传时完整读取文件，可限制上传带宽
+
+输出每条命令的延迟分位数、每分钟送达的本子数、峰值内存、CPU时间和各阶段耗时合计。
+同样的参数和 --seed 下请求序列、失败位置都相同，便于对比不同提交的结果。
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRAMBLE_ID = 220980  # 与JM一致，本子ID不小于该值时图片是混淆过的
+BASE_ID = 300000
+
+
+# ---------------- 模拟JM站点 ----------------
+
+def album_layout(album_id, pages, chapters):
+    """本子的章节ID和每章页数，单章本子的章节ID就是本子ID"""
+    chapters = max(1, min(chapters, pages))
+    per_chapter = [pages // chapters + (1 if i < pages % chapters else 0) for i in range(chapters)]
+    if chapters == 1:
+        return [(album_id, per_chapter[0])]
+    return [(album_id * 100 + i + 1, count) for i, count in enumerate(per_chapter)]
+
+
+def is_missing(album_id, seed, missing_rate):
+    return random.Random(album_id * 31 + seed).random() < missing_rate
+
+
+def make_images(count, width, height):
+    from PIL import Image
+    images = []
+    for i in range(count):
+        img = Image.effect_noise((width, height), 30 + i % 20).convert('RGB')
+        buffer = BytesIO()
+        img.save(buffer, 'JPEG', quality=85)
+        images.append(buffer.getvalue())
+    return images
+
+
+def serve(args, port_queue):
+    """站点进程入口：/album/{id}、/photo/{id} 返回JSON，/media/photos/{id}/{name} 返回图片"""
+    images = make_images(args.image_variants, args.width, args.height)
+    rng = random.Random(args.seed)
+    rng_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, status, body=b'', content_type='application/json'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def reply_json(self, data):
+            self.reply(200, json.dumps(data).encode())
+
+        def do_GET(self):
+            if args.latency:
+                time.sleep(args.latency)
+            parts = self.path.split('?')[0].strip('/').split('/')
+            try:
+                if len(parts) == 2 and parts[0] == 'album':
+                    return self.album(int(parts[1]))
+                if len(parts) == 2 and parts[0] == 'photo':
+                    return self.photo(int(parts[1]))
+                if len(parts) == 4 and parts[:2] == ['media', 'photos']:
+                    return self.image(parts[3])
+            except ValueError:
+                pass
+            self.reply(404)
+
+        def album(self, album_id):
+            if album_id >= BASE_ID * 100 or is_missing(album_id, args.seed, args.missing_rate):
+                return self.reply(404)
+            layout = album_layout(album_id, args.pages, args.chapters)
+            self.reply_json({
+                'id': album_id,
+                'name': f'bench-{album_id}',
+                'page_count': args.pages,
+                'episodes': [[photo_id, i + 1, f'第{i + 1}话'] for i, (photo_id, _) in enumerate(layout)],
+            })
+
+        def photo(self, photo_id):
+            album_id = photo_id if photo_id < BASE_ID * 100 else photo_id // 100
+            if is_missing(album_id, args.seed, args.missing_rate):
+                return self.reply(404)
+            layout = dict(album_layout(album_id, args.pages, args.chapters))
+            if photo_id not in layout:
+                return self.reply(404)
+            single = len(layout) == 1
+            self.reply_json({
+                'id': photo_id,
+                'name': f'bench-{photo_id}',
+                'series_id': 0 if single else album_id,
+                'sort': 2 if single else photo_id % 100,
+                'page_arr': [f'{i:05d}.webp' for i in range(1, layout[photo_id] + 1)],
+                'domain': self.headers['Host'],
+            })
+
+        def image(self, name):
+            with rng_lock:
+                failed = rng.random() < args.fail_rate
+            if failed:
+                return self.reply(503)
+            index = int(name.split('.')[0])
+            self.reply(200, images[index % len(images)], 'image/webp')
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+# ---------------- 机器人运行环境 ----------------
+
+def register_bench_client():
+    """按模拟站点的JSON格式解析本子和章节的客户端，图片仍走 jmcomic 原本的下载和解密流程"""
+    import jmcomic
+    from jmcomic import JmcomicText, JmModuleConfig, ExceptionTool
+
+    class BenchClient(jmcomic.JmHtmlClient):
+        client_key = 'bench'
+
+        def fetch_detail_entity(self, jmid, prefix):
+            jmid = JmcomicText.parse_to_jm_id(jmid)
+            resp = self.get(f"/{prefix}/{jmid}")
+            if resp.status_code == 404:
+                ExceptionTool.raise_missing(resp, jmid)
+            data = resp.json()
+            if prefix == 'album':
+                return jmcomic.JmAlbumDetail(
+                    data['id'], SCRAMBLE_ID, data['name'], data['episodes'], data['page_count'],
+                    '', '', '0', '0', 0, [], [], ['bench'], [],
+                )
+            return jmcomic.JmPhotoDetail(
+                data['id'], data['name'], data['series_id'], data['sort'],
+                scramble_id=SCRAMBLE_ID,
+                page_arr=data['page_arr'],
+                data_original_domain=data['domain'],
+            )
+
+    JmModuleConfig.register_client(BenchClient)
+    JmModuleConfig.PROT = 'http://'
+
+
+def prepare_workspace(args, port):
+    """在临时目录中按仓库配置生成机器人配置，指向模拟站点"""
+    work = tempfile.mkdtemp(prefix='jm-bench-')
+    for filename in ('dc-jm.py', 'jm_workers.py'):
+        shutil.copy(os.path.join(ROOT, filename), work)
+
+    with open(os.path.join(ROOT, 'option.yml'), 'r', encoding='utf-8') as f:
+        option = yaml.safe_load(f)
+    option['log'] = False
+    option['client'].update(impl='bench', domain=[f'127.0.0.1:{port}'], retry_times=args.retry_times)
+    option['client']['postman'] = {'meta_data': {'proxies': None}}
+    for item in option['plugins']['before_album']:
+        if item['plugin'] == 'skip_too_long_book':
+            item['kwargs']['max_pages'] = max(item['kwargs'].get('max_pages', 100), args.pages)
+    with open(os.path.join(work, 'option.yml'), 'w', encoding='utf-8') as f:
+        yaml.safe_dump(option, f, allow_unicode=True)
+
+    with open(os.path.join(ROOT, 'bot_config.json'), 'r', encoding='utf-8') as f:
+        bot_config = json.load(f)
+    bot_config.update(token=None, IDmin=BASE_ID, IDmax=BASE_ID + args.id_span - 1)
+    bot_config.setdefault('scheduler', {})['max_concurrent_albums'] = args.max_concurrent_albums
+    bot_config['scheduler']['max_queue'] = max(bot_config['scheduler'].get('max_queue', 20), args.requests)
+    for section in ('domain_probe', 'random_prefetch', 'metrics'):
+        bot_config.setdefault(section, {})['enabled'] = False
+    bot_config.setdefault('random_index', {})['crawler_enabled'] = False
+    staging = bot_config.setdefault('image_staging', {})
+    staging['mode'] = args.image_staging
+    if args.image_staging == 'tmpfs':
+        staging['tmpfs_dir'] = args.tmpfs_dir or os.path.join(work, 'staging')
+    if args.staging_mb is not None:
+        staging['max_size_mb'] = args.staging_mb
+    with open(os.path.join(work, 'bot_config.json'), 'w', encoding='utf-8') as f:
+        json.dump(bot_config, f, ensure_ascii=False, indent=2)
+    return work
+
+
+def load_bot(work):
+    """在工作目录中加载 dc-jm.py（load_config 从当前目录读取 bot_config.json）"""
+    os.chdir(work)
+    sys.path.insert(0, work)  # 进程池的子进程也从这里导入 jm_workers
+    spec = importlib.util.spec_from_file_location('dc_jm', os.path.join(work, 'dc-jm.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['dc_jm'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# ---------------- 模拟Discord交互 ----------------
+
+class FakeAttachment:
+    def __init__(self, url):
+        self.url = url
+
+
+class FakeChannel:
+    id = 1
+
+
+class FakeMessage:
+    next_id = 1
+
+    def __init__(self, interaction, embed=None, attachments=()):
+        self.id = FakeMessage.next_id
+        FakeMessage.next_id += 1
+        self.channel = FakeChannel
+        self.interaction = interaction
+        self.embed = embed
+        self.attachments = list(attachments)
+
+    async def edit(self, embed=None, **kwargs):
+        self.embed = embed
+        self.interaction.record('edit', embed)
+        return self
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.message = None
+
+    def is_done(self):
+        return self.message is not None
+
+    async def send_message(self, embed=None, **kwargs):
+        self.message = FakeMessage(self.interaction, embed)
+        self.interaction.record('response', embed)
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, embed=None, embeds=None, file=None, **kwargs):
+        attachments = []
+        if file is not None:
+            size = await self.interaction.upload(file)
+            attachments.append(FakeAttachment(
+                f"https://cdn.example/attachments/{FakeMessage.next_id}/{file.filename}?ex={int(time.time()) + 86400:x}&size={size}"
+            ))
+        message = FakeMessage(self.interaction, embed or (embeds[0] if embeds else None), attachments)
+        self.interaction.record('file' if file is not None else 'followup', message.embed)
+        return message
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+class FakeInteraction:
+    """只实现命令处理流程用到的属性，记录每条消息的时间"""
+
+    def __init__(self, user_id, filesize_limit, upload_bps):
+        self.user = FakeUser(user_id)
+        self.guild_id = 1
+        self.guild = None
+        self.filesize_limit = filesize_limit
+        self.application_id = 1
+        self.token = f'bench-{user_id}-{FakeMessage.next_id}'
+        self.upload_bps = upload_bps
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.started = time.perf_counter()
+        self.events = []  # (相对时间, 类型, 标题)
+        self.uploaded = 0
+
+    def record(self, kind, embed):
+        self.events.append((time.perf_counter() - self.started, kind, embed.title if embed else None))
+
+    async def original_response(self):
+        return self.response.message
+
+    async def upload(self, file):
+        """像真实上传一样按块读完文件内容，设置了带宽时按带宽等待"""
+        size = 0
+        while True:
+            block = file.fp.read(1024 * 1024)
+            if not block:
+                break
+            size += len(block)
+            if self.upload_bps:
+                await asyncio.sleep(len(block) / self.upload_bps)
+        self.uploaded += size
+        return size
+
+    @property
+    def delivered(self):
+        return any(kind == 'file' or title == '📎 文件已上传过' for _, kind, title in self.events)
+
+    @property
+    def first_file(self):
+        return next((at for at, kind, title in self.events if kind == 'file' or title == '📎 文件已上传过'), None)
+
+
+# ---------------- 统计 ----------------
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    rank = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[rank]
+
+
+def stage_totals(metrics):
+    """各阶段的次数和耗时合计"""
+    totals = {}
+    with metrics.lock:
+        for (name, labels), values in metrics.histograms.items():
+            if name == 'jm_stage_duration_seconds':
+                totals[dict(labels)['stage']] = (values[-2], values[-1])
+    return totals
+
+
+async def run_benchmark(dc_jm, args):
+    bot = dc_jm.bot
+    bot.load_state()
+    random.seed(args.seed)
+
+    plan_rng = random.Random(args.seed)
+    plan = []
+    for i in range(args.requests):
+        if plan_rng.random() < args.jmr:
+            plan.append(('jmr', None))
+        else:
+            plan.append(('jm', str(BASE_ID + i % args.id_span)))
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    results = []
+
+    async def one(index, command, comic_id):
+        async with semaphore:
+            interaction = FakeInteraction(1000 + index % args.users, args.filesize_limit_mb * 1024 * 1024,
+                                          args.upload_mbps * 1024 * 1024 / 8)
+            try:
+                if command == 'jmr':
+                    await dc_jm.slash_random_download_jm.callback(interaction)
+                else:
+                    await dc_jm.download_comic_handler_slash(interaction, comic_id)
+            except Exception as e:
+                interaction.record('error', None)
+                print(f"  {command} {comic_id or ''} 出错: {e}")
+            elapsed = time.perf_counter() - interaction.started
+            results.append((command, elapsed, interaction))
+
+    cpu_before = os.times()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i, command, comic_id) for i, (command, comic_id) in enumerate(plan)))
+    wall = time.perf_counter() - started
+    if bot.process_pool.executor is not None:
+        # 等进程池退出，子进程的资源占用才会计入 RUSAGE_CHILDREN
+        bot.process_pool.executor.shutdown(wait=True)
+    await bot.close()
+    cpu_after = os.times()
+
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    delivered = [r for r in results if r[2].delivered]
+    report = {
+        'requests': len(results),
+        'delivered': len(delivered),
+        'wall_seconds': wall,
+        'albums_per_minute': len(delivered) / wall * 60 if wall else 0,
+        'cpu_seconds': (cpu_after.user - cpu_before.user) + (cpu_after.system - cpu_before.system),
+        'children_cpu_seconds': (cpu_after.children_user - cpu_before.children_user)
+                                + (cpu_after.children_system - cpu_before.children_system),
+        'peak_rss_mb': self_usage.ru_maxrss / 1024,
+        'children_peak_rss_mb': children_usage.ru_maxrss / 1024,
+        'uploaded_mb': sum(r[2].uploaded for r in results) / 1024 / 1024,
+        'staged_images': dc_jm.bot.image_staging.staged,
+        'spilled_images': dc_jm.bot.image_staging.spilled,
+        'commands': {},
+        'stages': {stage: {'count': count, 'seconds': seconds}
+                   for stage, (count, seconds) in sorted(stage_totals(dc_jm.metrics).items())},
+    }
+    for command in ('jm', 'jmr', 'all'):
+        latencies = [elapsed for c, elapsed, _ in results if command in ('all', c)]
+        first_files = [r[2].first_file for r in results if command in ('all', r[0]) and r[2].first_file is not None]
+        if not latencies:
+            continue
+        report['commands'][command] = {
+            'count': len(latencies),
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'first_file_p50': percentile(first_files, 50),
+        }
+    return report
+
+
+def print_report(report):
+    print(f"\n请求 {report['requests']} 个，送达 {report['delivered']} 个，耗时 {report['wall_seconds']:.1f}s，"
+          f"{report['albums_per_minute']:.1f} 本/分钟，上传 {report['uploaded_mb']:.1f}MB")
+    print(f"{'命令':<6}{'数量':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'首个文件p50':>14}")
+    for command, stats in report['commands'].items():
+        print(f"{command:<6}{stats['count']:>6}{stats['p50']:>8.2f}s{stats['p95']:>8.2f}s{stats['p99']:>8.2f}s"
+              f"{stats['first_file_p50']:>13.2f}s")
+    print(f"CPU时间: 主进程 {report['cpu_seconds']:.1f}s，解密进程池 {report['children_cpu_seconds']:.1f}s")
+    print(f"峰值内存: 主进程 {report['peak_rss_mb']:.0f}MB，子进程最大 {report['children_peak_rss_mb']:.0f}MB")
+    if report['staged_images'] or report['spilled_images']:
+        print(f"图片暂存: 暂存 {report['staged_images']} 张，超出预算写入磁盘 {report['spilled_images']} 张")
+    print("各阶段耗时合计:")
+    for stage, stats in report['stages'].items():
+        print(f"  {stage:<16}{stats['count']:>6} 次 {stats['seconds']:>9.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=20, help='命令总数')
+    parser.add_argument('--concurrency', type=int, default=4, help='同时进行的命令数')
+    parser.add_argument('--jmr', type=float, default=0.25, help='/jmr 命令的比例')
+    parser.add_argument('--id-span', type=int, default=0, help='ID范围大小，默认等于命令总数；小于命令数时会出现重复ID')
+    parser.add_argument('--users', type=int, default=4, help='发起命令的用户数')
+    parser.add_argument('--pages', type=int, default=40, help='每本页数')
+    parser.add_argument('--chapters', type=int, default=1, help='每本章节数')
+    parser.add_argument('--width', type=int, default=1080)
+    parser.add_argument('--height', type=int, default=1600)
+    parser.add_argument('--image-variants', type=int, default=8, help='站点预先生成的不同图片数')
+    parser.add_argument('--latency', type=float, default=0.02, help='站点每个请求的延迟（秒）')
+    parser.add_argument('--fail-rate', type=float, default=0.02, help='图片请求返回503的概率')
+    parser.add_argument('--missing-rate', type=float, default=0.0, help='不存在的本子ID比例')
+    parser.add_argument('--retry-times', type=int, default=5, help='option.yml 中的 retry_times')
+    parser.add_argument('--max-concurrent-albums', type=int, default=2, help='bot_config.json 中的同时下载本子数')
+    parser.add_argument('--filesize-limit-mb', type=float, default=10, help='模拟的服务器上传限制')
+    parser.add_argument('--upload-mbps', type=float, default=0, help='模拟的上传带宽（Mbps），0为不限')
+    parser.add_argument('--image-staging', choices=('disk', 'memory', 'tmpfs'), default='disk', help='图片暂存模式')
+    parser.add_argument('--tmpfs-dir', help='tmpfs 模式的暂存目录，默认为工作目录下的 staging/')
+    parser.add_argument('--staging-mb', type=float, help='图片暂存预算（MB），默认使用 bot_config.json 中的值')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='把结果写入该JSON文件')
+    parser.add_argument('--keep', action='store_true', help='保留临时工作目录')
+    args = parser.parse_args()
+    args.id_span = args.id_span or args.requests
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(args, port_queue), daemon=True)
+    server.start()
+    port = port_queue.get(timeout=60)
+    print(f"模拟站点: 127.0.0.1:{port}，每本 {args.pages} 页 / {args.chapters} 章，"
+          f"延迟 {args.latency * 1000:.0f}ms，失败率 {args.fail_rate:.0%}")
+
+    register_bench_client()
+    work = prepare_workspace(args, port)
+    cwd = os.getcwd()
+    try:
+        dc_jm = load_bot(work)
+        import logging
+        logging.getLogger().setLevel(logging.WARNING)
+        print(f"工作目录: {work}，并发 {args.concurrency}，命令 {args.requests} 个（/jmr 约 {args.jmr:.0%}），"
+              f"图片暂存 {args.image_staging}")
+        report = asyncio.run(run_benchmark(dc_jm, args))
+    finally:
+        os.chdir(cwd)
+        server.terminate()
+        if not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), **report}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
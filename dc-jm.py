@@ -3,161 +3,2911 @@ from discord.ext import commands
 from discord import app_commands
 import json
 import asyncio
+import copy
 import os
 import time
 import random
 import yaml
 import logging
-import zipfile
+import math
+import hashlib
+import weakref
+import threading
+import re
+import zlib
+import io
+import mmap
+import struct
+import contextlib
+import shutil
+import heapq
+import itertools
+import multiprocessing
+import importlib.util
+import sys
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
 from io import BytesIO
+from collections import OrderedDict, deque
+from aiohttp import web, TraceConfig
 
 import jmcomic
-from jmcomic.jm_exception import PartialDownloadFailedException
+from common import AbstractPostman
+from jmcomic.jm_exception import PartialDownloadFailedException, MissingAlbumPhotoException
+from jmcomic.jm_downloader import catch_exception, record_download_duration
+from jm_workers import DEFAULT_DPI, decode_jm_image, encode_jm_image, scan_pdf_images, encode_pdf_pages
 
 # 设置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# 自定义JMComic插件实现控制最大下载页数
-async def download_comic_async(album_id, option):
-    """异步下载漫画"""
+class Metrics:
+    """运行指标，按 Prometheus 文本格式输出
+
+    计数器和直方图可在任意线程中更新；瞬时值（队列长度、线程数等）注册为回调，输出时再读取。
+    """
+
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}  # 指标名 -> (类型, 说明)
+        self.counters = {}  # (指标名, 标签) -> 值
+        self.histograms = {}  # (指标名, 标签) -> [各桶计数..., 总数, 总和]
+        self.callbacks = {}  # 指标名 -> 返回当前值的函数
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            values = self.histograms.get(key)
+            if values is None:
+                values = self.histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    values[i] += 1
+            values[-2] += 1
+            values[-1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def register(self, name, kind, text, func):
+        """注册输出时才读取的指标"""
+        self.describe(name, kind, text)
+        self.callbacks[name] = func
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        return '{' + ','.join(f'{key}="{str(value)}"' for key, value in items) + '}'
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+        samples = {}  # 指标名 -> 行
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append(f"{name}{self.format_labels(labels)} {value}")
+        for (name, labels), values in histograms.items():
+            lines = samples.setdefault(name, [])
+            for bound, count in zip(self.BUCKETS, values):
+                lines.append(f"{name}_bucket{self.format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {values[-2]}")
+            lines.append(f"{name}_count{self.format_labels(labels)} {values[-2]}")
+            lines.append(f"{name}_sum{self.format_labels(labels)} {values[-1]}")
+        for name, func in self.callbacks.items():
+            try:
+                samples[name] = [f"{name} {func()}"]
+            except Exception as e:
+                logger.debug(f"读取指标 {name} 失败: {e}")
+        
+        output = []
+        for name in sorted(samples):
+            kind, text = self.help.get(name, ('untyped', ''))
+            output.append(f"# HELP {name} {text}")
+            output.append(f"# TYPE {name} {kind}")
+            output.extend(samples[name])
+        return '\n'.join(output) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('jm_stage_duration_seconds', 'histogram', '各阶段耗时（排队、元数据、图片下载、解密、PDF生成、分片、上传）')
+metrics.describe('jm_downloaded_bytes_total', 'counter', '下载的图片字节数')
+metrics.describe('jm_uploaded_bytes_total', 'counter', '上传到Discord的字节数')
+metrics.describe('jm_image_failures_total', 'counter', '下载失败的图片数，按图片域名')
+metrics.describe('jm_downloads_total', 'counter', '本子下载次数，按结果')
+
+
+class ProfileSession:
+    """一次下载任务的性能采样
+
+    后台线程按固定间隔采样所有线程的调用栈，覆盖 to_thread 工作线程和 jmcomic 的下载线程；
+    同时用 tracemalloc 记录内存峰值。结束后写出折叠调用栈（可直接生成火焰图）和文字摘要。
+    """
+
+    # 调用栈顶层在这些文件中的线程视为空闲等待，不计入热点
+    IDLE_FILES = ('threading.py', 'selectors.py', 'queue.py', os.path.join('concurrent', 'futures', 'thread.py'))
+
+    def __init__(self, comic_id, output_dir, interval=0.005):
+        self.comic_id = comic_id
+        self.output_dir = output_dir
+        self.interval = interval
+        self.stacks = {}  # 调用栈（从外到内）-> 采样次数
+        self.samples = 0
+        self.idle_samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.started_tracemalloc = False
+        self.started_at = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        tracemalloc.reset_peak()
+        self.started_at = time.perf_counter()
+        self.thread = threading.Thread(target=self._sample_loop, name=f'profile-{self.comic_id}', daemon=True)
+        self.thread.start()
+
+    def _sample_loop(self):
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if frame.f_code.co_filename.endswith(self.IDLE_FILES):
+                    self.idle_samples += 1
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack = tuple(reversed(stack))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.samples += 1
+
+    def stop(self):
+        """停止采样并写出结果文件，返回摘要"""
+        self.stop_event.set()
+        self.thread.join()
+        elapsed = time.perf_counter() - self.started_at
+        _, peak = tracemalloc.get_traced_memory()
+        top_allocations = tracemalloc.take_snapshot().statistics('lineno')[:20]
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+
+        own, total = {}, {}
+        for stack, count in self.stacks.items():
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            for name in set(stack):
+                total[name] = total.get(name, 0) + count
+        top_own = sorted(own.items(), key=lambda item: item[1], reverse=True)[:15]
+        top_total = sorted(total.items(), key=lambda item: item[1], reverse=True)[:15]
+        try:
+            import resource
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Linux 上单位为KB
+        except ImportError:
+            peak_rss = None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, f"{self.comic_id}_{time.strftime('%Y%m%d-%H%M%S')}")
+        with open(base + '.folded', 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.items():
+                f.write(f"{';'.join(stack)} {count}\n")
+        with open(base + '.txt', 'w', encoding='utf-8') as f:
+            f.write(f"漫画 {self.comic_id}，耗时 {elapsed:.1f}s，采样 {self.samples} 次（空闲 {self.idle_samples} 次）\n")
+            f.write(f"tracemalloc 峰值: {peak / 1024 / 1024:.1f}MB\n")
+            if peak_rss is not None:
+                f.write(f"进程峰值RSS: {peak_rss / 1024 / 1024:.1f}MB\n")
+            f.write("\n== 自身耗时 ==\n")
+            f.writelines(f"{count:8d}  {name}\n" for name, count in top_own)
+            f.write("\n== 累计耗时 ==\n")
+            f.writelines(f"{count:8d}  {name}\n" for name, count in top_total)
+            f.write("\n== 内存分配 ==\n")
+            f.writelines(f"{stat}\n" for stat in top_allocations)
+
+        return {
+            'elapsed': elapsed,
+            'samples': self.samples,
+            'idle_samples': self.idle_samples,
+            'top_own': top_own,
+            'tracemalloc_peak': peak,
+            'peak_rss': peak_rss,
+            'files': [base + '.folded', base + '.txt'],
+        }
+
+
+class JobProfiler:
+    """按所有者的要求为接下来的N个下载或指定漫画开启性能采样，同一时间只采样一个任务"""
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.remaining = 0
+        self.targets = set()
+        self.channel = None  # 结果发送到下达命令的频道
+        self.active = None
+
+    def arm_next(self, count, channel):
+        self.remaining = count
+        self.channel = channel
+
+    def arm_id(self, comic_id, channel):
+        self.targets.add(comic_id)
+        self.channel = channel
+
+    def disarm(self):
+        self.remaining = 0
+        self.targets.clear()
+
+    def claim(self, comic_id):
+        """该下载需要采样时返回新的 ProfileSession"""
+        if self.active is not None:
+            return None
+        if comic_id in self.targets:
+            self.targets.discard(comic_id)
+        elif self.remaining > 0:
+            self.remaining -= 1
+        else:
+            return None
+        self.active = ProfileSession(comic_id, self.output_dir)
+        return self.active
+
+    async def finish(self, session):
+        """结束采样并把摘要发到下达命令的频道"""
+        self.active = None
+        try:
+            report = await asyncio.to_thread(session.stop)
+        except Exception as e:
+            logger.error(f"写出性能采样结果失败 {session.comic_id}: {e}")
+            return
+        logger.info(f"性能采样完成 {session.comic_id}: {report['files'][1]}")
+        if self.channel is None:
+            return
+        busy = report['samples'] or 1
+        lines = [f"`{count * 100 // busy:3d}%` {name[:90]}" for name, count in report['top_own'][:8]]
+        embed = discord.Embed(
+            title=f"🔬 性能采样: {session.comic_id}",
+            description=f"耗时 {report['elapsed']:.1f}s，采样 {report['samples']} 次（另有 {report['idle_samples']} 次空闲等待）",
+            color=discord.Color.blue()
+        )
+        embed.add_field(name="🔥 热点函数（自身耗时占比）", value="\n".join(lines) or "无", inline=False)
+        memory = f"tracemalloc 峰值 {report['tracemalloc_peak'] / 1024 / 1024:.1f}MB"
+        if report['peak_rss'] is not None:
+            memory += f"\n进程峰值RSS {report['peak_rss'] / 1024 / 1024:.1f}MB"
+        embed.add_field(name="💾 内存", value=memory, inline=True)
+        embed.add_field(name="📄 结果文件", value="\n".join(f"`{os.path.basename(path)}`" for path in report['files']), inline=True)
+        try:
+            await self.channel.send(embed=embed)
+        except discord.HTTPException as e:
+            logger.warning(f"发送性能采样结果失败: {e}")
+
+
+class ZipPartStream(io.RawIOBase):
+    """把文件的一段包装成只含一个 ZIP_STORED 条目的 zip 流。
+
+    数据部分直接引用 mmap 的 memoryview，不复制分片内容；只有几十字节的
+    zip 头和目录是新生成的。可 seek，便于 discord.py 在重试时重新读取。
+    """
+
+    # 分片大小需要为 zip 头/目录和 multipart 表单头预留的空间
+    RESERVED = 64 * 1024
+
+    def __init__(self, mapped, offset, length, arcname):
+        super().__init__()
+        self.data = memoryview(mapped)[offset:offset + length]
+        crc = zlib.crc32(self.data)
+        name = arcname.encode('utf-8')
+        t = time.localtime()
+        dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+        dos_date = ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+        # 通用标志位 0x800 表示文件名为 UTF-8
+        local_header = struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 20, 0x800, 0, dos_time, dos_date,
+            crc, length, length, len(name), 0
+        ) + name
+        central_dir = struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, 0x800, 0, dos_time, dos_date,
+            crc, length, length, len(name), 0, 0, 0, 0, 0, 0
+        ) + name
+        end_record = struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, 1, 1,
+            len(central_dir), len(local_header) + length, 0
+        )
+        self.segments = [local_header, self.data, central_dir + end_record]
+        self.size = sum(len(segment) for segment in self.segments)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.pos = offset
+        return self.pos
+
+    def readinto(self, buffer):
+        written = 0
+        wanted = len(buffer)
+        base = 0
+        for segment in self.segments:
+            seg_len = len(segment)
+            if written < wanted and self.pos < base + seg_len:
+                start = self.pos - base
+                count = min(seg_len - start, wanted - written)
+                buffer[written:written + count] = segment[start:start + count]
+                written += count
+                self.pos += count
+            base += seg_len
+        return written
+
+    def release(self):
+        """释放对 mmap 的引用，否则 mmap 无法关闭。
+
+        discord.File 会把 fp.close 替换成空函数，所以单独提供这个方法。
+        """
+        if self.segments:
+            self.segments = []
+            self.data.release()
+
+    def close(self):
+        self.release()
+        super().close()
+
+async def send_large_file(interaction: discord.Interaction, file_path: str, filename: str, max_size: int = None, sent_messages: list = None):
+    """发送大文件，如果超过限制则分片发送。sent_messages 用于收集带附件的消息
+
+    max_size 默认取当前服务器的上传限制
+    """
+    if sent_messages is None:
+        sent_messages = []
+    if max_size is None:
+        max_size = bot.upload_limits.get(interaction)
+    file_size = await bot.file_io.getsize(file_path)
+    
+    if file_size <= max_size:
+        # 文件小于限制，直接发送
+        try:
+            with await bot.file_io.open(file_path) as f, metrics.timer('jm_stage_duration_seconds', stage='discord_upload'):
+                file = discord.File(f, filename=filename)
+                sent_messages.append(await bot.upload_scheduler.send(interaction, file=file))
+            metrics.inc('jm_uploaded_bytes_total', file_size)
+            return True, "文件发送成功"
+        except Exception as e:
+            return False, f"文件发送失败: {str(e)}"
+    
+    # 文件过大，需要分片发送
+    logger.info(f"文件过大 ({file_size//1024}KB)，开始分片发送")
+    
     try:
-        # 将同步下载操作放到线程池中执行，避免阻塞事件循环
-        await asyncio.to_thread(jmcomic.download_album, album_id, option)
-        return True, None
-    except PartialDownloadFailedException as e:
-        # 处理部分下载失败
-        logger.warning(f"部分下载失败: {str(e)}")
-        failed_count = str(e).count("RequestRetryAllFailException")
-        return "partial", f"部分图片下载失败({failed_count}个)，但可能已生成不完整的PDF"
+        # 分片以 ZIP_STORED 直接引用 mmap 视图，任一时刻只有一个分片在发送
+        chunk_size = max_size - ZipPartStream.RESERVED
+        total_parts = math.ceil(file_size / chunk_size)
+        
+        # 分片说明和第一个分片放在同一条消息里，第一个分片被413拒绝重新分片时不会留下分片数不对的说明
+        header_embed = discord.Embed(
+            title="📦 文件分片发送",
+            description=f"文件过大({file_size//1024}KB)，分为{total_parts}个部分发送",
+            color=discord.Color.blue()
+        )
+        
+        retry_size = None
+        with await bot.file_io.open(file_path) as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for i in range(1, total_parts + 1):
+                offset = (i - 1) * chunk_size
+                # CRC 需要扫描整个分片，放到文件IO线程池里避免阻塞事件循环
+                with metrics.timer('jm_stage_duration_seconds', stage='file_split'):
+                    part = await bot.file_io.run(
+                        ZipPartStream, mapped, offset, min(chunk_size, file_size - offset), f"{filename}.part{i}"
+                    )
+                try:
+                    chunk_file = discord.File(part, filename=f"{filename}.part{i}.zip")
+                    embed = discord.Embed(
+                        title=f"📁 第{i}部分",
+                        description=f"共{total_parts}部分",
+                        color=discord.Color.green()
+                    )
+                    embeds = [header_embed, embed] if i == 1 else [embed]
+                    with metrics.timer('jm_stage_duration_seconds', stage='discord_upload'):
+                        sent_messages.append(await bot.upload_scheduler.send(
+                            interaction, UploadScheduler.PRIORITY_PART, embeds=embeds, file=chunk_file
+                        ))
+                    metrics.inc('jm_uploaded_bytes_total', part.size)
+                except discord.HTTPException as e:
+                    # 第一个分片就被拒绝说明限制估计偏高，按学到的限制重新分片
+                    if e.status != 413 or i > 1:
+                        raise
+                    retry_size = bot.upload_limits.learn(interaction, part.size)
+                    if retry_size >= max_size:
+                        raise
+                    break
+                finally:
+                    part.release()
+        
+        if retry_size is not None:
+            logger.warning(f"分片超过上传限制，改为按 {retry_size//1024}KB 重新分片: {filename}")
+            return await send_large_file(interaction, file_path, filename, retry_size, sent_messages)
+        
+        # 发送合并说明
+        merge_embed = discord.Embed(
+            title="🔧 文件合并说明",
+            description=f"""
+**合并步骤：**
+1. 下载所有 .zip 分片文件
+2. 解压每个分片文件得到 .part 文件
+3. 使用以下命令合并（Windows）：
+```
+copy /b {filename}.part1+{filename}.part2+...+{filename}.part{total_parts} {filename}
+```
+**或者使用在线工具合并分片文件**
+            """,
+            color=discord.Color.yellow()
+        )
+        await interaction.followup.send(embed=merge_embed)
+        
+        return True, f"文件已分为{total_parts}个部分发送"
+        
     except Exception as e:
-        return False, f"下载出错: {str(e)}"
+        return False, f"分片发送失败: {str(e)}"
+
+async def send_file_smart(interaction: discord.Interaction, file_path: str, filename: str, sent_messages: list = None):
+    """智能文件发送，自动处理大文件。sent_messages 用于收集带附件的消息"""
+    if sent_messages is None:
+        sent_messages = []
+    file_size = await bot.file_io.getsize(file_path)
+    
+    # Discord文件大小限制检测（按服务器缓存）
+    max_size = bot.upload_limits.get(interaction)
+    
+    if file_size <= max_size:
+        # 尝试直接发送
+        try:
+            with await bot.file_io.open(file_path) as f, metrics.timer('jm_stage_duration_seconds', stage='discord_upload'):
+                file = discord.File(f, filename=filename)
+                sent_messages.append(await bot.upload_scheduler.send(interaction, file=file))
+            metrics.inc('jm_uploaded_bytes_total', file_size)
+            logger.info(f"文件直接发送成功: {filename} ({file_size//1024}KB)")
+            return True, "文件发送成功"
+        except discord.HTTPException as e:
+            if e.status == 413 or "Payload Too Large" in str(e):
+                logger.warning(f"文件过大，转为分片发送: {filename}")
+                max_size = bot.upload_limits.learn(interaction, file_size)
+                return await send_large_file(interaction, file_path, filename, max_size, sent_messages)
+            else:
+                return False, f"文件发送失败: {str(e)}"
+        except Exception as e:
+            return False, f"文件发送失败: {str(e)}"
+    else:
+        # 文件明显过大，直接分片
+        logger.info(f"文件过大，直接分片发送: {filename} ({file_size//1024}KB)")
+        return await send_large_file(interaction, file_path, filename, max_size, sent_messages)
+
+def file_sha256(file_path):
+    """计算文件的sha256（阻塞，需在线程中调用）"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class SkipTooLongBook(jmcomic.JmOptionPlugin):
+    plugin_key = 'skip_too_long_book'
+    
+    def invoke(self, 
+               max_pages: int = 100,  # 可在option.yml中配置
+               album: jmcomic.JmAlbumDetail = None,
+               **kwargs):
+        if album is None:
+            logger.error('错误: Album is None')
+            return
+        pages = album.page_count
+        logger.info(f'漫画 {album.id} 共 {pages} 页，限制为 {max_pages} 页')
+        if pages <= max_pages:
+            logger.info(f'页数检查通过: {pages}/{max_pages}')
+            return
+        else:
+            logger.warning(f'超过页数限制({max_pages}页)，已阻止下载 - 漫画ID: {album.id}')
+            raise Exception(f"漫画页数({pages}页)超过限制({max_pages}页)")
+
+class StreamingPdfWriter:
+    """增量写入的PDF文件
+
+    每页图片到达后立即写入图片、内容流和页面对象，内存中只保留对象偏移量，
+    close() 时再写入页面树、目录和交叉引用表。JPEG 原样嵌入，不重新编码。
+    """
+
+    DEFAULT_DPI = DEFAULT_DPI
+
+    def __init__(self, pdf_path):
+        self.pdf_path = pdf_path
+        self.temp_path = pdf_path + '.part'
+        self.file = open(self.temp_path, 'wb')
+        self.offsets = {}
+        self.page_ids = []
+        self.next_id = 3  # 1: 目录，2: 页面树
+        self.file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+    def _write_object(self, obj_id, body, stream=None):
+        self.offsets[obj_id] = self.file.tell()
+        self.file.write(f"{obj_id} 0 obj\n".encode())
+        self.file.write(body)
+        if stream is not None:
+            self.file.write(b"\nstream\n")
+            self.file.write(stream)
+            self.file.write(b"\nendstream")
+        self.file.write(b"\nendobj\n")
+
+    @classmethod
+    def encode_image(cls, source):
+        """把图片转为PDF图片对象，返回 (字典内容, 数据, 宽, 高, dpi)。source 为路径或字节"""
+        from PIL import Image
+        fp = BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source
+        with Image.open(fp) as img:
+            width, height = img.size
+            dpi = img.info.get('dpi', (cls.DEFAULT_DPI,))[0] or cls.DEFAULT_DPI
+            if dpi < 10:
+                dpi = cls.DEFAULT_DPI
+            colorspace = {'L': '/DeviceGray', 'RGB': '/DeviceRGB', 'CMYK': '/DeviceCMYK'}
+            if img.format == 'JPEG' and img.mode in colorspace:
+                if isinstance(source, str):
+                    with open(source, 'rb') as f:
+                        data = f.read()
+                else:
+                    data = bytes(source)
+                extra = ''
+                if img.mode == 'CMYK' and 'adobe' in img.info:
+                    # Adobe 写出的 CMYK JPEG 是反相的
+                    extra = ' /Decode [1 0 1 0 1 0 1 0]'
+                return f"/ColorSpace {colorspace[img.mode]} /BitsPerComponent 8 /Filter /DCTDecode{extra}", data, width, height, dpi
+            # 其他格式无损压缩后嵌入
+            if img.mode not in ('L', 'RGB'):
+                img = img.convert('RGB')
+            data = zlib.compress(img.tobytes(), 6)
+            return f"/ColorSpace {colorspace[img.mode]} /BitsPerComponent 8 /Filter /FlateDecode", data, width, height, dpi
+
+    def add_page(self, source, page_size=None):
+        """写入一页，source 为图片路径或字节；page_size 为 (宽, 高)（单位pt），默认按图片的dpi换算"""
+        image_dict, data, width, height, dpi = self.encode_image(source)
+        image_id, content_id, page_id = self.next_id, self.next_id + 1, self.next_id + 2
+        self.next_id += 3
+        if page_size is None:
+            page_size = (width * 72 / dpi, height * 72 / dpi)
+        page_width, page_height = page_size
+        self._write_object(
+            image_id,
+            f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} {image_dict} /Length {len(data)} >>".encode(),
+            data,
+        )
+        content = f"q {page_width:.4f} 0 0 {page_height:.4f} 0 0 cm /Im0 Do Q".encode()
+        self._write_object(content_id, f"<< /Length {len(content)} >>".encode(), content)
+        self._write_object(
+            page_id,
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_width:.4f} {page_height:.4f}] "
+            f"/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>".encode(),
+        )
+        self.page_ids.append(page_id)
+
+    def close(self):
+        """写入页面树和交叉引用表，完成后替换为正式文件"""
+        kids = ' '.join(f"{page_id} 0 R" for page_id in self.page_ids)
+        self._write_object(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(self.page_ids)} >>".encode())
+        self._write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        xref_offset = self.file.tell()
+        xref = [f"xref\n0 {self.next_id}\n", "0000000000 65535 f \n"]
+        xref += [f"{self.offsets[obj_id]:010d} 00000 n \n" for obj_id in range(1, self.next_id)]
+        xref.append(f"trailer\n<< /Size {self.next_id} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n")
+        self.file.write(''.join(xref).encode())
+        self.file.close()
+        os.replace(self.temp_path, self.pdf_path)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+
+class ImageStagingStore:
+    """下载图片的暂存区，让图片不经过 dir_rule.base_dir 直接交给流式PDF
+
+    - memory：解密后的图片字节保存在进程内存中
+    - tmpfs：写入 tmpfs_dir（如 /dev/shm 下的目录），不占用SSD的写入和fsync
+
+    暂存的图片写入PDF后仍保留到整本下载结束：全部成功时释放，有图片失败时写入各自在
+    dir_rule.base_dir 中的保存路径，重试时与磁盘上的图片一样被 download.cache 跳过。
+    暂存总量超过 max_bytes 时新图片照常写入磁盘，所以同一本中可以同时有暂存和磁盘上的图片。
+    """
+
+    MODES = ('disk', 'memory', 'tmpfs')
+
+    def __init__(self, mode='disk', max_bytes=256 * 1024 * 1024, tmpfs_dir=None):
+        if mode not in self.MODES:
+            logger.warning(f"未知的图片暂存模式 {mode}，改用 disk")
+            mode = 'disk'
+        if mode == 'tmpfs' and not tmpfs_dir:
+            logger.warning("图片暂存模式为 tmpfs 但没有配置 tmpfs_dir，改用 disk")
+            mode = 'disk'
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.tmpfs_dir = tmpfs_dir
+        self.lock = threading.Lock()
+        self.entries = {}  # 图片在磁盘上的保存路径 -> (本子ID, 字节或tmpfs路径, 大小)
+        self.albums = {}  # 本子ID -> 该本暂存中的图片路径
+        self.total_bytes = 0
+        self.staged = 0  # 暂存过的图片数
+        self.spilled = 0  # 因超出预算写入磁盘的图片数
+
+    @property
+    def enabled(self):
+        return self.mode != 'disk'
+
+    def reset(self):
+        """清理上次运行留在 tmpfs_dir 中的图片（只删除以本子ID命名的目录）"""
+        if self.mode != 'tmpfs':
+            return
+        os.makedirs(self.tmpfs_dir, exist_ok=True)
+        for name in os.listdir(self.tmpfs_dir):
+            if name.isdigit():
+                shutil.rmtree(os.path.join(self.tmpfs_dir, name), ignore_errors=True)
+
+    def put(self, album_id, path, data):
+        """暂存一张图片，超出预算时返回False，由调用方写入磁盘"""
+        size = len(data)
+        with self.lock:
+            if self.total_bytes + size > self.max_bytes:
+                self.spilled += 1
+                return False
+            self.total_bytes += size
+            self.staged += 1
+        if self.mode == 'tmpfs':
+            staged_path = os.path.join(self.tmpfs_dir, str(album_id), hashlib.sha1(path.encode()).hexdigest() + os.path.splitext(path)[1])
+            try:
+                os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+                with open(staged_path, 'wb') as f:
+                    f.write(data)
+            except OSError as e:
+                logger.warning(f"写入 tmpfs 失败，改为写入磁盘: {e}")
+                with self.lock:
+                    self.total_bytes -= size
+                    self.spilled += 1
+                return False
+            data = staged_path
+        with self.lock:
+            self.entries[path] = (album_id, data, size)
+            self.albums.setdefault(album_id, set()).add(path)
+        return True
+
+    def read(self, path):
+        """返回一张暂存图片的字节，不在暂存区时返回None。图片保留到 discard 或 persist"""
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is None:
+            return None
+        data = entry[1]
+        if self.mode == 'tmpfs':
+            with open(data, 'rb') as f:
+                data = f.read()
+        return data
+
+    def persist(self, album_id):
+        """把本子暂存的图片写入各自的保存路径后释放，返回写入的张数（下载不完整时调用）"""
+        with self.lock:
+            entries = [(path, self.entries[path][1]) for path in self.albums.get(album_id, ())]
+        persisted = 0
+        for path, data in entries:
+            # 先写临时文件，避免写了一半的图片在重试时被 download.cache 当作已下载
+            temp_path = path + '.part'
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if self.mode == 'tmpfs':
+                    shutil.copyfile(data, temp_path)
+                else:
+                    with open(temp_path, 'wb') as f:
+                        f.write(data)
+                os.replace(temp_path, path)
+                persisted += 1
+            except OSError as e:
+                logger.warning(f"暂存图片写入磁盘失败: {path} ({e})")
+                self._unlink(temp_path)
+        self.discard(album_id)
+        return persisted
+
+    def discard(self, album_id):
+        """释放本子所有的暂存图片"""
+        with self.lock:
+            paths = self.albums.pop(album_id, ())
+            entries = [self.entries.pop(path) for path in paths]
+            self.total_bytes -= sum(size for _, _, size in entries)
+        if self.mode == 'tmpfs':
+            for _, staged_path, _ in entries:
+                self._unlink(staged_path)
+            with contextlib.suppress(OSError):
+                os.rmdir(os.path.join(self.tmpfs_dir, str(album_id)))
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class AlbumPdfStream:
+    """单个本子的流式PDF：图片按下载完成顺序到达，经重排缓冲后按页码顺序写入
+
+    缓冲区只保存尚未轮到的图片路径，不保存图片数据。磁盘上已写入的图片在整本下载成功后才删除，
+    有图片下载失败时保留下来，重试时不必重新下载。在图片暂存区中的图片从暂存区读取，
+    由下载器在整本结束时释放或写入磁盘。
+    """
+
+    staging = None  # ImageStagingStore，未设置时只从磁盘读取图片
+
+    def __init__(self, album, pdf_path, delete_original_file=False):
+        self.album = album
+        self.pdf_path = pdf_path
+        self.delete_original_file = delete_original_file
+        self.lock = threading.Lock()
+        self.writer = None
+        # 章节在本子中的位置，用于确定全局页码顺序
+        self.photo_positions = {episode[0]: pos for pos, episode in enumerate(album.episode_list)}
+        self.photo_sizes = {}  # 章节位置 -> 图片数
+        self.pending = {}  # (章节位置, 图片序号) -> 图片路径
+        self.expected = (0, 1)
+        self.written = []  # 已写入PDF的磁盘图片路径
+        self.build_seconds = 0.0  # 写入PDF的累计耗时
+        self.image_dirs = set()
+
+    def add(self, image):
+        photo = image.from_photo
+        key = (self.photo_positions.get(photo.photo_id, len(self.photo_positions)), image.index)
+        with self.lock:
+            self.photo_sizes[key[0]] = len(photo)
+            self.pending[key] = image.save_path
+            self._drain()
+
+    def _drain(self):
+        while True:
+            position, index = self.expected
+            size = self.photo_sizes.get(position)
+            if size is not None and index > size:
+                self.expected = (position + 1, 1)
+                continue
+            path = self.pending.pop(self.expected, None)
+            if path is None:
+                return
+            self._write(path)
+            self.expected = (position, index + 1)
+
+    def _write(self, path):
+        started = time.perf_counter()
+        if self.writer is None:
+            self.writer = StreamingPdfWriter(self.pdf_path)
+        data = self.staging.read(path) if self.staging is not None else None
+        try:
+            self.writer.add_page(path if data is None else data)
+        except Exception as e:
+            logger.warning(f"写入PDF页面失败，已跳过: {path} ({e})")
+            return
+        finally:
+            self.build_seconds += time.perf_counter() - started
+        if data is None:
+            self.written.append(path)
+        self.image_dirs.add(os.path.dirname(path))
+
+    def finish(self):
+        """写入剩余页面（跳过下载失败的缺页）并生成PDF，没有任何页面时返回False"""
+        with self.lock:
+            for key in sorted(self.pending):
+                self._write(self.pending.pop(key))
+            if self.writer is None:
+                return False
+            if not self.writer.page_ids:
+                self.writer.abort()
+                return False
+            started = time.perf_counter()
+            self.writer.close()
+            self.build_seconds += time.perf_counter() - started
+            metrics.observe('jm_stage_duration_seconds', self.build_seconds, stage='pdf_build')
+            return True
+
+    def delete_images(self):
+        for path in self.written:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class StreamPdfPlugin(jmcomic.JmOptionPlugin):
+    """边下载边合并PDF，替代下载完成后才开始转换的 img2pdf 插件
+
+    需要同时配置在 before_album、after_image 和 after_album，kwargs 写在第一个即可。
+    """
+    plugin_key = 'stream_pdf'
+    
+    streams = weakref.WeakKeyDictionary()  # album -> AlbumPdfStream
+    streams_lock = threading.Lock()
+    
+    def invoke(self,
+               album: jmcomic.JmAlbumDetail = None,
+               image: jmcomic.JmImageDetail = None,
+               downloader=None,
+               pdf_dir=None,
+               filename_rule='Aid',
+               delete_original_file=False,
+               **kwargs):
+        if image is not None:
+            # after_image
+            self.get_stream(image.from_photo.from_album, pdf_dir, filename_rule, delete_original_file).add(image)
+            return
+        
+        if album is None:
+            logger.error('stream_pdf 必须配置在 before_album、after_image 和 after_album')
+            return
+        
+        with self.streams_lock:
+            stream = self.streams.pop(album, None)
+        if stream is None:
+            # before_album
+            self.get_stream(album, pdf_dir, filename_rule, delete_original_file)
+            return
+        
+        # after_album
+        if not stream.finish():
+            logger.error(f'没有可写入PDF的图片: {album.id}')
+            return
+        if downloader is not None and hasattr(downloader, 'record_export_filepath'):
+            downloader.record_export_filepath(album, stream.pdf_path)
+        logger.info(f'流式PDF生成完成: {stream.pdf_path} ({len(stream.writer.page_ids)} 页)')
+        if downloader is not None and downloader.has_download_failures:
+            # 保留已下载的图片，重试时 download.cache 会跳过它们，只下载缺失的图片
+            logger.info(f'{album.id} 有图片下载失败，保留已下载的 {len(stream.written)} 张图片用于重试')
+            return
+        if stream.delete_original_file:
+            stream.delete_images()
+        self.delete_original_file = stream.delete_original_file
+        self.execute_deletion(sorted(stream.image_dirs))
+    
+    def get_stream(self, album, pdf_dir, filename_rule, delete_original_file):
+        with self.streams_lock:
+            stream = self.streams.get(album)
+            if stream is None:
+                pdf_path = self.decide_filepath(album, None, filename_rule, 'pdf', pdf_dir, None)
+                stream = AlbumPdfStream(album, pdf_path, delete_original_file)
+                self.streams[album] = stream
+            return stream
+
+
+class ProcessPool:
+    """所有本子共用的进程池，用于图片解密和PDF压缩等CPU密集任务
+
+    进程池按需创建。run_bounded 供下载线程调用，同时提交的任务数不超过 max_in_flight，
+    超出时调用线程阻塞等待，从而限制内存中待处理的图片数据。
+    
+    子进程一律用 spawn 启动：进程池是在下载线程中按需创建的，fork 一个多线程进程可能继承
+    其他线程持有的锁而死锁。任务函数都在 jm_workers 中，子进程以 jm_workers 作为主模块启动，
+    不重新执行本脚本，也就不导入 discord、不创建机器人。
+    """
+
+    def __init__(self, workers=0, max_in_flight=0):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_in_flight = max_in_flight or self.workers * 2
+        self.slots = threading.BoundedSemaphore(self.max_in_flight)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.use_workers_main()
+                self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self.executor
+
+    @staticmethod
+    def use_workers_main():
+        """让 spawn 的子进程以 jm_workers 代替本脚本作为主模块
+
+        子进程按主模块的 __spec__ 决定启动时执行哪个模块；直接运行脚本时 __spec__ 为 None，
+        子进程会按文件路径以 __mp_main__ 重新执行整个 dc-jm.py。
+        本文件被其他脚本导入时（如基准测试）不修改对方的主模块。
+        """
+        if __name__ == '__main__':
+            sys.modules['__main__'].__spec__ = importlib.util.find_spec('jm_workers')
+
+    def run_bounded(self, func, *args):
+        """在进程池中执行并等待结果（阻塞，只能在线程中调用）"""
+        with self.slots:
+            return self.get_executor().submit(func, *args).result()
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+
+class AsyncFileIO:
+    """事件循环中的文件操作，在专用线程池中执行 open、getsize 等可能阻塞的系统调用
+
+    不使用 asyncio.to_thread 的默认线程池：下载本子的长时间任务也在默认线程池中，
+    占满时文件操作会排在它们后面。线程池按需创建。
+    """
+
+    def __init__(self, workers=4):
+        self.workers = max(1, workers)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='jm-io')
+            return self.executor
+
+    def submit(self, func, *args):
+        """提交后不等待结果，可以在事件循环之外调用"""
+        return self.get_executor().submit(func, *args)
+
+    async def run(self, func, *args):
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    async def getsize(self, path):
+        return await self.run(os.path.getsize, path)
+
+    async def exists(self, path):
+        return await self.run(os.path.exists, path)
+
+    async def open(self, path, mode='rb'):
+        return await self.run(open, path, mode)
+
+    async def remove(self, path):
+        await self.run(os.remove, path)
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+
+
+class PictureIndex:
+    """每个本子最近一次下载写入的图片，由下载线程在保存图片时更新
+
+    下载结束却没有生成PDF时用于给出诊断信息，不必遍历整个 picture/ 目录。只保留最近 max_albums 本。
+    """
+
+    def __init__(self, max_albums=1000):
+        self.max_albums = max_albums
+        self.albums = OrderedDict()  # 本子ID -> 图片统计
+        self.lock = threading.Lock()
+
+    def start(self, album_id):
+        """开始下载一本，清空该本上次的记录"""
+        with self.lock:
+            self.albums.pop(album_id, None)
+            self.albums[album_id] = {'disk': 0, 'staged': 0, 'cached': 0, 'bytes': 0, 'dirs': []}
+            while len(self.albums) > self.max_albums:
+                self.albums.popitem(last=False)
+
+    def record(self, album_id, path, nbytes, kind):
+        """kind 为 disk（写入磁盘）、staged（在暂存区）或 cached（磁盘上已存在）"""
+        with self.lock:
+            entry = self.albums.get(album_id)
+            if entry is None:
+                return
+            entry[kind] += 1
+            entry['bytes'] += nbytes
+            directory = os.path.dirname(path)
+            if directory not in entry['dirs']:
+                entry['dirs'].append(directory)
+
+    def describe(self, album_id):
+        """返回该本最近一次下载的诊断信息列表"""
+        with self.lock:
+            entry = self.albums.get(album_id)
+            if entry is None:
+                return ["没有该本子的下载记录（可能在获取本子信息时就失败了）"]
+            total = entry['disk'] + entry['staged'] + entry['cached']
+            if not total:
+                return ["没有下载到任何图片"]
+            info = [f"共 {total} 张图片（新写入磁盘 {entry['disk']} 张，暂存 {entry['staged']} 张，"
+                    f"已存在 {entry['cached']} 张），{entry['bytes'] // 1024}KB"]
+            info.append(f"图片目录: {entry['dirs'][:3]}")
+            return info
+
+
+class PooledSessionPostman(AbstractPostman):
+    """多线程共用的 curl_cffi 会话池
+
+    curl_cffi 的 Session 在每个线程各建一个 curl 句柄，而 jmcomic 的下载线程用完即弃，
+    连接也随之丢失。这里改为最多 pool_size 个长期会话，请求时借出一个、用完归还，
+    所有本子的所有下载线程共用会话里的 keep-alive 连接。
+    """
+    postman_key = 'jm_pooled_session'
+
+    def __init__(self, kwargs, pool_size=32, idle_timeout=60):
+        super().__init__(kwargs)
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.idle = deque()  # 后进先出，最近用过的会话连接最可能还活着
+        self.created = 0
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def new_session(self):
+        from curl_cffi import CurlOpt, requests
+        # 空闲超过 idle_timeout 秒的连接不再复用
+        return requests.Session(use_thread_local_curl=False, curl_options={CurlOpt.MAXAGE_CONN: self.idle_timeout})
+
+    def acquire(self):
+        with self.condition:
+            while not self.idle and self.created >= self.pool_size:
+                self.condition.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.created += 1
+        try:
+            return self.new_session()
+        except BaseException:
+            with self.condition:
+                self.created -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, session):
+        with self.condition:
+            if not self.closed:
+                self.idle.append(session)
+                self.condition.notify()
+                return
+            self.created -= 1
+        session.close()
+
+    def request(self, method, url, **kwargs):
+        kwargs = self.before_request(kwargs)
+        session = self.acquire()
+        try:
+            return getattr(session, method)(url, **kwargs)
+        finally:
+            self.release(session)
+
+    def get(self, url, **kwargs):
+        return self.request('get', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('post', url, **kwargs)
+
+    def close(self):
+        """关闭空闲会话，借出中的会话归还时关闭"""
+        with self.condition:
+            self.closed = True
+            sessions, self.idle = list(self.idle), deque()
+            self.created -= len(sessions)
+        for session in sessions:
+            session.close()
+
+
+class AlbumManifestStore:
+    """每个本子的下载清单
+
+    下载结束后有图片或章节失败时，记录成功数和失败的图片，已下载的图片保留在磁盘上；
+    之后重试（自动重试或 /jm_retry）时 jmcomic 的 download.cache 会跳过已存在的图片，
+    只下载缺失的部分并重新生成PDF。全部成功后删除清单。
+    """
+
+    DIRNAME = '.manifests'
+
+    def __init__(self, pdf_dir):
+        self.dir = os.path.join(pdf_dir, self.DIRNAME)
+
+    def path_of(self, album_id):
+        return os.path.join(self.dir, f"{album_id}.json")
+
+    def load(self, album_id):
+        try:
+            with open(self.path_of(album_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"下载清单读取失败 {album_id}: {e}")
+            return None
+
+    def pending(self):
+        """有未完成清单的本子ID"""
+        if not os.path.isdir(self.dir):
+            return []
+        return [name[:-len('.json')] for name in os.listdir(self.dir) if name.endswith('.json')]
+
+    def record(self, album, downloader):
+        """按下载器的结果写入或删除清单"""
+        if not downloader.has_download_failures:
+            self.discard(album.album_id)
+            return
+        manifest = {
+            'album_id': album.album_id,
+            'page_count': album.page_count,
+            'succeeded': sum(len(images) for images in downloader.download_success_dict.get(album, {}).values()),
+            'failed_images': [
+                {'photo_id': image.from_photo.photo_id, 'index': image.index, 'path': image.save_path, 'error': str(e)}
+                for image, e in downloader.download_failed_image
+            ],
+            'failed_photos': [
+                {'photo_id': photo.photo_id, 'error': str(e)}
+                for photo, e in downloader.download_failed_photo
+            ],
+            'updated_at': time.time(),
+        }
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            temp_path = self.path_of(album.album_id) + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            os.replace(temp_path, self.path_of(album.album_id))
+        except OSError as e:
+            logger.error(f"保存下载清单失败 {album.album_id}: {e}")
+
+    def prepare_resume(self, album_id):
+        """继续下载前删除上次失败时可能残留的图片文件，返回上次缺失的图片数和章节数"""
+        manifest = self.load(album_id)
+        if manifest is None:
+            return None
+        for image in manifest['failed_images']:
+            try:
+                os.remove(image['path'])
+            except OSError:
+                pass
+        return len(manifest['failed_images']), len(manifest['failed_photos'])
+
+    def discard(self, album_id):
+        try:
+            os.remove(self.path_of(album_id))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"删除下载清单失败 {album_id}: {e}")
+
+
+class AlbumTooLongError(Exception):
+    """本子页数超过下载档案的限制"""
+
+
+class JmBotDownloader(jmcomic.JmDownloader):
+    """机器人使用的下载器
+
+    - 使用配置档案共享的长期客户端，不再每个本子新建客户端和HTTP会话
+    - 下载线程只负责获取图片数据，解密交给共享进程池。jmcomic 默认在下载线程中解密，
+      解密受GIL限制，一个大本子就会占满一个核心并拖慢网络线程
+    - 获取到的本子详情和不存在的ID记入元数据缓存；页数超过档案限制时直接中止下载
+      （插件抛出的异常会被 jmcomic 吞掉，SkipTooLongBook 本身拦不住下载）
+    - 下载结束后把失败的图片写入下载清单，下次下载同一本时只补下缺失的图片
+    - option.progress 为 DownloadProgress 时，每完成一张图片、一个章节更新进度计数
+    - 启用图片暂存时，解密后的图片放入暂存区由流式PDF直接读取，超出暂存预算才写入磁盘
+    - 每保存一张图片记入图片索引，下载失败时据此给出诊断信息
+    """
+
+    pool = None  # ProcessPool，未设置时使用 jmcomic 默认的线程内解密
+    staging = None  # ImageStagingStore，未设置或为 disk 模式时图片都写入磁盘
+    pictures = None  # PictureIndex，未设置时不记录
+    album_meta = None  # AlbumMetaCache，未设置时不记录元数据
+    manifests = None  # AlbumManifestStore，未设置时不记录下载清单
+
+    def create_client(self):
+        shared_client = getattr(self.option, 'shared_client', None)
+        return shared_client() if shared_client is not None else super().create_client()
+
+    def download_album(self, album_id):
+        if self.manifests is not None:
+            missing = self.manifests.prepare_resume(jmcomic.JmcomicText.parse_to_jm_id(album_id))
+            if missing is not None:
+                logger.info(f"继续下载 {album_id}: 上次缺少 {missing[0]} 张图片、{missing[1]} 个章节，已下载的图片不再重新下载")
+        self.album_started_at = time.perf_counter()
+        complete = False
+        try:
+            album = super().download_album(album_id)
+            complete = not self.has_download_failures
+        except MissingAlbumPhotoException as e:
+            # 只记录本子本身不存在，章节缺失不算
+            if self.album_meta is not None and e.error_jmid == jmcomic.JmcomicText.parse_to_jm_id(album_id):
+                self.album_meta.record_missing(e.error_jmid)
+            raise
+        finally:
+            if self.staging is not None:
+                jm_id = jmcomic.JmcomicText.parse_to_jm_id(album_id)
+                if complete:
+                    self.staging.discard(jm_id)
+                else:
+                    # 下载不完整时把暂存的图片写入磁盘，重试时只下载缺失的部分
+                    persisted = self.staging.persist(jm_id)
+                    if persisted:
+                        logger.info(f"{album_id} 下载不完整，已将 {persisted} 张暂存图片写入磁盘用于重试")
+        for image, _ in self.download_failed_image:
+            metrics.inc('jm_image_failures_total', domain=urlsplit(image.download_url).hostname)
+        if self.manifests is not None:
+            self.manifests.record(album, self)
+        return album
+
+    def before_album(self, album: jmcomic.JmAlbumDetail):
+        started = getattr(self, 'album_started_at', None)
+        if started is not None:
+            metrics.observe('jm_stage_duration_seconds', time.perf_counter() - started, stage='metadata_fetch')
+        if self.album_meta is not None:
+            self.album_meta.record(album)
+        max_pages = getattr(self.option, 'max_pages', None)
+        if max_pages is not None and album.page_count > max_pages:
+            logger.warning(f'超过页数限制({max_pages}页)，已阻止下载 - 漫画ID: {album.album_id}')
+            raise AlbumTooLongError(f"漫画页数({album.page_count}页)超过限制({max_pages}页)")
+        progress = getattr(self.option, 'progress', None)
+        if progress is not None:
+            progress.start(album)
+        if self.pictures is not None:
+            self.pictures.start(album.album_id)
+        super().before_album(album)
+
+    def after_photo(self, photo: jmcomic.JmPhotoDetail):
+        progress = getattr(self.option, 'progress', None)
+        if progress is not None:
+            progress.add_chapter()
+        super().after_photo(photo)
+
+    @catch_exception
+    @record_download_duration('image_started_at')
+    def download_by_image_detail(self, image: jmcomic.JmImageDetail):
+        img_save_path = self.option.decide_image_filepath(image)
+        image.save_path = img_save_path
+        image.exists = os.path.exists(img_save_path)
+        image.cache = self.option.decide_download_cache(image)
+
+        self.before_image(image, img_save_path)
+        if image.skip:
+            return
+
+        progress = getattr(self.option, 'progress', None)
+        if image.cache and image.exists:
+            self.record_picture(image, img_save_path, 0, 'cached')
+            self.after_image(image, img_save_path)
+            if progress is not None:
+                progress.add_image(0)
+            return
+
+        decode_image = self.option.decide_download_image_decode(image)
+        kind = 'disk'
+        if self.staging is not None and self.staging.enabled:
+            nbytes, kind = self.save_to_staging(image, img_save_path, decode_image)
+        elif self.pool is None:
+            # 线程内解密，下载和解密的耗时合在一起
+            with metrics.timer('jm_stage_duration_seconds', stage='image_download'):
+                self.client.download_by_image_detail(image, img_save_path, decode_image=decode_image)
+            nbytes = os.path.getsize(img_save_path)
+            metrics.inc('jm_downloaded_bytes_total', nbytes)
+        else:
+            nbytes = self.save_with_pool(image, img_save_path, decode_image)
+
+        self.record_picture(image, img_save_path, nbytes, kind)
+        self.after_image(image, img_save_path)
+        if progress is not None:
+            progress.add_image(nbytes)
+
+    def fetch_image(self, image, img_save_path, decode_image):
+        """下载图片数据，返回 (响应, 分割数)。不需要解密也不需要转换格式时分割数为None"""
+        with metrics.timer('jm_stage_duration_seconds', stage='image_download'):
+            resp = self.client.get_jm_image(image.download_url)
+            resp.require_success()
+        metrics.inc('jm_downloaded_bytes_total', len(resp.content))
+
+        # 与 JmImageResp.transfer_to 的处理保持一致
+        img_url = image.download_url.split('?')[0]
+        num = 0
+        if decode_image and image.scramble_id is not None:
+            num = jmcomic.JmImageTool.get_num_by_url(int(image.scramble_id), img_url)
+        same_format = os.path.splitext(img_url)[1].lower() == os.path.splitext(img_save_path)[1].lower()
+        return resp, (None if num == 0 and same_format else num)
+
+    def save_with_pool(self, image, img_save_path, decode_image):
+        resp, num = self.fetch_image(image, img_save_path, decode_image)
+        if num is None:
+            jmcomic.JmImageTool.save_directly(resp, img_save_path)
+        else:
+            with metrics.timer('jm_stage_duration_seconds', stage='decode'):
+                self.pool.run_bounded(decode_jm_image, resp.content, num, img_save_path)
+        return len(resp.content)
+
+    def record_picture(self, image, img_save_path, nbytes, kind):
+        if self.pictures is not None:
+            self.pictures.record(image.from_photo.from_album.album_id, img_save_path, nbytes, kind)
+
+    def save_to_staging(self, image, img_save_path, decode_image):
+        """返回 (下载的字节数, 'staged' 或超出暂存预算时的 'disk')"""
+        resp, num = self.fetch_image(image, img_save_path, decode_image)
+        data = resp.content
+        if num is not None:
+            suffix = os.path.splitext(img_save_path)[1]
+            with metrics.timer('jm_stage_duration_seconds', stage='decode'):
+                if self.pool is None:
+                    data = encode_jm_image(data, num, suffix)
+                else:
+                    data = self.pool.run_bounded(encode_jm_image, data, num, suffix)
+        if self.staging.put(image.from_photo.from_album.album_id, img_save_path, data):
+            return len(resp.content), 'staged'
+        with open(img_save_path, 'wb') as f:
+            f.write(data)
+        return len(resp.content), 'disk'
+
+
+class QueueFullError(Exception):
+    """下载队列已满"""
+
+
+class DownloadTicket:
+    """调度器中的一个任务，记录排队与运行状态"""
+
+    def __init__(self, comic_id, priority, user_id, guild_id, on_position):
+        self.comic_id = comic_id
+        self.priority = priority
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.on_position = on_position
+        self.position = None  # 排队位置，从1开始；None表示未排过队
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.started = asyncio.get_running_loop().create_future()
+
+
+class DownloadScheduler:
+    """全局下载调度器
+
+    - 同时下载的本子数不超过 max_concurrent，另外预留 reserved_fast_slots 个名额给缓存发送
+    - 等待队列有上限，超出时抛出 QueueFullError
+    - 不同优先级严格按优先级出队，同一优先级内按服务器、再按用户轮转，避免单个用户占满队列
+    """
+
+    PRIORITY_CACHED = 0  # 缓存命中，直接发送文件
+    PRIORITY_NORMAL = 1  # 普通下载 (/jm, /jmr)
+    PRIORITY_HEAVY = 2   # 强制/重试下载
+
+    def __init__(self, max_concurrent: int = 2, max_queue: int = 20, reserved_fast_slots: int = 1):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.reserved_fast_slots = max(0, reserved_fast_slots)
+        self.running = []
+        # priority -> OrderedDict[guild_id -> OrderedDict[user_id -> deque[DownloadTicket]]]
+        self.queues = {}
+        self.queued_count = 0
+        self.last_busy = time.monotonic()
+        self._notify_tasks = set()
+
+    @property
+    def idle_for(self):
+        """调度器已经空闲的秒数，有任务时为0"""
+        if self.running or self.queued_count:
+            return 0
+        return time.monotonic() - self.last_busy
+
+    @property
+    def active_ids(self):
+        """正在下载或排队中的漫画ID"""
+        ids = {t.comic_id for t in self.running}
+        ids.update(t.comic_id for t in self._ordered_waiting())
+        return ids
+
+    async def acquire(self, comic_id, priority=PRIORITY_NORMAL, user_id=None, guild_id=None, on_position=None):
+        """申请一个下载名额，必要时排队等待。返回的 ticket 用完后必须调用 release"""
+        ticket = DownloadTicket(comic_id, priority, user_id, guild_id, on_position)
+        self.last_busy = time.monotonic()
+        self._enqueue(ticket)
+        self._dispatch()
+        if not ticket.started.done() and self.queued_count > self.max_queue:
+            self._remove(ticket)
+            raise QueueFullError(f"下载队列已满({self.max_queue})，请稍后再试")
+        self._publish_positions()
+        try:
+            await ticket.started
+        except asyncio.CancelledError:
+            self.release(ticket)
+            raise
+        return ticket
+
+    def release(self, ticket):
+        """归还名额并调度下一个任务"""
+        self.last_busy = time.monotonic()
+        if ticket in self.running:
+            self.running.remove(ticket)
+        else:
+            self._remove(ticket)
+        self._dispatch()
+        self._publish_positions()
+
+    def _capacity(self, priority):
+        if priority == self.PRIORITY_CACHED:
+            return len(self.running) < self.max_concurrent + self.reserved_fast_slots
+        downloads = sum(1 for t in self.running if t.priority != self.PRIORITY_CACHED)
+        return downloads < self.max_concurrent
+
+    def _enqueue(self, ticket):
+        guilds = self.queues.setdefault(ticket.priority, OrderedDict())
+        users = guilds.setdefault(ticket.guild_id, OrderedDict())
+        users.setdefault(ticket.user_id, deque()).append(ticket)
+        self.queued_count += 1
+
+    def _remove(self, ticket):
+        guilds = self.queues.get(ticket.priority, {})
+        users = guilds.get(ticket.guild_id, {})
+        queue = users.get(ticket.user_id)
+        if not queue or ticket not in queue:
+            return
+        queue.remove(ticket)
+        self.queued_count -= 1
+        if not queue:
+            del users[ticket.user_id]
+        if not users:
+            del guilds[ticket.guild_id]
+
+    @staticmethod
+    def _take(guilds):
+        """按服务器、用户轮转取出下一个任务"""
+        guild_id, users = next(iter(guilds.items()))
+        user_id, queue = next(iter(users.items()))
+        ticket = queue.popleft()
+        if queue:
+            users.move_to_end(user_id)
+        else:
+            del users[user_id]
+        if users:
+            guilds.move_to_end(guild_id)
+        else:
+            del guilds[guild_id]
+        return ticket
+
+    def _dispatch(self):
+        for priority in sorted(self.queues):
+            guilds = self.queues[priority]
+            while guilds:
+                if not self._capacity(priority):
+                    return
+                ticket = self._take(guilds)
+                self.queued_count -= 1
+                ticket.started_at = time.monotonic()
+                self.running.append(ticket)
+                if not ticket.started.done():
+                    ticket.started.set_result(True)
+
+    def _ordered_waiting(self):
+        """按实际出队顺序列出排队中的任务"""
+        order = []
+        for priority in sorted(self.queues):
+            guilds = OrderedDict(
+                (guild_id, OrderedDict((user_id, deque(queue)) for user_id, queue in users.items()))
+                for guild_id, users in self.queues[priority].items()
+            )
+            while guilds:
+                order.append(self._take(guilds))
+        return order
+
+    def _publish_positions(self):
+        """排队位置变化时通知对应任务"""
+        for index, ticket in enumerate(self._ordered_waiting(), 1):
+            if ticket.position == index:
+                continue
+            ticket.position = index
+            if ticket.on_position is None:
+                continue
+            task = asyncio.get_running_loop().create_task(self._notify(ticket, index))
+            self._notify_tasks.add(task)
+            task.add_done_callback(self._notify_tasks.discard)
+
+    @staticmethod
+    async def _notify(ticket, position):
+        try:
+            await ticket.on_position(position)
+        except Exception as e:
+            logger.warning(f"更新排队位置失败 {ticket.comic_id}: {e}")
+
+
+class SingleFlight:
+    """合并同一漫画ID的并发请求：同一时间只执行一次下载，其余请求等待同一个结果"""
+
+    def __init__(self):
+        self.inflight = {}  # key -> (future, 发起者的tag, 等待者数量)
+
+    def __contains__(self, key):
+        return key in self.inflight
+
+    def waiters(self, key):
+        """正在等待该任务结果的请求数（不含发起者）"""
+        entry = self.inflight.get(key)
+        return entry[2] if entry else 0
+
+    async def run(self, key, func, tag=None, accept=None):
+        """执行 func() 并返回结果；若相同 key 已在执行则等待其结果。
+
+        accept(result, leader_tag) 返回 False 时（例如不同下载模式的任务失败了），
+        等待者会在其结束后自己重新执行一次。
+        """
+        while key in self.inflight:
+            future, leader_tag, waiters = self.inflight[key]
+            self.inflight[key] = (future, leader_tag, waiters + 1)
+            result = await asyncio.shield(future)
+            if leader_tag == tag or accept is None or accept(result, leader_tag):
+                return result
+
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = (future, tag, 0)
+        try:
+            result = await func()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self.inflight[key]
+            if not future.done():
+                # 发起者被取消，等待者不能一直挂起
+                future.set_exception(RuntimeError("下载任务已被取消"))
+            # 没有等待者时避免 "Future exception was never retrieved" 警告
+            future.exception()
+
+
+class PipelineStage:
+    """下载流水线中的一个阶段：最多 workers 个任务同时执行，最多 max_queue 个任务等待"""
+
+    def __init__(self, name, workers, max_queue):
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.semaphore = asyncio.Semaphore(self.workers)
+        self.active = 0
+        self.waiting = 0
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """占用一个执行名额，没有空闲名额且队列已满时抛出 QueueFullError"""
+        if self.active >= self.workers and self.waiting >= self.max_queue:
+            raise QueueFullError(f"{self.name} 阶段队列已满（{self.waiting}/{self.max_queue}），请稍后再试")
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self.semaphore.release()
+
+
+class DownloadProgress:
+    """一次下载的进度计数，由下载线程更新，StatusUpdater 在事件循环中定期读取"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = None
+        self.total_pages = 0
+        self.pages = 0
+        self.total_chapters = 0
+        self.chapters = 0
+        self.bytes = 0
+
+    def start(self, album):
+        # 自动重试会再次进入 before_album，已有的图片会重新计数，这里从头统计
+        with self.lock:
+            self.started_at = time.monotonic()
+            self.total_pages = album.page_count
+            self.total_chapters = len(album)
+            self.pages = self.chapters = self.bytes = 0
+
+    def add_image(self, nbytes):
+        with self.lock:
+            self.pages += 1
+            self.bytes += nbytes
+
+    def add_chapter(self):
+        with self.lock:
+            self.chapters += 1
+
+    def snapshot(self):
+        with self.lock:
+            if self.started_at is None:
+                return None
+            return {
+                'elapsed': time.monotonic() - self.started_at,
+                'total_pages': self.total_pages,
+                'pages': self.pages,
+                'total_chapters': self.total_chapters,
+                'chapters': self.chapters,
+                'bytes': self.bytes,
+            }
+
+
+class StatusWatch:
+    """一条正在更新的状态消息"""
+
+    def __init__(self, message, comic_id, start_embed):
+        self.message = message
+        self.comic_id = comic_id
+        self.start_embed = start_embed
+        self.position = None  # 排队位置，None表示没有在排队
+        self.shown = ('start',)  # 当前显示的内容，没有变化时不编辑
+        self.last_edit = 0
+        self.task = None  # 进行中的编辑
+
+
+class StatusUpdater:
+    """合并下载状态消息的编辑
+
+    下载线程只更新 DownloadProgress 的计数，这里每秒检查一次所有关注中的状态消息，
+    内容有变化且距该消息上次编辑超过 interval 秒时才编辑。所有消息共用一个每秒
+    edits_per_second 次的令牌桶，任务很多时本轮编不完的消息留到下一轮合并更新，
+    不会积压编辑请求，也不会超出Discord的速率限制。
+    """
+
+    def __init__(self, enabled=True, interval=3, edits_per_second=5):
+        self.enabled = enabled  # 关闭时只显示排队位置
+        self.interval = interval
+        self.rate = edits_per_second
+        self.tokens = edits_per_second
+        self.refilled_at = time.monotonic()
+        self.watches = {}  # id(消息) -> StatusWatch
+        self.progress = {}  # 漫画ID -> DownloadProgress
+        self.task = None
+        self.edits = 0
+        self.skipped = 0  # 因令牌不足推迟的编辑次数
+
+    def track(self, comic_id):
+        """开始统计一次下载的进度，返回交给下载线程的 DownloadProgress"""
+        progress = self.progress[comic_id] = DownloadProgress()
+        return progress
+
+    def untrack(self, comic_id):
+        self.progress.pop(comic_id, None)
+
+    def watch(self, message, comic_id, start_embed):
+        self.watches[id(message)] = StatusWatch(message, comic_id, start_embed)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def set_queue_position(self, message, position):
+        watch = self.watches.get(id(message))
+        if watch is not None:
+            watch.position = position
+
+    async def unwatch(self, message):
+        """停止更新，等进行中的编辑结束，之后调用方可以放心写入最终结果"""
+        watch = self.watches.pop(id(message), None)
+        if watch is not None and watch.task is not None:
+            await asyncio.gather(watch.task, return_exceptions=True)
+
+    async def run(self):
+        while self.watches:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.refilled_at) * self.rate)
+            self.refilled_at = now
+            # 最久没更新的消息优先
+            for watch in sorted(self.watches.values(), key=lambda w: w.last_edit):
+                if watch.task is not None and not watch.task.done():
+                    continue
+                if now - watch.last_edit < self.interval:
+                    continue
+                shown, embed = self.render(watch)
+                if shown == watch.shown:
+                    continue
+                if self.tokens < 1:
+                    self.skipped += 1
+                    continue
+                self.tokens -= 1
+                self.edits += 1
+                watch.shown = shown
+                watch.last_edit = now
+                watch.task = asyncio.create_task(self.edit(watch.message, embed))
+
+    @staticmethod
+    async def edit(message, embed):
+        try:
+            await message.edit(embed=embed)
+        except discord.HTTPException as e:
+            logger.debug(f"更新状态消息失败: {e}")
+
+    def render(self, watch):
+        """返回 (用于判断是否变化的键, embed)"""
+        if watch.position is not None:
+            return ('queue', watch.position), discord.Embed(
+                title="⏳ 排队中",
+                description=f"{watch.comic_id} 已加入下载队列，当前排在第 {watch.position} 位",
+                color=discord.Color.orange()
+            )
+        progress = self.progress.get(watch.comic_id) if self.enabled else None
+        snapshot = progress.snapshot() if progress is not None else None
+        if snapshot is None:
+            return ('start',), watch.start_embed
+        
+        pages, total = snapshot['pages'], max(snapshot['total_pages'], snapshot['pages'])
+        elapsed = max(snapshot['elapsed'], 0.001)
+        speed = snapshot['bytes'] / elapsed
+        lines = [f"页数: {pages}/{total}" + (f" ({pages * 100 // total}%)" if total else "")]
+        if snapshot['total_chapters'] > 1:
+            lines.append(f"章节: {snapshot['chapters']}/{snapshot['total_chapters']}")
+        lines.append(f"已下载: {snapshot['bytes'] / 1024 / 1024:.1f}MB，速度 {speed / 1024 / 1024:.2f}MB/s")
+        if 0 < pages < total:
+            remaining = int((total - pages) * elapsed / pages)
+            lines.append(f"预计剩余: {remaining // 60}分{remaining % 60}秒" if remaining >= 60 else f"预计剩余: {remaining}秒")
+        return ('progress', pages, snapshot['chapters'], snapshot['bytes']), discord.Embed(
+            title="📥 下载中",
+            description=f"{watch.comic_id}\n" + "\n".join(lines),
+            color=discord.Color.blue()
+        )
+
+
+class PdfCacheIndex:
+    """pdf/ 目录的缓存索引
+
+    记录每个PDF的大小、最后访问时间、命中次数以及是否完整。索引在启动时加载一次，
+    之后的缓存查询只查内存；总大小超过预算时按最近最少使用淘汰，命中次数越多越晚被淘汰。
+    """
+
+    INDEX_FILENAME = '.cache_index.json'
+
+    def __init__(self, pdf_dir, file_io, max_bytes=0, frequency_bonus=3600):
+        self.pdf_dir = pdf_dir
+        self.file_io = file_io  # AsyncFileIO，事件循环中的文件操作都经由它执行
+        self.index_path = os.path.join(pdf_dir, self.INDEX_FILENAME)
+        self.max_bytes = max_bytes  # 0 表示不限制
+        self.frequency_bonus = frequency_bonus  # 命中次数每翻一倍，相当于晚访问这么多秒
+        self.entries = {}  # comic_id -> {size, last_access, hits, complete}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.save_lock = asyncio.Lock()  # 保证先复制的索引先写入
+
+    def path_of(self, comic_id):
+        return os.path.join(self.pdf_dir, f"{comic_id}.pdf")
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def load(self):
+        """读取索引文件，并与 pdf/ 目录中的实际文件对齐"""
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            saved = {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"PDF缓存索引读取失败，将重新建立: {e}")
+            saved = {}
+        
+        self.entries = {}
+        if os.path.isdir(self.pdf_dir):
+            for item in os.scandir(self.pdf_dir):
+                if not item.is_file() or not item.name.endswith('.pdf'):
+                    continue
+                comic_id = item.name[:-len('.pdf')]
+                stat = item.stat()
+                entry = saved.get(comic_id) or {}
+                self.entries[comic_id] = {
+                    'size': stat.st_size,
+                    'last_access': entry.get('last_access', stat.st_mtime),
+                    'hits': entry.get('hits', 0),
+                    # 索引建立前已有的文件视为完整
+                    'complete': entry.get('complete', True),
+                }
+                if entry.get('size') == stat.st_size and 'sha256' in entry:
+                    self.entries[comic_id]['sha256'] = entry['sha256']
+        self.total_bytes = sum(entry['size'] for entry in self.entries.values())
+        self.dirty = True
+        logger.info(f"PDF缓存索引已加载: {len(self.entries)} 个文件，共 {self.total_bytes / 1024 / 1024:.1f}MB")
+        self.evict()
+        self.save()
+
+    def save(self):
+        """索引有变化时原子写入磁盘（阻塞，只在启动和退出时使用）"""
+        data = self.snapshot()
+        if data is not None:
+            self.write(data)
+
+    async def save_async(self):
+        """在事件循环中保存：先复制索引，再在文件线程池中写入"""
+        async with self.save_lock:
+            data = self.snapshot()
+            if data is not None:
+                await self.file_io.run(self.write, data)
+
+    def snapshot(self):
+        """索引有变化时返回一份副本并清除变化标记，没有变化时返回None"""
+        if not self.dirty:
+            return None
+        self.dirty = False
+        return {comic_id: dict(entry) for comic_id, entry in self.entries.items()}
+
+    def write(self, data):
+        try:
+            os.makedirs(self.pdf_dir, exist_ok=True)
+            temp_path = self.index_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            self.dirty = True
+            logger.error(f"保存PDF缓存索引失败: {e}")
+
+    def lookup(self, comic_id):
+        """查询完整的缓存PDF，命中时返回路径，不完整或不存在返回None"""
+        entry = self.entries.get(comic_id)
+        if entry is None or not entry['complete']:
+            self.misses += 1
+            return None
+        entry['hits'] += 1
+        entry['last_access'] = time.time()
+        self.hits += 1
+        self.dirty = True
+        return self.path_of(comic_id)
+
+    async def digest(self, comic_id):
+        """返回缓存文件的sha256，首次计算后记入索引"""
+        entry = self.entries.get(comic_id)
+        if entry is None:
+            return None
+        if 'sha256' not in entry:
+            entry['sha256'] = await self.file_io.run(file_sha256, self.path_of(comic_id))
+            self.dirty = True
+        return entry['sha256']
+
+    async def add(self, comic_id, complete=True):
+        """登记新生成的PDF，必要时淘汰其他文件"""
+        try:
+            size = await self.file_io.getsize(self.path_of(comic_id))
+        except OSError:
+            return
+        old = self.entries.get(comic_id)
+        if old is not None:
+            self.total_bytes -= old['size']
+        self.entries[comic_id] = {
+            'size': size,
+            'last_access': time.time(),
+            'hits': old['hits'] if old else 0,
+            'complete': complete,
+        }
+        self.total_bytes += size
+        self.dirty = True
+        self.evict(keep=comic_id)
+        await self.save_async()
+
+    def mark_incomplete(self, comic_id):
+        entry = self.entries.get(comic_id)
+        if entry is not None and entry['complete']:
+            entry['complete'] = False
+            self.dirty = True
+
+    def remove(self, comic_id, delete_file=False):
+        entry = self.entries.pop(comic_id, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry['size']
+        self.dirty = True
+        if delete_file:
+            # 在文件线程池中删除，不等待结果
+            self.file_io.submit(self.delete_file, comic_id, self.path_of(comic_id))
+
+    @staticmethod
+    def delete_file(comic_id, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"删除缓存文件失败 {comic_id}: {e}")
+
+    def _score(self, comic_id):
+        entry = self.entries[comic_id]
+        return entry['last_access'] + math.log2(1 + entry['hits']) * self.frequency_bonus
+
+    def evict(self, keep=None):
+        """淘汰分数最低的文件直到总大小不超过预算"""
+        if self.max_bytes <= 0 or self.total_bytes <= self.max_bytes:
+            return
+        for comic_id in sorted((cid for cid in self.entries if cid != keep), key=self._score):
+            if self.total_bytes <= self.max_bytes:
+                break
+            logger.info(f"PDF缓存超出预算，淘汰 {comic_id}")
+            self.remove(comic_id, delete_file=True)
+
+
+class UploadRefCache:
+    """记录已上传到Discord的PDF附件，按漫画ID和文件哈希索引
+
+    重复请求时直接发送附件链接，不再重新上传文件内容。
+    """
+
+    INDEX_FILENAME = '.upload_refs.json'
+    EXPIRY_MARGIN = 10 * 60  # 附件链接剩余有效期不足时先刷新
+
+    def __init__(self, pdf_dir, file_io):
+        self.index_path = os.path.join(pdf_dir, self.INDEX_FILENAME)
+        self.file_io = file_io
+        self.refs = {}  # comic_id -> {sha256, filename, channel_id, message_ids, urls, uploaded_at}
+        self.reused = 0
+        self._locks = weakref.WeakValueDictionary()
+        self.save_lock = asyncio.Lock()
+
+    def load(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.refs = json.load(f)
+        except FileNotFoundError:
+            self.refs = {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"上传记录读取失败: {e}")
+            self.refs = {}
+
+    async def save(self):
+        """复制记录后在文件线程池中写入"""
+        async with self.save_lock:
+            data = {comic_id: dict(ref) for comic_id, ref in self.refs.items()}
+            await self.file_io.run(self.write, data)
+
+    def write(self, data):
+        try:
+            temp_path = self.index_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            logger.error(f"保存上传记录失败: {e}")
+
+    def lock(self, comic_id):
+        """同一漫画的发送串行执行，后到的请求可以复用前一个请求的上传结果"""
+        lock = self._locks.get(comic_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[comic_id] = lock
+        return lock
+
+    def get(self, comic_id, sha256):
+        ref = self.refs.get(comic_id)
+        if ref is None or sha256 is None or ref['sha256'] != sha256:
+            return None
+        return ref
+
+    async def record(self, comic_id, sha256, filename, messages):
+        # 发送失败的分片没有消息对象
+        messages = [message for message in messages if message]
+        urls = [attachment.url for message in messages for attachment in message.attachments]
+        if sha256 is None or not urls:
+            return
+        first = messages[0]
+        self.refs[comic_id] = {
+            'sha256': sha256,
+            'filename': filename,
+            'channel_id': first.channel.id,
+            'message_ids': [message.id for message in messages],
+            'urls': urls,
+            'uploaded_at': time.time(),
+        }
+        await self.save()
+
+    async def discard(self, comic_id):
+        if self.refs.pop(comic_id, None) is not None:
+            await self.save()
+
+    @staticmethod
+    def url_expires_at(url):
+        """Discord附件链接的过期时间（查询参数ex，十六进制时间戳），没有则返回None"""
+        ex = parse_qs(urlsplit(url).query).get('ex')
+        try:
+            return int(ex[0], 16) if ex else None
+        except ValueError:
+            return None
+
+    def needs_refresh(self, ref):
+        deadline = time.time() + self.EXPIRY_MARGIN
+        return any(
+            expires_at is not None and expires_at < deadline
+            for expires_at in map(self.url_expires_at, ref['urls'])
+        )
+
+
+class UploadLimitCache:
+    """按服务器缓存Discord上传大小限制
+
+    优先使用交互里Discord给出的限制（已包含服务器加成），
+    实际上传仍返回413时记住一个更小的值，之后按它分片。
+    """
+
+    # 已知的上传限制档位，收到413时退到比被拒大小更小的一档
+    KNOWN_LIMITS = (
+        8 * 1024 * 1024,
+        discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES,
+        50 * 1024 * 1024,
+        100 * 1024 * 1024,
+    )
+    MIN_LIMIT = 1024 * 1024
+
+    def __init__(self):
+        self.reported = {}  # guild_id（私信为None）-> Discord给出的限制
+        self.learned = {}   # guild_id -> 收到413后学到的上限
+
+    def get(self, interaction):
+        key = interaction.guild_id
+        limit = getattr(interaction, 'filesize_limit', None)
+        if not limit and interaction.guild is not None:
+            limit = interaction.guild.filesize_limit
+        if limit:
+            if self.reported.get(key) != limit:
+                # 服务器加成等级变化后之前学到的值不再可信
+                self.reported[key] = limit
+                self.learned.pop(key, None)
+        else:
+            limit = self.reported.get(key, discord.utils.DEFAULT_FILE_SIZE_LIMIT_BYTES)
+        learned = self.learned.get(key)
+        return min(limit, learned) if learned else limit
+
+    def is_learned(self, interaction):
+        return interaction.guild_id in self.learned
+
+    def learn(self, interaction, rejected_size):
+        """记录一次413，返回之后使用的上传限制"""
+        lower = [limit for limit in self.KNOWN_LIMITS if limit < rejected_size]
+        limit = max(lower) if lower else max(rejected_size // 2, self.MIN_LIMIT)
+        key = interaction.guild_id
+        if key in self.learned:
+            limit = min(limit, self.learned[key])
+        self.learned[key] = limit
+        logger.warning(f"上传 {rejected_size//1024}KB 被拒绝(413)，服务器 {key} 的上传限制调整为 {limit//1024}KB")
+        return limit
+
+
+class UploadScheduler:
+    """所有附件上传的调度器
+
+    通过 aiohttp 的 trace 读取Discord响应中的速率限制头，按路由（每个交互的followup
+    webhook）记录剩余次数和重置时间，收到429时按 Retry-After 暂停该路由，全局限制时暂停所有上传。
+    在限额以内最多同时进行 max_parallel 个上传；等待中的上传按优先级出队，单个文件排在分片任务前面。
+    discord.py 自己也会在429后重试，这里只是让其他等待中的上传不再撞上同一个限制。
+    """
+
+    PRIORITY_SINGLE = 0  # 单个文件
+    PRIORITY_PART = 1    # 分片任务中的一个分片
+
+    def __init__(self, max_parallel=2):
+        self.max_parallel = max(1, max_parallel)
+        self.active = 0
+        self.waiting = []  # 堆：(优先级, 序号, 路由, future)
+        self.counter = itertools.count()
+        self.buckets = {}  # 路由 -> [剩余次数, 重置时间(monotonic)]
+        self.global_reset_at = 0
+        self.wakeup = None  # 限额重置时重新调度的定时器
+        self.rate_limited = 0  # 收到429的次数
+        self.trace_config = TraceConfig()
+        self.trace_config.on_request_end.append(self.on_request_end)
+
+    @property
+    def queued_count(self):
+        return sum(1 for *_, future in self.waiting if not future.done())
+
+    @staticmethod
+    def route_of(interaction):
+        return f"webhooks/{interaction.application_id}/{interaction.token}"
+
+    async def send(self, interaction, priority=PRIORITY_SINGLE, **kwargs):
+        """等到限额允许后执行 interaction.followup.send(**kwargs)"""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (priority, next(self.counter), self.route_of(interaction), future))
+        self.pump()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已经分到名额才被取消
+                self.release()
+            raise
+        try:
+            return await interaction.followup.send(**kwargs)
+        finally:
+            self.release()
+
+    def release(self):
+        self.active -= 1
+        self.pump()
+
+    def pump(self):
+        """按优先级放行限额允许的上传"""
+        now = time.monotonic()
+        if now < self.global_reset_at:
+            self.wake_at(self.global_reset_at)
+            return
+        blocked = []
+        next_reset = None
+        while self.waiting and self.active < self.max_parallel:
+            item = heapq.heappop(self.waiting)
+            route, future = item[2], item[3]
+            if future.done():
+                continue
+            bucket = self.buckets.get(route)
+            if bucket is not None and now >= bucket[1]:
+                # 已过重置时间，等下一次响应再更新
+                del self.buckets[route]
+                bucket = None
+            if bucket is not None and bucket[0] <= 0:
+                blocked.append(item)
+                next_reset = bucket[1] if next_reset is None else min(next_reset, bucket[1])
+                continue
+            if bucket is not None:
+                bucket[0] -= 1
+            self.active += 1
+            future.set_result(None)
+        for item in blocked:
+            heapq.heappush(self.waiting, item)
+        if next_reset is not None:
+            self.wake_at(next_reset)
+
+    def wake_at(self, when):
+        loop = asyncio.get_running_loop()
+        if self.wakeup is not None:
+            if self.wakeup.when() <= loop.time() + (when - time.monotonic()):
+                return
+            self.wakeup.cancel()
+        self.wakeup = loop.call_later(max(0, when - time.monotonic()), self.on_wakeup)
+
+    def on_wakeup(self):
+        self.wakeup = None
+        self.pump()
+
+    async def on_request_end(self, session, trace_config_ctx, params):
+        """记录followup请求的速率限制头"""
+        if params.method != 'POST':
+            return
+        parts = params.url.path.strip('/').split('/')
+        if 'webhooks' not in parts:
+            return
+        index = parts.index('webhooks')
+        if len(parts) != index + 3:
+            # 只关心发送消息的路由，编辑消息等是其他限额
+            return
+        route = '/'.join(parts[index:])
+        headers = params.response.headers
+        now = time.monotonic()
+        if params.response.status == 429:
+            self.rate_limited += 1
+            retry_after = float(headers.get('X-RateLimit-Reset-After') or headers.get('Retry-After') or 1)
+            if headers.get('X-RateLimit-Global') or headers.get('X-RateLimit-Scope') == 'global':
+                self.global_reset_at = max(self.global_reset_at, now + retry_after)
+            else:
+                self.buckets[route] = [0, now + retry_after]
+            logger.warning(f"上传触发速率限制，{retry_after:.2f}秒后重试")
+        elif 'X-RateLimit-Remaining' in headers:
+            self.buckets[route] = [
+                int(headers['X-RateLimit-Remaining']),
+                now + float(headers.get('X-RateLimit-Reset-After', 0)),
+            ]
+        self.pump()
+
+
+class AlbumMetaCache:
+    """本子元数据缓存
+
+    下载时获取到的本子详情（标题、页数、章节、封面）按有效期缓存，不存在的ID另外
+    按较短的有效期记录。超过页数限制不单独记录：页数已缓存，按各档案自己的限制判断。
+    命令在排队下载前先查询这里，已知不存在或超过限制的ID直接拒绝，不再访问网络。
+    """
+
+    INDEX_FILENAME = '.album_meta.json'
+
+    def __init__(self, pdf_dir, ttl=7 * 24 * 3600, negative_ttl=6 * 3600, max_entries=50000):
+        self.index_path = os.path.join(pdf_dir, self.INDEX_FILENAME)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.albums = OrderedDict()  # album_id -> {title, page_count, episodes, cover, fetched_at}，按写入顺序
+        self.missing = OrderedDict()  # album_id -> 确认不存在的时间
+        self.lock = threading.Lock()  # 下载线程写入，事件循环读取
+        self.rejected = 0
+        self.dirty = False
+
+    def load(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            saved = {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"本子元数据缓存读取失败: {e}")
+            saved = {}
+
+        now = time.time()
+        with self.lock:
+            self.albums = OrderedDict(
+                (album_id, entry) for album_id, entry in saved.get('albums', {}).items()
+                if now - entry['fetched_at'] < self.ttl
+            )
+            self.missing = OrderedDict(
+                (album_id, checked_at) for album_id, checked_at in saved.get('missing', {}).items()
+                if now - checked_at < self.negative_ttl
+            )
+        logger.info(f"本子元数据缓存已加载: {len(self.albums)} 个本子，{len(self.missing)} 个不存在的ID")
+
+    def save(self):
+        """有变化时写入磁盘（阻塞，在文件线程池中或退出时调用）"""
+        data = self.snapshot()
+        if data is not None:
+            self.write(data)
+
+    def snapshot(self):
+        """有变化时在锁内复制缓存并清除变化标记，序列化留给 write"""
+        with self.lock:
+            if not self.dirty:
+                return None
+            self.dirty = False
+            return {'albums': dict(self.albums), 'missing': dict(self.missing)}
+
+    def write(self, data):
+        try:
+            temp_path = self.index_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            self.dirty = True
+            logger.error(f"保存本子元数据缓存失败: {e}")
+
+    def get(self, album_id):
+        """返回未过期的元数据，没有则返回None"""
+        with self.lock:
+            entry = self.albums.get(album_id)
+            if entry is not None and time.time() - entry['fetched_at'] >= self.ttl:
+                del self.albums[album_id]
+                self.dirty = True
+                entry = None
+            return entry
 
-async def send_large_file(interaction: discord.Interaction, file_path: str, filename: str, max_size: int = 8 * 1024 * 1024):
-    """发送大文件，如果超过限制则分片发送"""
-    file_size = os.path.getsize(file_path)
-    
-    if file_size <= max_size:
-        # 文件小于限制，直接发送
+    def missing_since(self, album_id):
+        """ID已确认不存在时返回确认时间，否则返回None"""
+        with self.lock:
+            checked_at = self.missing.get(album_id)
+            if checked_at is not None and time.time() - checked_at >= self.negative_ttl:
+                del self.missing[album_id]
+                self.dirty = True
+                checked_at = None
+            return checked_at
+
+    def record(self, album: jmcomic.JmAlbumDetail):
+        entry = {
+            'title': album.name,
+            'page_count': album.page_count,
+            'episodes': [list(episode) for episode in album.episode_list],
+            'cover': jmcomic.JmcomicText.get_album_cover_url(album.album_id),
+            'fetched_at': time.time(),
+        }
+        with self.lock:
+            self.albums.pop(album.album_id, None)
+            self.albums[album.album_id] = entry
+            self.missing.pop(album.album_id, None)
+            self._trim(self.albums)
+            self.dirty = True
+
+    def record_missing(self, album_id):
+        album_id = str(album_id)
+        with self.lock:
+            self.albums.pop(album_id, None)
+            self.missing.pop(album_id, None)
+            self.missing[album_id] = time.time()
+            self._trim(self.missing)
+            self.dirty = True
+
+    def _trim(self, entries):
+        # 超过条数上限时丢弃最早写入的记录
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+
+class RandomIdIndex:
+    """/jmr 随机范围内每个ID的状态索引
+
+    文件依次存放文件头、可用位图和不可用位图，每个ID在两个位图中各占一位，都为0表示未知。
+    文件通过内存映射读写，启动时只按块统计可用数量，110万个ID的范围也只需几毫秒。
+    随机时按块计数抽取一个已知可用的ID，并按探索比例抽取未知ID来发现新的可用ID。
+    """
+
+    INDEX_FILENAME = '.id_index.bin'
+    HEADER = struct.Struct('<4sII')  # 标识、IDmin、IDmax
+    MAGIC = b'JMID'
+    BLOCK_BYTES = 512  # 每块4096个ID
+
+    VALID = 'valid'
+    INVALID = 'invalid'
+    UNKNOWN = 'unknown'
+
+    def __init__(self, pdf_dir, id_min, id_max):
+        self.path = os.path.join(pdf_dir, self.INDEX_FILENAME)
+        self.id_min = id_min
+        self.id_max = id_max
+        self.bitmap_bytes = (id_max - id_min + 1 + 7) // 8
+        self.valid_offset = self.HEADER.size
+        self.invalid_offset = self.valid_offset + self.bitmap_bytes
+        self.file = None
+        self.mapped = None
+        self.block_counts = []  # 每块中已知可用的ID数
+        self.valid_total = 0
+        self.invalid_total = 0
+        self.dirty = False
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        header = self.HEADER.pack(self.MAGIC, self.id_min, self.id_max)
+        total = self.invalid_offset + self.bitmap_bytes
         try:
-            with open(file_path, 'rb') as f:
-                file = discord.File(f, filename=filename)
-                await interaction.followup.send(file=file)
-            return True, "文件发送成功"
-        except Exception as e:
-            return False, f"文件发送失败: {str(e)}"
-    
-    # 文件过大，需要分片发送
-    logger.info(f"文件过大 ({file_size//1024}KB)，开始分片发送")
-    
-    try:
-        # 创建分片ZIP文件
-        chunk_size = max_size - 1024 * 1024  # 预留1MB空间给ZIP文件头
-        chunks = []
-        
-        with open(file_path, 'rb') as f:
-            chunk_num = 1
-            while True:
-                chunk_data = f.read(chunk_size)
-                if not chunk_data:
-                    break
-                
-                # 创建ZIP文件在内存中
-                zip_buffer = BytesIO()
-                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                    zip_file.writestr(f"{filename}.part{chunk_num}", chunk_data)
-                
-                zip_buffer.seek(0)
-                chunks.append((zip_buffer.getvalue(), f"{filename}.part{chunk_num}.zip"))
-                chunk_num += 1
-        
-        # 发送分片文件
-        embed = discord.Embed(
-            title="📦 文件分片发送",
-            description=f"文件过大({file_size//1024}KB)，分为{len(chunks)}个部分发送",
-            color=discord.Color.blue()
-        )
-        await interaction.followup.send(embed=embed)
+            f = open(self.path, 'r+b')
+        except FileNotFoundError:
+            f = open(self.path, 'w+b')
+        if f.read(self.HEADER.size) != header:
+            if os.fstat(f.fileno()).st_size:
+                logger.warning("随机ID范围已变化，重新建立ID索引")
+            f.seek(0)
+            f.truncate(0)
+            f.write(header)
+        f.truncate(total)
+        self.file = f
+        self.mapped = mmap.mmap(f.fileno(), total)
+
+        self.block_counts = [
+            self.count_bits(self.valid_offset, start, start + self.BLOCK_BYTES)
+            for start in range(0, self.bitmap_bytes, self.BLOCK_BYTES)
+        ]
+        self.valid_total = sum(self.block_counts)
+        self.invalid_total = self.count_bits(self.invalid_offset, 0, self.bitmap_bytes)
+        logger.info(f"随机ID索引已加载: {self.valid_total} 个可用，{self.invalid_total} 个不可用")
+
+    def read_bits(self, bitmap_offset, start, end):
+        """把位图中 [start, end) 字节读成整数，第i位对应该段的第i个ID"""
+        end = min(end, self.bitmap_bytes)
+        return int.from_bytes(self.mapped[bitmap_offset + start:bitmap_offset + end], 'little')
+
+    def count_bits(self, bitmap_offset, start, end):
+        return self.read_bits(bitmap_offset, start, end).bit_count()
+
+    def locate(self, album_id):
+        """返回ID所在的字节偏移和位掩码，超出范围时返回None"""
+        index = int(album_id) - self.id_min
+        if not 0 <= index <= self.id_max - self.id_min:
+            return None
+        byte, bit = divmod(index, 8)
+        return byte, 1 << bit
+
+    def state(self, album_id):
+        location = self.locate(album_id)
+        if location is None:
+            return self.UNKNOWN
+        byte, mask = location
+        if self.mapped[self.valid_offset + byte] & mask:
+            return self.VALID
+        if self.mapped[self.invalid_offset + byte] & mask:
+            return self.INVALID
+        return self.UNKNOWN
+
+    def mark(self, album_id, valid):
+        location = self.locate(album_id)
+        if location is None:
+            return
+        byte, mask = location
+        old = self.state(album_id)
+        new = self.VALID if valid else self.INVALID
+        if old == new:
+            return
+        block = byte // self.BLOCK_BYTES
+        if old == self.VALID:
+            self.mapped[self.valid_offset + byte] &= ~mask & 0xFF
+            self.block_counts[block] -= 1
+            self.valid_total -= 1
+        elif old == self.INVALID:
+            self.mapped[self.invalid_offset + byte] &= ~mask & 0xFF
+            self.invalid_total -= 1
+        if valid:
+            self.mapped[self.valid_offset + byte] |= mask
+            self.block_counts[block] += 1
+            self.valid_total += 1
+        else:
+            self.mapped[self.invalid_offset + byte] |= mask
+            self.invalid_total += 1
+        self.dirty = True
+
+    def sample(self, explore_rate=0.1):
+        """随机返回一个已知可用的ID，按 explore_rate 的比例（或还没有可用ID时）返回未知ID"""
+        if not self.valid_total or random.random() < explore_rate:
+            return self.sample_unknown()
+        k = random.randrange(self.valid_total)
+        for block, count in enumerate(self.block_counts):
+            if k < count:
+                break
+            k -= count
+        start = block * self.BLOCK_BYTES
+        bits = self.read_bits(self.valid_offset, start, start + self.BLOCK_BYTES)
+        for _ in range(k):
+            bits &= bits - 1  # 去掉最低的k个置位
+        return self.id_min + start * 8 + (bits & -bits).bit_length() - 1
+
+    def sample_unknown(self, tries=64):
+        album_id = random.randint(self.id_min, self.id_max)
+        for _ in range(tries):
+            if self.state(album_id) == self.UNKNOWN:
+                break
+            album_id = random.randint(self.id_min, self.id_max)
+        return album_id
+
+    def flush(self):
+        if self.dirty and self.mapped is not None:
+            # 先清除标记，flush 期间新写入的位会在下次 flush 时写回
+            self.dirty = False
+            self.mapped.flush()
+
+    def close(self):
+        if self.mapped is None:
+            return
+        self.flush()
+        self.mapped.close()
+        self.file.close()
+        self.mapped = None
+
+
+class RandomWarmPool:
+    """/jmr 的预下载池
+
+    空闲时在后台随机下载几本并转换成PDF放进缓存，/jmr 直接取出一本发送，再在后台补充。
+    预下载不占用调度器名额，只在调度器空闲一段时间后开始，有用户任务时立即取消；
+    使用低并发的 prefetch 档案限制带宽和CPU，池中PDF的总大小不超过磁盘预算。
+    """
+
+    def __init__(self, pdf_cache, pool_size=3, refill_interval=60, idle_seconds=30, max_disk_bytes=0):
+        self.pdf_cache = pdf_cache
+        self.pool_size = pool_size
+        self.refill_interval = refill_interval  # 两次预下载之间至少间隔的秒数
+        self.idle_seconds = idle_seconds
+        self.max_disk_bytes = max_disk_bytes  # 0 表示不限制
+        self.ready = deque()  # 已转换好的漫画ID
+        self.wakeup = asyncio.Event()
+        self.control = None  # 正在进行的预下载，用于取消
+        self.filled = 0
+        self.served = 0
+        self.cancelled = 0
+
+    def pop(self):
+        """取出一本已缓存的预下载漫画并触发补充，池为空时返回None"""
+        self.wakeup.set()
+        while self.ready:
+            comic_id = self.ready.popleft()
+            entry = self.pdf_cache.entries.get(comic_id)
+            if entry is not None and entry['complete']:
+                self.served += 1
+                return comic_id
+        return None
+
+    def push(self, comic_id):
+        self.ready.append(comic_id)
+        self.filled += 1
+
+    def disk_bytes(self):
+        return sum(self.pdf_cache.entries[comic_id]['size'] for comic_id in self.ready if comic_id in self.pdf_cache.entries)
+
+    def needs_refill(self):
+        if len(self.ready) >= self.pool_size:
+            return False
+        return self.max_disk_bytes <= 0 or self.disk_bytes() < self.max_disk_bytes
+
+    def cancel(self, reason):
+        if self.control is not None and self.control.cancel(reason):
+            self.cancelled += 1
+            logger.info(f"预下载已取消: {reason}")
+
+
+class PdfOptimizer:
+    """把超过上传限制的PDF重新压缩到目标大小以内
+
+    在进程池中对页面图片重新编码：先用抽样页面估算整本大小，依次尝试各个缩放比例，
+    在每个比例下二分查找满足目标大小的最高JPEG质量，再分块完整编码并边编码边写入，确认实际大小。
+    压缩结果作为 {漫画ID}.opt{目标KB}k.pdf 登记在PDF缓存中，之后直接复用。
+    """
+
+    SCALES = (1.0, 0.85, 0.7, 0.55, 0.4)
+    SAMPLE_PAGES = 24
+    PAGE_OVERHEAD = 512  # 每页内容流和页面对象的大致字节数
+    PAGES_PER_TASK = 4  # 完整编码时每个进程一次处理的页数，内存中只保留当前一块的编码结果
+
+    def __init__(self, pdf_cache, process_pool, enabled=False, target_bytes=0, min_quality=40, max_quality=90):
+        self.pdf_cache = pdf_cache
+        self.process_pool = process_pool
+        self.enabled = enabled
+        self.target_bytes = target_bytes  # 0 表示使用当前服务器的上传限制
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self._locks = weakref.WeakValueDictionary()
+
+    @staticmethod
+    def variant_key(comic_id, target):
+        return f"{comic_id}.opt{target // 1024}k"
+
+    async def needs(self, pdf_path, upload_limit):
+        """是否需要压缩（开启了压缩且文件超过上传限制）"""
+        return self.enabled and await self.pdf_cache.file_io.getsize(pdf_path) > upload_limit
+
+    @staticmethod
+    def is_fresh(variant_path, pdf_path):
+        """压缩版本存在且不早于原文件（阻塞）"""
+        return os.path.exists(variant_path) and os.path.getmtime(variant_path) >= os.path.getmtime(pdf_path)
+
+    async def fit(self, comic_id, pdf_path, upload_limit):
+        """返回不超过目标大小的 (缓存键, 路径)，无需或无法压缩时返回None"""
+        if not await self.needs(pdf_path, upload_limit):
+            return None
+        target = min(self.target_bytes, upload_limit) if self.target_bytes else upload_limit
         
-        for i, (chunk_data, chunk_filename) in enumerate(chunks, 1):
-            chunk_file = discord.File(BytesIO(chunk_data), filename=chunk_filename)
-            embed = discord.Embed(
-                title=f"📁 第{i}部分",
-                description=f"共{len(chunks)}部分",
-                color=discord.Color.green()
-            )
-            await interaction.followup.send(embed=embed, file=chunk_file)
-            # 小延迟避免速率限制
-            await asyncio.sleep(1)
+        key = self.variant_key(comic_id, target)
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        async with lock:
+            variant_path = self.pdf_cache.path_of(key)
+            # 原文件重新下载过则压缩版本作废
+            if key in self.pdf_cache.entries and await self.pdf_cache.file_io.run(self.is_fresh, variant_path, pdf_path):
+                self.pdf_cache.lookup(key)
+                return key, variant_path
+            
+            started = time.monotonic()
+            try:
+                written = await self.optimize(pdf_path, variant_path, target)
+            except Exception as e:
+                logger.error(f"PDF压缩失败 {comic_id}: {e}")
+                written = None
+            if written is None:
+                logger.info(f"PDF {comic_id} 无法压缩到 {target//1024}KB 以内，按原文件发送")
+                return None
+            logger.info(f"PDF {comic_id} 已压缩到 {written//1024}KB，用时 {time.monotonic() - started:.1f}s")
+            await self.pdf_cache.add(key)
+            return key, variant_path
+
+    async def _encode(self, pdf_path, pages, quality, scale, return_data):
+        """把页面分块交给进程池并行编码，结果按页面顺序返回"""
+        loop = asyncio.get_running_loop()
+        executor = self.process_pool.get_executor()
+        size = math.ceil(len(pages) / self.process_pool.workers)
+        chunks = await asyncio.gather(*(
+            loop.run_in_executor(executor, encode_pdf_pages, pdf_path, pages[i:i + size], quality, scale, return_data)
+            for i in range(0, len(pages), size)
+        ))
+        return [result for chunk in chunks for result in chunk]
+
+    @staticmethod
+    def _add_pages(writer, images, pages):
+        # 保持原来的页面尺寸，重新编码只改变图片像素
+        for data, page in zip(images, pages):
+            writer.add_page(data, page_size=page[6:8])
+        return writer.file.tell()
+
+    async def _write_variant(self, pdf_path, variant_path, pages, quality, scale, target):
+        """分块编码并依次写入PDF，返回文件大小；超过 target 时提前放弃并删除文件"""
+        file_io = self.pdf_cache.file_io
+        writer = await file_io.run(StreamingPdfWriter, variant_path)
+        size = self.process_pool.workers * self.PAGES_PER_TASK
+        try:
+            for i in range(0, len(pages), size):
+                images = await self._encode(pdf_path, pages[i:i + size], quality, scale, True)
+                written = await file_io.run(self._add_pages, writer, images, pages[i:i + size])
+                del images
+                if written > target:
+                    await file_io.run(writer.abort)
+                    return written
+            await file_io.run(writer.close)
+        except BaseException:
+            # 任务被取消时也要在文件IO线程中关闭并删除临时文件
+            await asyncio.shield(file_io.run(writer.abort))
+            raise
+        written = await file_io.getsize(variant_path)
+        if written > target:
+            await file_io.remove(variant_path)
+        return written
+
+    async def optimize(self, pdf_path, variant_path, target):
+        """生成不超过 target 字节的PDF，成功返回实际大小，否则返回None"""
+        loop = asyncio.get_running_loop()
+        pages = await loop.run_in_executor(self.process_pool.get_executor(), scan_pdf_images, pdf_path)
+        if not pages:
+            logger.info(f"PDF结构不支持重新压缩: {pdf_path}")
+            return None
         
-        # 发送合并说明
-        merge_embed = discord.Embed(
-            title="🔧 文件合并说明",
-            description=f"""
-**合并步骤：**
-1. 下载所有 .zip 分片文件
-2. 解压每个分片文件得到 .part 文件
-3. 使用以下命令合并（Windows）：
-```
-copy /b {filename}.part1+{filename}.part2+...+{filename}.part{len(chunks)} {filename}
-```
-**或者使用在线工具合并分片文件**
-            """,
-            color=discord.Color.yellow()
-        )
-        await interaction.followup.send(embed=merge_embed)
+        budget = target - self.PAGE_OVERHEAD * len(pages) - 4096
+        sample = pages[::max(1, len(pages) // self.SAMPLE_PAGES)]
+        # 按原始数据大小把抽样结果折算到整本
+        ratio = sum(page[1] for page in pages) / max(1, sum(page[1] for page in sample))
         
-        return True, f"文件已分为{len(chunks)}个部分发送"
+        async def fits(quality, scale):
+            return sum(await self._encode(pdf_path, sample, quality, scale, False)) * ratio <= budget
         
-    except Exception as e:
-        return False, f"分片发送失败: {str(e)}"
+        for scale in self.SCALES:
+            if not await fits(self.min_quality, scale):
+                continue
+            low, high, quality = self.min_quality + 1, self.max_quality, self.min_quality
+            while low <= high:
+                middle = (low + high) // 2
+                if await fits(middle, scale):
+                    quality, low = middle, middle + 1
+                else:
+                    high = middle - 1
+            
+            # 抽样估算可能偏小，超出时降低质量重试
+            while quality >= self.min_quality:
+                written = await self._write_variant(pdf_path, variant_path, pages, quality, scale, target)
+                if written <= target:
+                    return written
+                quality -= 10
+        return None
 
-async def send_file_smart(interaction: discord.Interaction, file_path: str, filename: str):
-    """智能文件发送，自动处理大文件"""
-    file_size = os.path.getsize(file_path)
-    
-    # Discord文件大小限制检测
-    max_size = 8 * 1024 * 1024  # 8MB (免费用户限制)
-    
-    if file_size <= max_size:
-        # 尝试直接发送
+
+class OptionProfiles:
+    """下载配置档案
+
+    启动时只解析一次 option.yml，normal/force/retry 及 bot_config.json 中自定义的档案
+    都在内存中按结构覆盖后构造成 JmOption，每次下载复制一份使用，不再读写临时文件。
+    """
+
+    # 内置档案相对 option.yml 的覆盖项，plugin_kwargs 按插件名修改所有同名插件的参数
+    BUILTIN = {
+        'normal': {},
+        'force': {'plugin_kwargs': {'skip_too_long_book': {'max_pages': 500}}},
+        'retry': {
+            'client': {'retry_times': 10},
+            'download': {'threading': {'image': 15, 'photo': 8}},  # 降低并发
+        },
+        'prefetch': {'download': {'threading': {'image': 4, 'photo': 1}}},  # 后台预下载，少占带宽和CPU
+    }
+
+    def __init__(self, option_path, custom=None, pool_size=32, idle_timeout=60):
+        self.option_path = option_path
+        self.custom = custom or {}  # 同名时覆盖内置档案
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.profiles = {}  # 档案名 -> JmOption
+        self.clients = {}  # 档案名 -> 长期共用的 JmcomicClient
+        self.base_domains = {}  # 档案名 -> 客户端原始的域名顺序
+        self.domain_health = None  # DomainHealth，设置后按健康度排列域名
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.error = None
+
+    def load(self):
         try:
-            with open(file_path, 'rb') as f:
-                file = discord.File(f, filename=filename)
-                await interaction.followup.send(file=file)
-            logger.info(f"文件直接发送成功: {filename} ({file_size//1024}KB)")
-            return True, "文件发送成功"
-        except discord.HTTPException as e:
-            if "Payload Too Large" in str(e) or "413" in str(e):
-                logger.warning(f"文件过大，转为分片发送: {filename}")
-                return await send_large_file(interaction, file_path, filename, max_size)
-            else:
-                return False, f"文件发送失败: {str(e)}"
+            self.mtime = os.stat(self.option_path).st_mtime_ns
+            with open(self.option_path, 'r', encoding='utf-8') as f:
+                base = yaml.safe_load(f) or {}
+            base.setdefault('filepath', self.option_path)
+            option_class = jmcomic.JmModuleConfig.option_class()
+            profiles = {
+                name: option_class.construct(self.apply_overrides(name, base, overrides))
+                for name, overrides in {**self.BUILTIN, **self.custom}.items()
+            }
         except Exception as e:
-            return False, f"文件发送失败: {str(e)}"
-    else:
-        # 文件明显过大，直接分片
-        logger.info(f"文件过大，直接分片发送: {filename} ({file_size//1024}KB)")
-        return await send_large_file(interaction, file_path, filename, max_size)
-
-class SkipTooLongBook(jmcomic.JmOptionPlugin):
-    plugin_key = 'skip_too_long_book'
-    
-    def invoke(self, 
-               max_pages: int = 100,  # 可在option.yml中配置
-               album: jmcomic.JmAlbumDetail = None,
-               **kwargs):
-        if album is None:
-            logger.error('错误: Album is None')
+            # 重新加载失败时继续使用之前的档案
+            self.error = str(e)
+            logger.error(f"加载 option.yml 失败: {e}")
             return
-        pages = album.page_count
-        logger.info(f'漫画 {album.id} 共 {pages} 页，限制为 {max_pages} 页')
-        if pages <= max_pages:
-            logger.info(f'页数检查通过: {pages}/{max_pages}')
+        
+        with self.lock:
+            # 客户端配置没变的档案继续使用原来的客户端和连接
+            for name, client in list(self.clients.items()):
+                old = self.profiles.get(name)
+                new = profiles.get(name)
+                if new is None or old is None or new.client.src_dict != old.client.src_dict:
+                    self.close_client(self.clients.pop(name))
+                    self.base_domains.pop(name, None)
+            self.profiles = profiles
+        self.error = None
+        logger.info(f"已加载下载配置档案: {', '.join(self.profiles)}")
+
+    def refresh(self):
+        """option.yml 修改过则重新加载"""
+        try:
+            mtime = os.stat(self.option_path).st_mtime_ns
+        except OSError:
             return
+        if mtime != self.mtime:
+            logger.info("option.yml 已修改，重新加载配置档案")
+            self.load()
+
+    def get(self, name):
+        """返回该档案的一份副本，调用方可以随意修改；下载时使用该档案共用的客户端"""
+        self.refresh()
+        if not self.profiles:
+            raise RuntimeError(f"option.yml 加载失败: {self.error}")
+        if name not in self.profiles:
+            raise KeyError(f"未知的下载配置档案: {name}")
+        option = self.profiles[name].copy_option()
+        option.shared_client = lambda: self.client_for(name)
+        option.max_pages = self.max_pages(name)
+        return option
+
+    def max_pages(self, name):
+        """档案中 skip_too_long_book 插件的页数限制，没有配置该插件时返回None"""
+        option = self.profiles.get(name)
+        if option is None:
+            return None
+        for item in option.plugins.get('before_album') or []:
+            if item.get('plugin') == SkipTooLongBook.plugin_key:
+                return (item.get('kwargs') or {}).get('max_pages', 100)
+        return None
+
+    def client_for(self, name):
+        """返回档案共用的客户端，首次使用时在下载线程中创建"""
+        with self.lock:
+            client = self.clients.get(name)
+            if client is None:
+                client = self.new_client(self.profiles[name])
+                self.clients[name] = client
+                self.base_domains[name] = list(client.get_domain_list())
+            self.apply_domain_order(name, client)
+            return client
+
+    def apply_domain_order(self, name, client):
+        """按域名健康度重排客户端的域名，整体替换列表，对正在使用的线程是安全的"""
+        if self.domain_health is not None:
+            client.set_domain_list(self.domain_health.rank(self.base_domains[name]))
+
+    def reorder_domains(self):
+        with self.lock:
+            for name, client in self.clients.items():
+                self.apply_domain_order(name, client)
+
+    def all_domains(self):
+        """所有档案配置的域名（未配置时为客户端自动获取的域名），保持首次出现的顺序"""
+        domains = []
+        with self.lock:
+            for name, option in self.profiles.items():
+                configured = self.base_domains.get(name) or option.client.src_dict.get('domain') or []
+                if isinstance(configured, dict):
+                    configured = configured.get(option.client.src_dict.get('impl') or jmcomic.JmModuleConfig.DEFAULT_CLIENT_IMPL, [])
+                if isinstance(configured, str):
+                    configured = configured.split()
+                domains += [domain for domain in configured if domain not in domains]
+        return domains
+
+    def new_client(self, option):
+        client = option.new_jm_client()
+        postman_type = option.client.postman.src_dict.get('type', 'curl_cffi')
+        if postman_type in ('curl_cffi', 'cffi', 'curl_cffi_session'):
+            client.postman = PooledSessionPostman(client.postman.meta_data, self.pool_size, self.idle_timeout)
+        return client
+
+    @staticmethod
+    def close_client(client):
+        if isinstance(client.postman, PooledSessionPostman):
+            client.postman.close()
+
+    def close(self):
+        with self.lock:
+            for client in self.clients.values():
+                self.close_client(client)
+            self.clients = {}
+
+    @classmethod
+    def apply_overrides(cls, name, base, overrides):
+        result = copy.deepcopy(base)
+        overrides = dict(overrides)
+        plugin_kwargs = overrides.pop('plugin_kwargs', {})
+        cls.deep_merge(result, overrides)
+        
+        matched = set()
+        for group in (result.get('plugins') or {}).values():
+            if not isinstance(group, list):
+                continue
+            for item in group:
+                plugin_key = item.get('plugin')
+                if plugin_key in plugin_kwargs:
+                    item['kwargs'] = {**(item.get('kwargs') or {}), **plugin_kwargs[plugin_key]}
+                    matched.add(plugin_key)
+        for plugin_key in plugin_kwargs.keys() - matched:
+            logger.warning(f"配置档案 {name}: option.yml 中没有插件 {plugin_key}，覆盖项未生效")
+        return result
+
+    @classmethod
+    def deep_merge(cls, target, overrides):
+        for key, value in overrides.items():
+            if isinstance(value, dict) and isinstance(target.get(key), dict):
+                cls.deep_merge(target[key], value)
+            else:
+                target[key] = copy.deepcopy(value)
+
+
+class DomainHealth:
+    """JM域名健康度
+
+    后台定期探测每个域名，用指数加权平均记录延迟和成功率。下载时按成功率和延迟排列域名，
+    成功率低于 bad_success_rate 的域名直接跳过（全部不可用时保持原顺序）。
+    """
+
+    def __init__(self, alpha=0.3, bad_success_rate=0.5):
+        self.alpha = alpha
+        self.bad_success_rate = bad_success_rate
+        self.stats = {}  # domain -> {latency, success, probes, last_error, probed_at}
+
+    def record(self, domain, ok, latency, error=None):
+        stat = self.stats.get(domain)
+        if stat is None:
+            stat = self.stats[domain] = {
+                'latency': latency if ok else None,
+                'success': 1.0 if ok else 0.0,
+                'probes': 0,
+            }
         else:
-            logger.warning(f'超过页数限制({max_pages}页)，已阻止下载 - 漫画ID: {album.id}')
-            raise Exception(f"漫画页数({pages}页)超过限制({max_pages}页)")
+            stat['success'] += self.alpha * ((1.0 if ok else 0.0) - stat['success'])
+            if ok:
+                stat['latency'] = latency if stat['latency'] is None else stat['latency'] + self.alpha * (latency - stat['latency'])
+        stat['probes'] += 1
+        stat['last_error'] = None if ok else error
+        stat['probed_at'] = time.time()
+
+    def is_bad(self, domain):
+        stat = self.stats.get(domain)
+        return stat is not None and stat['success'] < self.bad_success_rate
+
+    def score(self, domain):
+        """越小越好，没有探测结果的域名排在有结果的后面"""
+        stat = self.stats.get(domain)
+        if stat is None or stat['latency'] is None:
+            return math.inf
+        return stat['latency'] / max(stat['success'], 0.05)
+
+    def ordered(self, domains):
+        """按健康度排列全部域名，不可用的排在最后"""
+        return sorted(domains, key=lambda domain: (self.is_bad(domain), self.score(domain)))
+
+    def rank(self, domains):
+        """下载使用的域名顺序"""
+        healthy = [domain for domain in self.ordered(domains) if not self.is_bad(domain)]
+        return healthy or list(domains)
+
+    @staticmethod
+    def probe(client, domain, timeout):
+        """请求一次域名首页（阻塞，需在线程中调用），返回 (是否可用, 延迟秒数, 错误)"""
+        started = time.monotonic()
+        try:
+            resp = client.postman.get(f"https://{domain}/", timeout=timeout)
+        except Exception as e:
+            return False, time.monotonic() - started, str(e)[:100]
+        latency = time.monotonic() - started
+        # 网页端首页应正常返回，APP端域名的根路径可能是404，只要服务可达即可
+        limit = 400 if isinstance(client, jmcomic.JmHtmlClient) else 500
+        if resp.status_code >= limit:
+            return False, latency, f"HTTP {resp.status_code}"
+        return True, latency, None
+
 
 class JMBot(commands.Bot):
     def __init__(self):
@@ -165,19 +2915,57 @@ class JMBot(commands.Bot):
         intents = discord.Intents.default()
         intents.message_content = True
         
-        super().__init__(command_prefix='!', intents=intents)
+        # 上传调度器从HTTP会话的 trace 中读取速率限制头，需要在创建会话前传入
+        self.upload_scheduler = UploadScheduler()
+        super().__init__(command_prefix='!', intents=intents, http_trace=self.upload_scheduler.trace_config)
         
         # 注册自定义插件
         jmcomic.JmModuleConfig.register_plugin(SkipTooLongBook)
+        jmcomic.JmModuleConfig.register_plugin(StreamPdfPlugin)
+        
+        # 合并同一ID的并发下载请求
+        self.single_flight = SingleFlight()
         
-        # 存储正在下载的ID
-        self.downloading = set()
+        # 各服务器的上传大小限制
+        self.upload_limits = UploadLimitCache()
         
         # 加载配置
         self.load_config()
     
+    @property
+    def downloading(self):
+        """正在下载或排队中的ID"""
+        return self.scheduler.active_ids
+    
+    def load_state(self):
+        """加载磁盘上的缓存索引等状态，不需要连接Discord（benchmarks 中也直接调用）"""
+        self.pdf_cache.load()
+        for comic_id in self.manifests.pending():
+            # 有未完成清单的PDF不能当作完整缓存
+            self.pdf_cache.mark_incomplete(comic_id)
+        self.upload_refs.load()
+        self.album_meta.load()
+        self.image_staging.reset()
+        self.id_index.open()
+        self.seed_id_index()
+        self.register_metrics()
+    
     async def setup_hook(self):
         """机器人启动时的设置钩子"""
+        # 加载PDF缓存索引并定期写回
+        self.load_state()
+        self.background_tasks = [asyncio.create_task(self.flush_cache_index_loop())]
+        if self.domain_probe_config.get('enabled', True):
+            self.background_tasks.append(asyncio.create_task(self.domain_probe_loop()))
+        if self.random_index_config.get('crawler_enabled', False):
+            self.background_tasks.append(asyncio.create_task(self.id_crawler_loop()))
+        if self.prefetch_config.get('enabled', False):
+            self.background_tasks.append(asyncio.create_task(self.prefetch_loop()))
+        
+        # 本地指标接口
+        if self.metrics_config.get('enabled', False):
+            await self.start_metrics_server()
+        
         # 同步斜杠命令到Discord
         try:
             synced = await self.tree.sync()
@@ -185,20 +2973,333 @@ class JMBot(commands.Bot):
         except Exception as e:
             logger.error(f"同步斜杠命令失败: {e}")
         
+    async def flush_cache_index_loop(self):
+        """定期保存缓存索引中的访问记录"""
+        while True:
+            await asyncio.sleep(60)
+            try:
+                await self.pdf_cache.save_async()
+                # 元数据缓存有自己的锁，整个保存过程都可以放到文件线程池
+                await self.file_io.run(self.album_meta.save)
+                await self.file_io.run(self.id_index.flush)
+            except Exception as e:
+                logger.error(f"定期保存缓存索引失败: {e}")
+    
+    async def domain_probe_loop(self):
+        """定期探测各域名并更新下载使用的域名顺序"""
+        interval = self.domain_probe_config.get('interval_seconds', 300)
+        while True:
+            try:
+                await self.probe_domains()
+            except Exception as e:
+                logger.error(f"域名探测失败: {e}")
+            await asyncio.sleep(interval)
+    
+    async def probe_domains(self):
+        domains = self.option_profiles.all_domains()
+        if not domains:
+            return
+        timeout = self.domain_probe_config.get('timeout_seconds', 10)
+        client = await asyncio.to_thread(self.option_profiles.client_for, 'normal')
+        results = await asyncio.gather(*(
+            asyncio.to_thread(DomainHealth.probe, client, domain, timeout) for domain in domains
+        ))
+        for domain, (ok, latency, error) in zip(domains, results):
+            self.domain_health.record(domain, ok, latency, error)
+        self.option_profiles.reorder_domains()
+        logger.info(f"域名探测完成，当前顺序: {self.domain_health.rank(domains)}")
+    
+    def update_id_index(self, comic_id):
+        """按元数据缓存更新随机ID索引，超过普通下载页数限制的本子算作不可用"""
+        if self.album_meta.missing_since(comic_id) is not None:
+            self.id_index.mark(comic_id, False)
+            return
+        meta = self.album_meta.get(comic_id)
+        if meta is not None:
+            max_pages = self.option_profiles.max_pages("normal")
+            self.id_index.mark(comic_id, max_pages is None or meta['page_count'] <= max_pages)
+    
+    def seed_id_index(self):
+        """把元数据缓存中已有的结果写入随机ID索引"""
+        for comic_id in list(self.album_meta.albums) + list(self.album_meta.missing):
+            self.update_id_index(comic_id)
+    
+    async def id_crawler_loop(self):
+        """空闲时逐个查询未知ID，补充随机ID索引；有下载任务时暂停"""
+        interval = self.random_index_config.get('crawl_interval_seconds', 10)
+        while True:
+            await asyncio.sleep(interval)
+            if self.scheduler.running or self.scheduler.queued_count:
+                continue
+            comic_id = str(self.id_index.sample_unknown())
+            try:
+                client = await asyncio.to_thread(self.option_profiles.client_for, "normal")
+                album = await asyncio.to_thread(client.get_album_detail, comic_id)
+                self.album_meta.record(album)
+            except MissingAlbumPhotoException:
+                self.album_meta.record_missing(comic_id)
+            except Exception as e:
+                logger.debug(f"查询ID {comic_id} 失败: {e}")
+                continue
+            self.update_id_index(comic_id)
+    
+    async def prefetch_loop(self):
+        """调度器空闲时补充 /jmr 预下载池"""
+        while True:
+            try:
+                await asyncio.wait_for(self.warm_pool.wakeup.wait(), self.warm_pool.refill_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.warm_pool.wakeup.clear()
+            if not self.warm_pool.needs_refill():
+                continue
+            if self.scheduler.running or self.scheduler.queued_count or self.scheduler.idle_for < self.warm_pool.idle_seconds:
+                continue
+            try:
+                await self.prefetch_one()
+            except Exception as e:
+                logger.error(f"预下载失败: {e}")
+    
+    async def prefetch_one(self):
+        comic_id = str(self.id_index.sample(self.random_index_config.get('explore_rate', 0.1)))
+        if comic_id in self.single_flight or comic_id in self.warm_pool.ready:
+            return
+        if self.id_index.state(comic_id) == RandomIdIndex.INVALID:
+            return
+        entry = self.pdf_cache.entries.get(comic_id)
+        if entry is not None and entry['complete']:
+            self.warm_pool.push(comic_id)
+            return
+        
+        control = jmcomic.DownloadControl()
+        
+        async def run():
+            option = await self.file_io.run(self.option_profiles.get, "prefetch")
+            logger.info(f"开始预下载漫画 {comic_id}")
+            result = await download_comic_async(comic_id, option, control)
+            self.update_id_index(comic_id)
+            if result[0] is True:
+                await self.pdf_cache.add(comic_id)
+            elif result[0] == "partial":
+                await self.pdf_cache.add(comic_id, complete=False)
+            return result
+        
+        self.warm_pool.control = control
+        watcher = asyncio.create_task(self.cancel_prefetch_when_busy())
+        try:
+            result = await self.single_flight.run(comic_id, run, tag="prefetch", accept=only_success_shared)
+        finally:
+            watcher.cancel()
+            self.warm_pool.control = None
+        if result[0] is True:
+            self.warm_pool.push(comic_id)
+            logger.info(f"预下载完成 {comic_id}，预下载池: {len(self.warm_pool.ready)}/{self.warm_pool.pool_size}")
+    
+    async def cancel_prefetch_when_busy(self):
+        """预下载期间有用户任务时取消预下载，把带宽让给用户"""
+        while not self.scheduler.running and not self.scheduler.queued_count:
+            await asyncio.sleep(1)
+        self.warm_pool.cancel("有用户下载任务")
+    
+    def register_metrics(self):
+        metrics.register('jm_cache_hits_total', 'counter', 'PDF缓存命中次数', lambda: self.pdf_cache.hits)
+        metrics.register('jm_cache_misses_total', 'counter', 'PDF缓存未命中次数', lambda: self.pdf_cache.misses)
+        metrics.register('jm_upload_reused_total', 'counter', '复用已上传附件的次数', lambda: self.upload_refs.reused)
+        metrics.register('jm_album_meta_rejected_total', 'counter', '按元数据缓存直接拒绝的请求数', lambda: self.album_meta.rejected)
+        metrics.register('jm_downloading', 'gauge', '正在下载或排队中的ID数', lambda: len(self.downloading))
+        metrics.register('jm_queue_length', 'gauge', '排队中的任务数', lambda: self.scheduler.queued_count)
+        metrics.register('jm_active_threads', 'gauge', '进程中的线程数', threading.active_count)
+        metrics.register('jm_pdf_cache_bytes', 'gauge', 'PDF缓存总大小', lambda: self.pdf_cache.total_bytes)
+        metrics.register('jm_upload_queue_length', 'gauge', '等待上传的附件数', lambda: self.upload_scheduler.queued_count)
+        metrics.register('jm_upload_rate_limited_total', 'counter', '上传收到429的次数', lambda: self.upload_scheduler.rate_limited)
+        metrics.register('jm_image_staging_bytes', 'gauge', '图片暂存区占用的字节数', lambda: self.image_staging.total_bytes)
+        metrics.register('jm_image_staging_spilled_total', 'counter', '超出暂存预算写入磁盘的图片数', lambda: self.image_staging.spilled)
+    
+    async def start_metrics_server(self):
+        """启动 Prometheus 格式的指标接口，默认只监听本机"""
+        async def handle_metrics(request):
+            return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+        
+        host = self.metrics_config.get('host', '127.0.0.1')
+        port = self.metrics_config.get('port', 9464)
+        app = web.Application()
+        app.router.add_get('/metrics', handle_metrics)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, host, port).start()
+        except OSError as e:
+            logger.error(f"指标接口启动失败 {host}:{port}: {e}")
+            await runner.cleanup()
+            return
+        self.metrics_runner = runner
+        logger.info(f"指标接口已启动: http://{host}:{port}/metrics")
+    
+    async def close(self):
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        self.pdf_cache.save()
+        self.album_meta.save()
+        self.id_index.close()
+        self.process_pool.shutdown()
+        self.file_io.shutdown()
+        self.option_profiles.close()
+        await super().close()
+    
     def load_config(self):
         """加载配置文件"""
         try:
             # 读取机器人配置
             with open('bot_config.json', 'r', encoding='utf-8') as f:
                 bot_config = json.load(f)
-                self.token = bot_config.get('token')
-                self.IDmin = bot_config.get('IDmin', 110000)
-                self.IDmax = bot_config.get('IDmax', 1200000)
         except FileNotFoundError:
             logger.error("找不到 bot_config.json 配置文件")
-            self.token = None
-            self.IDmin = 110000
-            self.IDmax = 1200000
+            bot_config = {}
+        
+        self.token = bot_config.get('token')
+        self.IDmin = bot_config.get('IDmin', 110000)
+        self.IDmax = bot_config.get('IDmax', 1200000)
+        
+        # 下载调度配置
+        scheduler_config = bot_config.get('scheduler', {})
+        self.scheduler = DownloadScheduler(
+            max_concurrent=scheduler_config.get('max_concurrent_albums', 2),
+            max_queue=scheduler_config.get('max_queue', 20),
+            reserved_fast_slots=scheduler_config.get('reserved_fast_slots', 1),
+        )
+        
+        # 附件上传调度
+        upload_config = bot_config.get('upload', {})
+        self.upload_scheduler.max_parallel = max(1, upload_config.get('max_parallel', 2))
+        
+        # 下载进度显示
+        progress_config = bot_config.get('progress', {})
+        self.status_updater = StatusUpdater(
+            enabled=progress_config.get('enabled', True),
+            interval=progress_config.get('interval_seconds', 3),
+            edits_per_second=progress_config.get('edits_per_second', 5),
+        )
+        
+        # 事件循环中的文件操作使用的线程池
+        file_io_config = bot_config.get('file_io', {})
+        self.file_io = AsyncFileIO(workers=file_io_config.get('workers', 4))
+        
+        # PDF缓存配置
+        cache_config = bot_config.get('pdf_cache', {})
+        self.pdf_cache = PdfCacheIndex(
+            os.path.join(os.path.abspath(os.path.dirname(__file__)), 'pdf'),
+            self.file_io,
+            max_bytes=cache_config.get('max_size_mb', 10240) * 1024 * 1024,
+            frequency_bonus=cache_config.get('frequency_bonus_seconds', 3600),
+        )
+        self.upload_refs = UploadRefCache(self.pdf_cache.pdf_dir, self.file_io)
+        
+        # 本子元数据缓存
+        meta_config = bot_config.get('album_meta', {})
+        self.album_meta = AlbumMetaCache(
+            self.pdf_cache.pdf_dir,
+            ttl=meta_config.get('ttl_hours', 168) * 3600,
+            negative_ttl=meta_config.get('negative_ttl_hours', 6) * 3600,
+            max_entries=meta_config.get('max_entries', 50000),
+        )
+        JmBotDownloader.album_meta = self.album_meta
+        
+        # 断点续传的下载清单
+        self.resume_config = bot_config.get('resume', {})
+        self.manifests = AlbumManifestStore(self.pdf_cache.pdf_dir)
+        JmBotDownloader.manifests = self.manifests
+        
+        # 所有者按需开启的性能采样
+        self.job_profiler = JobProfiler(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'profiles'))
+        
+        # 指标接口
+        self.metrics_config = bot_config.get('metrics', {})
+        self.metrics_runner = None
+        
+        # /jmr 使用的随机ID索引
+        self.random_index_config = bot_config.get('random_index', {})
+        self.id_index = RandomIdIndex(self.pdf_cache.pdf_dir, self.IDmin, self.IDmax)
+        
+        # /jmr 预下载池
+        self.prefetch_config = bot_config.get('random_prefetch', {})
+        self.warm_pool = RandomWarmPool(
+            self.pdf_cache,
+            pool_size=self.prefetch_config.get('pool_size', 3),
+            refill_interval=self.prefetch_config.get('refill_interval_seconds', 60),
+            idle_seconds=self.prefetch_config.get('idle_seconds', 30),
+            max_disk_bytes=self.prefetch_config.get('max_disk_mb', 1024) * 1024 * 1024,
+        )
+        
+        # 下载配置档案
+        client_config = bot_config.get('jm_client', {})
+        self.option_profiles = OptionProfiles(
+            os.path.join(os.path.abspath(os.path.dirname(__file__)), 'option.yml'),
+            bot_config.get('option_profiles', {}),
+            pool_size=client_config.get('pool_size', 32),
+            idle_timeout=client_config.get('idle_timeout_seconds', 60),
+        )
+        self.option_profiles.load()
+        
+        # 域名健康探测
+        self.domain_probe_config = bot_config.get('domain_probe', {})
+        self.domain_health = DomainHealth(
+            alpha=self.domain_probe_config.get('alpha', 0.3),
+            bad_success_rate=self.domain_probe_config.get('bad_success_rate', 0.5),
+        )
+        self.option_profiles.domain_health = self.domain_health
+        
+        # CPU密集任务共用的进程池
+        pool_config = bot_config.get('process_pool', {})
+        self.process_pool = ProcessPool(
+            workers=pool_config.get('workers', 0),
+            max_in_flight=pool_config.get('max_in_flight', 0),
+        )
+        JmBotDownloader.pool = self.process_pool if pool_config.get('decode_images', True) else None
+        
+        # 图片暂存：不经过 dir_rule.base_dir 直接交给流式PDF
+        staging_config = bot_config.get('image_staging', {})
+        self.image_staging = ImageStagingStore(
+            mode=staging_config.get('mode', 'disk'),
+            max_bytes=staging_config.get('max_size_mb', 256) * 1024 * 1024,
+            tmpfs_dir=staging_config.get('tmpfs_dir'),
+        )
+        JmBotDownloader.staging = self.image_staging
+        AlbumPdfStream.staging = self.image_staging
+        
+        # 每本最近一次下载写入的图片，用于下载失败时的诊断
+        self.pictures = PictureIndex()
+        JmBotDownloader.pictures = self.pictures
+        
+        # 超过上传限制时压缩PDF的配置
+        optimize_config = bot_config.get('pdf_optimize', {})
+        self.pdf_optimizer = PdfOptimizer(
+            self.pdf_cache,
+            self.process_pool,
+            enabled=optimize_config.get('enabled', False),
+            target_bytes=int(optimize_config.get('target_size_mb', 0) * 1024 * 1024),
+            min_quality=optimize_config.get('min_quality', 40),
+            max_quality=optimize_config.get('max_quality', 90),
+        )
+        # 压缩阶段：每本的页面已经在进程池中并行编码，同时压缩的本子数不宜多
+        self.optimize_stage = PipelineStage(
+            "压缩",
+            workers=optimize_config.get('max_concurrent', 1),
+            max_queue=optimize_config.get('max_queue', 10),
+        )
+        # 解析阶段查缓存和元数据，检查文档阶段检查生成的PDF，都只是短暂的文件操作
+        pipeline_config = bot_config.get('pipeline', {})
+        resolve_config = pipeline_config.get('resolve', {})
+        self.resolve_stage = PipelineStage(
+            "解析",
+            workers=resolve_config.get('max_concurrent', 8),
+            max_queue=resolve_config.get('max_queue', 100),
+        )
+        build_config = pipeline_config.get('build', {})
+        self.build_stage = PipelineStage(
+            "检查文档",
+            workers=build_config.get('max_concurrent', 4),
+            max_queue=build_config.get('max_queue', 50),
+        )
     
     async def on_ready(self):
         """机器人启动时的事件"""
@@ -220,11 +3321,17 @@ async def slash_download_jm(interaction: discord.Interaction, comic_id: str):
 @bot.tree.command(name="jmr", description="随机下载JM漫画")
 async def slash_random_download_jm(interaction: discord.Interaction):
     """随机下载JM漫画"""
-    rand_id = random.randint(bot.IDmin, bot.IDmax)
+    # 优先使用预下载好的漫画
+    rand_id = bot.warm_pool.pop()
+    if rand_id is not None:
+        note = "（已预先下载）"
+    else:
+        rand_id = bot.id_index.sample(bot.random_index_config.get('explore_rate', 0.1))
+        note = "" if bot.id_index.state(rand_id) == RandomIdIndex.VALID else "（未确认是否可用）"
     
     embed = discord.Embed(
         title="🎲 随机下载",
-        description=f"随机选择的ID: {rand_id}",
+        description=f"随机选择的ID: {rand_id}{note}",
         color=discord.Color.blue()
     )
     await interaction.response.send_message(embed=embed)
@@ -298,6 +3405,23 @@ async def slash_show_help(interaction: discord.Interaction):
     
     await interaction.response.send_message(embed=embed)
 
+def format_id_list(ids, limit=1024):
+    """用逗号拼接ID，超过 limit 个字符（Discord embed 字段的上限）时只显示前面的ID和剩余数量"""
+    ids = list(ids)
+    text = ", ".join(ids)
+    if len(text) <= limit:
+        return text
+    shown, length = [], 0
+    for comic_id in ids:
+        extra = len(comic_id) + (2 if shown else 0)
+        rest = len(ids) - len(shown) - 1
+        if length + extra + len(f", …(+{rest})") > limit:
+            break
+        shown.append(comic_id)
+        length += extra
+    more = f"…(+{len(ids) - len(shown)})"
+    return f"{', '.join(shown)}, {more}" if shown else more
+
 @bot.tree.command(name="status", description="显示机器人运行状态")
 async def slash_bot_status(interaction: discord.Interaction):
     """显示机器人状态"""
@@ -308,16 +3432,69 @@ async def slash_bot_status(interaction: discord.Interaction):
     
     embed.add_field(
         name="🔄 正在下载",
-        value=f"{len(bot.downloading)} 个任务" if bot.downloading else "无",
+        value=f"{len(bot.scheduler.running)} 个任务" if bot.scheduler.running else "无",
+        inline=True
+    )
+    
+    embed.add_field(
+        name="⏳ 排队中",
+        value=f"{bot.scheduler.queued_count}/{bot.scheduler.max_queue}",
+        inline=True
+    )
+    
+    embed.add_field(
+        name="💾 PDF缓存",
+        value=f"{len(bot.pdf_cache.entries)} 个文件，{bot.pdf_cache.total_bytes / 1024 / 1024:.1f}MB"
+              + (f" / {bot.pdf_cache.max_bytes / 1024 / 1024:.0f}MB" if bot.pdf_cache.max_bytes else ""),
+        inline=True
+    )
+    
+    embed.add_field(
+        name="📈 缓存命中率",
+        value=f"{bot.pdf_cache.hit_ratio:.0%} ({bot.pdf_cache.hits}/{bot.pdf_cache.hits + bot.pdf_cache.misses})",
+        inline=True
+    )
+    
+    embed.add_field(
+        name="📎 复用上传",
+        value=f"{bot.upload_refs.reused} 次",
+        inline=True
+    )
+    
+    embed.add_field(
+        name="🗂️ 元数据缓存",
+        value=f"{len(bot.album_meta.albums)} 个本子，{len(bot.album_meta.missing)} 个不存在，已拦截 {bot.album_meta.rejected} 次",
+        inline=True
+    )
+    
+    embed.add_field(
+        name="🎯 随机范围",
+        value=f"{bot.IDmin} - {bot.IDmax}\n已知可用 {bot.id_index.valid_total} 个，不可用 {bot.id_index.invalid_total} 个",
         inline=True
     )
     
+    if bot.prefetch_config.get('enabled', False):
+        embed.add_field(
+            name="🔥 预下载池",
+            value=f"{len(bot.warm_pool.ready)}/{bot.warm_pool.pool_size} 本，已使用 {bot.warm_pool.served} 本，取消 {bot.warm_pool.cancelled} 次",
+            inline=True
+        )
+    
     embed.add_field(
-        name="🎯 随机范围",
-        value=f"{bot.IDmin} - {bot.IDmax}",
+        name="📤 上传队列",
+        value=f"等待 {bot.upload_scheduler.queued_count} 个，上传中 {bot.upload_scheduler.active} 个，"
+              f"已触发速率限制 {bot.upload_scheduler.rate_limited} 次",
         inline=True
     )
     
+    if bot.image_staging.enabled:
+        embed.add_field(
+            name="🧠 图片暂存",
+            value=f"{bot.image_staging.mode}，占用 {bot.image_staging.total_bytes / 1024 / 1024:.1f}/{bot.image_staging.max_bytes / 1024 / 1024:.0f}MB，"
+                  f"已暂存 {bot.image_staging.staged} 张，写入磁盘 {bot.image_staging.spilled} 张",
+            inline=True
+        )
+    
     embed.add_field(
         name="📶 延迟",
         value=f"{round(bot.latency * 1000)}ms",
@@ -327,7 +3504,7 @@ async def slash_bot_status(interaction: discord.Interaction):
     if bot.downloading:
         embed.add_field(
             name="📋 下载队列",
-            value=", ".join(bot.downloading),
+            value=format_id_list(bot.downloading),
             inline=False
         )
     
@@ -347,7 +3524,7 @@ async def slash_diagnose(interaction: discord.Interaction):
     dirs_status = []
     for dir_name in ['pdf', 'picture']:
         dir_path = f"{path}/{dir_name}"
-        if os.path.exists(dir_path):
+        if await bot.file_io.exists(dir_path):
             dirs_status.append(f"✅ {dir_name}")
         else:
             dirs_status.append(f"❌ {dir_name}")
@@ -363,7 +3540,7 @@ async def slash_diagnose(interaction: discord.Interaction):
     config_files = ['option.yml', 'bot_config.json']
     for config_file in config_files:
         config_path = f"{path}/{config_file}"
-        if os.path.exists(config_path):
+        if await bot.file_io.exists(config_path):
             config_status.append(f"✅ {config_file}")
         else:
             config_status.append(f"❌ {config_file}")
@@ -384,9 +3561,10 @@ async def slash_diagnose(interaction: discord.Interaction):
     
     try:
         import img2pdf
-        deps_status.append("✅ img2pdf")
+        deps_status.append("✅ img2pdf（可选）")
     except ImportError:
-        deps_status.append("❌ img2pdf")
+        # 默认使用 stream_pdf 插件，只有改用 img2pdf 插件时才需要
+        deps_status.append("➖ img2pdf（可选，未安装）")
     
     embed.add_field(
         name="📦 依赖库",
@@ -395,224 +3573,472 @@ async def slash_diagnose(interaction: discord.Interaction):
     )
     
     # 检查option.yml配置
-    try:
-        option = jmcomic.create_option_by_file(path + "/option.yml")
+    if bot.option_profiles.error is None:
         embed.add_field(
             name="📋 option.yml状态",
-            value="✅ 配置文件加载成功",
+            value=f"✅ 配置文件加载成功\n配置档案: {', '.join(bot.option_profiles.profiles)}",
             inline=False
         )
-    except Exception as e:
+    else:
         embed.add_field(
             name="📋 option.yml状态",
-            value=f"❌ 加载失败: {str(e)}",
+            value=f"❌ 加载失败: {bot.option_profiles.error}",
+            inline=False
+        )
+    
+    # 域名健康度（按下载使用的顺序）
+    domain_lines = []
+    for domain in bot.domain_health.ordered(bot.option_profiles.all_domains()):
+        stat = bot.domain_health.stats.get(domain)
+        if stat is None:
+            domain_lines.append(f"❔ {domain} 未探测")
+            continue
+        icon = "❌" if bot.domain_health.is_bad(domain) else "✅"
+        latency = f"{stat['latency'] * 1000:.0f}ms" if stat['latency'] is not None else "-"
+        line = f"{icon} {domain} {latency} 成功率{stat['success']:.0%}"
+        if stat['last_error']:
+            line += f" ({stat['last_error'][:40]})"
+        domain_lines.append(line)
+    if domain_lines:
+        embed.add_field(
+            name="🌐 域名健康度",
+            value="\n".join(domain_lines)[:1024],
             inline=False
         )
     
     await interaction.response.send_message(embed=embed)
 
-async def download_comic_handler_slash(interaction: discord.Interaction, comic_id: str, followup: bool = False):
-    """处理漫画下载的通用函数"""
-    path = os.path.abspath(os.path.dirname(__file__))
-    pdf_path = f"{path}/pdf/{comic_id}.pdf"
+async def resend_upload_refs(interaction: discord.Interaction, comic_id, ref):
+    """以附件链接回复之前上传过的文件，链接失效且无法刷新时返回False"""
+    urls = ref['urls']
+    if bot.upload_refs.needs_refresh(ref):
+        # 重新获取消息即可拿到新的签名链接
+        try:
+            channel = bot.get_partial_messageable(ref['channel_id'])
+            urls = []
+            for message_id in ref['message_ids']:
+                message = await channel.fetch_message(message_id)
+                urls += [attachment.url for attachment in message.attachments]
+        except discord.HTTPException as e:
+            logger.info(f"上传记录已失效 {comic_id}: {e}")
+            await bot.upload_refs.discard(comic_id)
+            return False
+        if len(urls) != len(ref['urls']):
+            await bot.upload_refs.discard(comic_id)
+            return False
+        ref['urls'] = urls
+        await bot.upload_refs.save()
     
-    # 检查文件是否已存在
-    if os.path.exists(pdf_path):
-        embed = discord.Embed(
-            title="📁 文件已存在",
-            description=f"{comic_id}.pdf 已下载，直接发送",
+    filename = ref['filename']
+    if len(urls) == 1:
+        lines = [f"[{filename}]({urls[0]})"]
+    else:
+        lines = [f"[{filename}.part{i}.zip]({url})" for i, url in enumerate(urls, 1)]
+        lines.append(f"\n解压后合并：`copy /b {filename}.part1+...+{filename}.part{len(urls)} {filename}`")
+    
+    # 单个embed描述最多4096字符，链接过多时拆分
+    embeds = []
+    description = ""
+    for line in lines:
+        if len(description) + len(line) + 1 > 4000:
+            embeds.append(description)
+            description = ""
+        description += line + "\n"
+    embeds.append(description)
+    if len(embeds) > 10:
+        return False
+    
+    await interaction.followup.send(embeds=[
+        discord.Embed(
+            title="📎 文件已上传过" if i == 0 else None,
+            description=text,
             color=discord.Color.green()
         )
+        for i, text in enumerate(embeds)
+    ])
+    bot.upload_refs.reused += 1
+    logger.info(f"复用已上传的附件: {comic_id} ({len(urls)} 个)")
+    return True
+
+async def deliver_pdf(interaction: discord.Interaction, comic_id, pdf_path, filename):
+    """发送完整的PDF，之前上传过相同文件时直接复用附件链接
+
+    超过上传限制且开启了压缩时，改为发送压缩到限制以内的版本
+    """
+    upload_limit = bot.upload_limits.get(interaction)
+    if await bot.pdf_optimizer.needs(pdf_path, upload_limit):
+        try:
+            async with bot.optimize_stage.slot():
+                variant = await bot.pdf_optimizer.fit(comic_id, pdf_path, upload_limit)
+        except QueueFullError:
+            # 压缩阶段积压太多时直接分片发送原文件
+            logger.info(f"压缩队列已满，{comic_id} 不压缩直接发送")
+            variant = None
+        if variant is not None:
+            comic_id, pdf_path = variant
+    async with bot.upload_refs.lock(comic_id):
+        sha256 = await bot.pdf_cache.digest(comic_id)
+        ref = bot.upload_refs.get(comic_id, sha256)
+        if ref and await resend_upload_refs(interaction, comic_id, ref):
+            return True, "已复用之前上传的文件"
         
-        if followup:
-            await interaction.followup.send(embed=embed)
-        else:
-            await interaction.response.send_message(embed=embed)
-        
-        # 发送PDF文件
+        sent_messages = []
+        success, message = await send_file_smart(interaction, pdf_path, filename, sent_messages)
+        if success:
+            await bot.upload_refs.record(comic_id, sha256, filename, sent_messages)
+        return success, message
+
+def queue_position_notifier(status_message):
+    """生成排队位置回调，排队位置由 StatusUpdater 合并后显示在状态消息中"""
+    async def on_position(position):
+        bot.status_updater.set_queue_position(status_message, position)
+    return on_position
+
+def queue_full_embed(error):
+    return discord.Embed(
+        title="🚦 队列已满",
+        description=str(error),
+        color=discord.Color.red()
+    )
+
+def only_success_shared(result, leader_tag):
+    """其他模式的下载只有完整成功时才复用，否则按自己的模式重新下载"""
+    return result[0] is True
+
+async def download_with_scheduler(interaction, status_message, comic_id, priority, start_embed, profile="normal"):
+    """排队获取下载名额后按配置档案下载漫画，同一ID的并发请求只下载一次
+
+    下载期间状态消息由 StatusUpdater 定期更新排队位置和下载进度，返回前停止更新
+    """
+    async def run():
+        with metrics.timer('jm_stage_duration_seconds', stage='queue_wait'):
+            ticket = await bot.scheduler.acquire(
+                comic_id, priority, interaction.user.id, interaction.guild_id,
+                on_position=queue_position_notifier(status_message)
+            )
+        progress = bot.status_updater.track(comic_id)
         try:
-            success, message = await send_file_smart(interaction, pdf_path, f"{comic_id}.pdf")
-            if not success:
-                embed = discord.Embed(
-                    title="❌ 文件发送失败",
-                    description=message,
-                    color=discord.Color.red()
-                )
-                await interaction.followup.send(embed=embed)
-        except Exception as e:
-            embed = discord.Embed(
-                title="❌ 文件发送失败",
-                description=f"发送文件时出错: {str(e)}",
+            # 排过队时恢复为开始下载提示，之后显示下载进度
+            bot.status_updater.set_queue_position(status_message, None)
+            option = await bot.file_io.run(bot.option_profiles.get, profile)
+            option.progress = progress
+            logger.info(f"开始下载漫画 {comic_id} (配置档案: {profile})")
+            profiling = bot.job_profiler.claim(comic_id)
+            if profiling is not None:
+                logger.info(f"对漫画 {comic_id} 的下载进行性能采样")
+                profiling.start()
+            try:
+                result = await download_comic_async(comic_id, option)
+                for attempt in range(bot.resume_config.get('auto_retry', 1)):
+                    if result[0] != "partial":
+                        break
+                    # 自动重试只下载缺失的图片
+                    logger.info(f"漫画 {comic_id} 部分下载失败，第 {attempt + 1} 次自动补下缺失的图片")
+                    option = await bot.file_io.run(bot.option_profiles.get, "retry")
+                    option.progress = progress
+                    result = await download_comic_async(comic_id, option)
+            finally:
+                if profiling is not None:
+                    await bot.job_profiler.finish(profiling)
+            bot.update_id_index(comic_id)
+            if result[0] is True:
+                await bot.pdf_cache.add(comic_id)
+            elif result[0] == "partial":
+                # 不完整的PDF不能当作缓存命中
+                await bot.pdf_cache.add(comic_id, complete=False)
+            waiters = bot.single_flight.waiters(comic_id)
+            if waiters:
+                logger.info(f"漫画 {comic_id} 下载结束，合并了 {waiters} 个重复请求")
+            return result
+        finally:
+            bot.status_updater.untrack(comic_id)
+            bot.scheduler.release(ticket)
+    
+    bot.status_updater.watch(status_message, comic_id, start_embed)
+    try:
+        return await bot.single_flight.run(comic_id, run, tag=profile, accept=only_success_shared)
+    finally:
+        await bot.status_updater.unwatch(status_message)
+
+def album_rejection_embed(comic_id, profile, check_missing=True):
+    """按元数据缓存判断是否无需下载，已知不存在或超过档案页数限制时返回拒绝提示"""
+    if check_missing:
+        checked_at = bot.album_meta.missing_since(comic_id)
+        if checked_at is not None:
+            bot.album_meta.rejected += 1
+            return discord.Embed(
+                title="❌ 漫画不存在",
+                description=f"{comic_id} 在 {int((time.time() - checked_at) // 60)} 分钟前已确认不存在，跳过下载",
                 color=discord.Color.red()
             )
-            await interaction.followup.send(embed=embed)
-        return
-    
-    # 检查是否正在下载
-    if comic_id in bot.downloading:
-        embed = discord.Embed(
-            title="⏳ 正在下载中",
-            description="该漫画正在下载中，请稍后再试",
-            color=discord.Color.orange()
-        )
-        if followup:
-            await interaction.followup.send(embed=embed)
-        else:
-            await interaction.response.send_message(embed=embed)
-        return
     
-    # 开始下载
-    embed = discord.Embed(
-        title="📥 开始下载",
-        description=f"开始下载 {comic_id}，请稍候...",
+    meta = bot.album_meta.get(comic_id)
+    max_pages = bot.option_profiles.max_pages(profile)
+    if meta is None or max_pages is None or meta['page_count'] <= max_pages:
+        return None
+    bot.album_meta.rejected += 1
+    hint = ""
+    force_limit = bot.option_profiles.max_pages("force")
+    if profile != "force" and (force_limit is None or meta['page_count'] <= force_limit):
+        hint = "\n可以使用 /jm_force 强制下载"
+    return discord.Embed(
+        title="⚠️ 超出页数限制",
+        description=f"{comic_id}「{meta['title']}」共 {meta['page_count']} 页，超过 {max_pages} 页的限制{hint}",
+        color=discord.Color.orange()
+    )
+
+def joined_download_embed(comic_id):
+    return discord.Embed(
+        title="🔗 已加入进行中的下载",
+        description=f"{comic_id} 正在下载中，完成后会一并发送给你，无需重复请求",
         color=discord.Color.blue()
     )
+
+# 下载流水线的参数档案：/jm、/jmr 使用 normal，/jm_force、/jm_retry 只是参数不同
+PIPELINE_PRESETS = {
+    'normal': {
+        'profile': 'normal',  # option 配置档案
+        'priority': DownloadScheduler.PRIORITY_NORMAL,
+        'use_cache': True,  # 缓存命中时直接发送
+        'check_missing': True,  # 已知不存在的ID直接拒绝
+        'label': '下载',
+        'start_title': '📥 开始下载',
+        'start_description': '开始下载 {comic_id}，请稍候...',
+        'color': discord.Color.blue(),
+        'partial_filename': '{comic_id}_partial.pdf',
+    },
+    'force': {
+        'profile': 'force',
+        'priority': DownloadScheduler.PRIORITY_HEAVY,
+        'use_cache': True,
+        'check_missing': True,
+        'label': '强制下载',
+        'start_title': '🚀 强制下载',
+        'start_description': '开始强制下载 {comic_id} (页数限制500页)，请稍候...',
+        'color': discord.Color.purple(),
+        'partial_filename': '{comic_id}_partial_force.pdf',
+    },
+    'retry': {
+        'profile': 'retry',
+        'priority': DownloadScheduler.PRIORITY_HEAVY,
+        'use_cache': False,  # 重试总是重新下载
+        'check_missing': False,  # 重试时重新确认不存在的ID，只按页数拦截
+        'label': '重试下载',
+        'start_title': '🔄 重试下载',
+        'start_description': '开始重试下载 {comic_id} (增强网络配置)，请稍候...',
+        'color': discord.Color.blue(),
+        'partial_filename': '{comic_id}_retry.pdf',
+    },
+}
+
+async def run_download_pipeline(interaction: discord.Interaction, comic_id: str, preset_name: str = "normal", followup: bool = False):
+    """按档案执行下载流水线：解析 → 下载（边下载边生成PDF）→ 检查文档 → 压缩/分片 → 发送
+
+    各阶段有自己的并发上限和队列：解析、检查文档、压缩各是一个 PipelineStage，
+    下载由 DownloadScheduler 调度，上传由 UploadScheduler 调度。下载结束即释放下载名额，之后的压缩和上传与其他任务的下载同时进行。
+    followup 为 True 时交互已经回复过（如 /jmr），所有消息都用 followup 发送。
+    """
+    preset = PIPELINE_PRESETS[preset_name]
+    pdf_path = bot.pdf_cache.path_of(comic_id)
     
-    if followup:
-        status_message = await interaction.followup.send(embed=embed)
-    else:
+    async def respond(embed):
+        if followup:
+            return await interaction.followup.send(embed=embed)
         await interaction.response.send_message(embed=embed)
-        status_message = await interaction.original_response()
+        return await interaction.original_response()
+    
+    # 解析：缓存命中直接发送，已知不存在或超过页数限制的ID不再排队下载
+    try:
+        async with bot.resolve_stage.slot():
+            decision, embed = await pipeline_resolve(comic_id, preset)
+    except QueueFullError as e:
+        await respond(queue_full_embed(e))
+        return
+    if decision == 'cached':
+        await respond(embed)
+        await pipeline_deliver_cached(interaction, comic_id, pdf_path)
+        return
+    if decision == 'rejected':
+        await respond(embed)
+        return
     
-    bot.downloading.add(comic_id)
+    start_embed = embed
+    # 正在下载中则合并到同一个任务
+    first_embed = joined_download_embed(comic_id) if comic_id in bot.single_flight else start_embed
+    status_message = await respond(first_embed)
     
+    label = preset['label']
     try:
-        # 创建配置并开始异步下载
-        option = jmcomic.create_option_by_file(path + "/option.yml")
-        logger.info(f"开始下载漫画 {comic_id}")
-        success, error_msg = await download_comic_async(comic_id, option)
+        # 下载：排队获取下载名额，PDF在下载过程中同时生成
+        success, error_msg = await download_with_scheduler(
+            interaction, status_message, comic_id,
+            preset['priority'], start_embed, profile=preset['profile']
+        )
         
-        if success == "partial":
-            # 部分下载失败，但可能有PDF生成
-            logger.warning(f"部分下载失败 {comic_id}: {error_msg}")
-            
-            if os.path.exists(pdf_path):
-                file_size = os.path.getsize(pdf_path)
-                logger.info(f"部分下载，PDF文件已生成，大小: {file_size} bytes")
-                
-                embed = discord.Embed(
-                    title="⚠️ 部分下载完成",
-                    description=f"{comic_id} {error_msg}\n文件大小: {file_size//1024}KB\n**注意：PDF可能不完整**",
-                    color=discord.Color.orange()
-                )
-                await status_message.edit(embed=embed)
-                
-                # 发送PDF文件
-                try:
-                    success, message = await send_file_smart(interaction, pdf_path, f"{comic_id}_partial.pdf")
-                    if not success:
-                        embed = discord.Embed(
-                            title="❌ 文件发送失败",
-                            description=message,
-                            color=discord.Color.red()
-                        )
-                        await interaction.followup.send(embed=embed)
-                except Exception as e:
-                    logger.error(f"发送文件失败: {e}")
-                    embed = discord.Embed(
-                        title="❌ 文件发送失败",
-                        description=f"PDF已生成但发送失败: {str(e)}",
-                        color=discord.Color.red()
-                    )
-                    await interaction.followup.send(embed=embed)
-            else:
-                embed = discord.Embed(
-                    title="❌ 部分下载失败",
-                    description=f"{error_msg}，且未能生成PDF",
-                    color=discord.Color.red()
-                )
-                await status_message.edit(embed=embed)
-            return
-        elif not success:
-            logger.error(f"下载失败 {comic_id}: {error_msg}")
-            embed = discord.Embed(
-                title="❌ 下载失败",
-                description=error_msg,
-                color=discord.Color.red()
-            )
-            await status_message.edit(embed=embed)
+        # 检查文档：确定要发送的文件
+        async with bot.build_stage.slot():
+            embed, filename = await pipeline_check_document(comic_id, pdf_path, preset, success, error_msg)
+        await status_message.edit(embed=embed)
+        if filename is None:
             return
         
-        # 检查文件是否下载成功
-        logger.info(f"检查PDF文件: {pdf_path}")
-        if os.path.exists(pdf_path):
-            file_size = os.path.getsize(pdf_path)
-            logger.info(f"PDF文件已生成，大小: {file_size} bytes")
-            
-            embed = discord.Embed(
-                title="✅ 下载完成",
-                description=f"{comic_id} 下载完成 (文件大小: {file_size//1024}KB)",
-                color=discord.Color.green()
-            )
-            await status_message.edit(embed=embed)
-            
-            # 发送PDF文件
-            try:
-                with open(pdf_path, 'rb') as f:
-                    file = discord.File(f, filename=f"{comic_id}.pdf")
-                    await interaction.followup.send(file=file)
-            except Exception as e:
-                logger.error(f"发送文件失败: {e}")
-                embed = discord.Embed(
-                    title="❌ 文件发送失败",
-                    description=f"下载完成但发送文件时出错: {str(e)}",
-                    color=discord.Color.red()
-                )
-                await interaction.followup.send(embed=embed)
-        else:
-            # 检查图片文件夹是否有内容
-            picture_dir = f"{path}/picture"
-            logger.info(f"检查图片目录: {picture_dir}")
-            
-            debug_info = []
-            if os.path.exists(picture_dir):
-                files = []
-                for root, dirs, filenames in os.walk(picture_dir):
-                    for filename in filenames:
-                        files.append(os.path.join(root, filename))
-                debug_info.append(f"图片目录存在，包含 {len(files)} 个文件")
-                if files:
-                    debug_info.append(f"首个文件示例: {files[0]}")
-            else:
-                debug_info.append("图片目录不存在")
-            
-            # 检查是否存在以comic_id命名的文件夹
-            comic_dirs = [d for d in os.listdir(picture_dir) if comic_id in d] if os.path.exists(picture_dir) else []
-            if comic_dirs:
-                debug_info.append(f"找到相关目录: {comic_dirs}")
-            
-            logger.warning(f"PDF转换失败 {comic_id}: {'; '.join(debug_info)}")
-            
-            embed = discord.Embed(
-                title="⚠️ 转换失败",
-                description=f"无法转为PDF或超出页数限制\n调试信息: {'; '.join(debug_info)}",
-                color=discord.Color.orange()
-            )
-            await status_message.edit(embed=embed)
-            
+        # 压缩/分片并发送
+        await pipeline_deliver(interaction, comic_id, pdf_path, filename, complete=success is True)
+    except QueueFullError as e:
+        await status_message.edit(embed=queue_full_embed(e))
     except Exception as e:
-        logger.error(f"下载过程中出现错误 {comic_id}: {e}")
+        logger.error(f"{label}过程中出现错误 {comic_id}: {e}")
         embed = discord.Embed(
-            title="❌ 下载出错",
-            description=f"下载过程中出现错误: {str(e)}",
+            title=f"❌ {label}出错",
+            description=f"{label}过程中出现错误: {str(e)}",
             color=discord.Color.red()
         )
         await status_message.edit(embed=embed)
+
+async def pipeline_resolve(comic_id, preset):
+    """解析阶段，返回 (决定, embed)：
+    'cached' 直接发送缓存，'rejected' 不下载并回复拒绝提示，'download' 开始下载并以 embed 作为开始消息
+    """
+    # 下载中的文件可能尚未完成，不当作缓存
+    if preset['use_cache'] and comic_id not in bot.single_flight and bot.pdf_cache.lookup(comic_id):
+        return 'cached', discord.Embed(
+            title="📁 文件已存在",
+            description=f"{comic_id}.pdf 已下载，直接发送",
+            color=discord.Color.green()
+        )
+    
+    rejection = album_rejection_embed(comic_id, preset['profile'], check_missing=preset['check_missing'])
+    if rejection is not None:
+        return 'rejected', rejection
+    
+    return 'download', await pipeline_start_embed(comic_id, preset)
+
+async def pipeline_start_embed(comic_id, preset):
+    description = preset['start_description'].format(comic_id=comic_id)
+    if preset['profile'] == 'retry':
+        manifest = await bot.file_io.run(bot.manifests.load, comic_id)
+        if manifest is not None:
+            description += f"\n上次已下载 {manifest['succeeded']} 张，缺少 {len(manifest['failed_images'])} 张图片，本次只下载缺失的部分"
+    return discord.Embed(title=preset['start_title'], description=description, color=preset['color'])
+
+async def pipeline_deliver_cached(interaction, comic_id, pdf_path):
+    """发送缓存中的PDF，缓存发送优先于冷下载"""
+    try:
+        ticket = await bot.scheduler.acquire(
+            comic_id, DownloadScheduler.PRIORITY_CACHED, interaction.user.id, interaction.guild_id
+        )
+    except QueueFullError as e:
+        await interaction.followup.send(embed=queue_full_embed(e))
+        return
+    
+    try:
+        await pipeline_deliver(interaction, comic_id, pdf_path, f"{comic_id}.pdf", complete=True)
+    except FileNotFoundError:
+        # 文件在索引之外被删除
+        bot.pdf_cache.remove(comic_id)
+        embed = discord.Embed(
+            title="❌ 文件发送失败",
+            description="缓存文件已丢失，请重新下载",
+            color=discord.Color.red()
+        )
+        await interaction.followup.send(embed=embed)
     finally:
-        bot.downloading.discard(comic_id)
+        bot.scheduler.release(ticket)
+
+async def pipeline_check_document(comic_id, pdf_path, preset, success, error_msg):
+    """根据下载结果检查PDF，返回 (状态消息embed, 要发送的文件名)；没有可发送的文件时文件名为None"""
+    label = preset['label']
+    if success == "partial":
+        # 部分下载失败，但可能有PDF生成
+        logger.warning(f"{label}部分失败 {comic_id}: {error_msg}")
+        if not await bot.file_io.exists(pdf_path):
+            return discord.Embed(
+                title=f"❌ {label}部分失败",
+                description=f"{error_msg}，且未能生成PDF",
+                color=discord.Color.red()
+            ), None
+        file_size = await bot.file_io.getsize(pdf_path)
+        logger.info(f"{label}部分完成，PDF文件已生成，大小: {file_size} bytes")
+        return discord.Embed(
+            title=f"⚠️ {label}部分完成",
+            description=f"{comic_id} {error_msg}\n文件大小: {file_size//1024}KB\n**注意：PDF可能不完整**",
+            color=discord.Color.orange()
+        ), preset['partial_filename'].format(comic_id=comic_id)
+    
+    if not success:
+        logger.error(f"{label}失败 {comic_id}: {error_msg}")
+        return discord.Embed(
+            title=f"❌ {label}失败",
+            description=error_msg,
+            color=discord.Color.red()
+        ), None
+    
+    logger.info(f"检查PDF文件: {pdf_path}")
+    try:
+        file_size = await bot.file_io.getsize(pdf_path)
+    except FileNotFoundError:
+        file_size = None
+    if file_size is not None:
+        logger.info(f"PDF文件已生成，大小: {file_size} bytes")
+        return discord.Embed(
+            title=f"✅ {label}完成",
+            description=f"{comic_id} {label}完成 (文件大小: {file_size//1024}KB)",
+            color=discord.Color.green()
+        ), f"{comic_id}.pdf"
+    
+    # 从图片索引中查这一本写入了哪些图片，不遍历图片目录
+    debug_info = bot.pictures.describe(comic_id)
+    
+    logger.warning(f"PDF转换失败 {comic_id}: {'; '.join(debug_info)}")
+    return discord.Embed(
+        title=f"⚠️ {label}转换失败",
+        description=f"无法转为PDF或超出页数限制\n调试信息: {'; '.join(debug_info)}",
+        color=discord.Color.orange()
+    ), None
+
+async def pipeline_deliver(interaction, comic_id, pdf_path, filename, complete):
+    """发送PDF，失败时回复错误信息。完整的PDF会复用之前的上传并按需压缩，不完整的直接发送（必要时分片）"""
+    try:
+        if complete:
+            success, message = await deliver_pdf(interaction, comic_id, pdf_path, filename)
+        else:
+            success, message = await send_file_smart(interaction, pdf_path, filename)
+    except FileNotFoundError:
+        raise
+    except Exception as e:
+        logger.error(f"发送文件失败: {e}")
+        success, message = False, f"发送文件时出错: {str(e)}"
+    if not success:
+        embed = discord.Embed(
+            title="❌ 文件发送失败",
+            description=message,
+            color=discord.Color.red()
+        )
+        await interaction.followup.send(embed=embed)
+
+async def download_comic_handler_slash(interaction: discord.Interaction, comic_id: str, followup: bool = False):
+    """处理漫画下载的通用函数"""
+    await run_download_pipeline(interaction, comic_id, "normal", followup)
 
-async def download_comic_async(album_id, option):
-    """异步下载漫画"""
+async def download_comic_async(album_id, option, control=None):
+    """异步下载漫画，control 为 jmcomic.DownloadControl 时可以中途取消"""
     try:
         # 将同步下载操作放到线程池中执行，避免阻塞事件循环
-        await asyncio.to_thread(jmcomic.download_album, album_id, option)
+        with metrics.timer('jm_stage_duration_seconds', stage='album_download'):
+            await asyncio.to_thread(jmcomic.download_album, album_id, option, downloader=JmBotDownloader, control=control)
+        metrics.inc('jm_downloads_total', result='success')
         return True, None
-    except jmcomic.jm_exception.PartialDownloadFailedException as e:
-        # 处理部分下载失败
+    except PartialDownloadFailedException as e:
+        # 处理部分下载失败，失败的图片已记入下载清单
         logger.warning(f"部分下载失败: {str(e)}")
-        failed_count = str(e).count("RequestRetryAllFailException")
-        return "partial", f"部分图片下载失败({failed_count}个)，但可能已生成不完整的PDF"
+        metrics.inc('jm_downloads_total', result='partial')
+        downloader = e.downloader
+        failed_images = len(downloader.download_failed_image) if downloader else 0
+        failed_photos = len(downloader.download_failed_photo) if downloader else 0
+        detail = f"{failed_images}张图片" + (f"、{failed_photos}个章节" if failed_photos else "")
+        return "partial", f"部分下载失败({detail})，已生成不完整的PDF；重试时只会下载缺失的部分"
     except Exception as e:
+        metrics.inc('jm_downloads_total', result='failed')
         return False, f"下载出错: {str(e)}"
 
 # 添加文件分片发送支持命令
@@ -624,9 +4050,13 @@ async def slash_file_info(interaction: discord.Interaction):
         color=discord.Color.blue()
     )
     
+    upload_limit = bot.upload_limits.get(interaction)
+    limit_text = f"**{upload_limit / 1024 / 1024:.0f}MB**"
+    if bot.upload_limits.is_learned(interaction):
+        limit_text += "（根据上传失败记录调整）"
     embed.add_field(
-        name="Discord 文件大小限制",
-        value="• 免费用户: 8MB\n• Nitro 用户: 25MB",
+        name="当前服务器上传限制",
+        value=f"{limit_text}\n超过此大小的文件会自动分片发送，服务器加成等级越高限制越大",
         inline=False
     )
     
@@ -693,6 +4123,36 @@ async def sync_commands(ctx):
         await ctx.send(embed=embed)
         logger.error(f"手动同步斜杠命令失败: {e}")
 
+@bot.command(name='profile')
+@commands.is_owner()
+async def profile_downloads(ctx, target: str = None):
+    """为接下来的下载开启性能采样（仅限机器人所有者）
+
+    !profile 3        采样接下来的3个下载
+    !profile id:123   下次下载漫画123时采样
+    !profile off      取消
+    !profile          查看当前状态
+    """
+    profiler = bot.job_profiler
+    if target is None:
+        description = (
+            f"剩余 {profiler.remaining} 个下载，指定漫画: {', '.join(sorted(profiler.targets)) or '无'}"
+            + (f"\n正在采样: {profiler.active.comic_id}" if profiler.active else "")
+        )
+        embed = discord.Embed(title="🔬 性能采样状态", description=description, color=discord.Color.blue())
+    elif target == 'off':
+        profiler.disarm()
+        embed = discord.Embed(title="🔬 性能采样已取消", description="正在进行的采样会继续到该下载结束", color=discord.Color.orange())
+    elif target.startswith('id:') and target[3:].isdigit():
+        profiler.arm_id(target[3:], ctx.channel)
+        embed = discord.Embed(title="🔬 已开启性能采样", description=f"下次下载漫画 {target[3:]} 时采样，结果发送到此频道", color=discord.Color.green())
+    elif target.isdigit() and 0 < int(target) <= 20:
+        profiler.arm_next(int(target), ctx.channel)
+        embed = discord.Embed(title="🔬 已开启性能采样", description=f"接下来的 {target} 个下载将依次采样，结果发送到此频道", color=discord.Color.green())
+    else:
+        embed = discord.Embed(title="❓ 用法", description="`!profile <1-20>`、`!profile id:<漫画ID>`、`!profile off` 或 `!profile`", color=discord.Color.blue())
+    await ctx.send(embed=embed)
+
 @bot.event
 async def on_command_error(ctx, error):
     """处理传统命令错误"""
@@ -723,337 +4183,21 @@ async def on_command_error(ctx, error):
 @app_commands.describe(comic_id="要下载的漫画ID")
 async def slash_force_download_jm(interaction: discord.Interaction, comic_id: str):
     """强制下载指定ID的JM漫画（更高页数限制）"""
-    path = os.path.abspath(os.path.dirname(__file__))
-    
-    try:
-        with open(path + "/option.yml", 'r', encoding='utf-8') as f:
-            config_content = f.read()
-        
-        # 替换页数限制
-        modified_content = config_content.replace('max_pages: 100', 'max_pages: 500')
-        
-        temp_option_path = path + "/option_temp.yml"
-        with open(temp_option_path, 'w', encoding='utf-8') as f:
-            f.write(modified_content)
-        
-        await download_comic_handler_force(interaction, comic_id, temp_option_path)
-        
-        # 清理临时文件
-        try:
-            os.remove(temp_option_path)
-        except:
-            pass
-            
-    except Exception as e:
-        embed = discord.Embed(
-            title="❌ 配置错误",
-            description=f"无法创建临时配置: {str(e)}",
-            color=discord.Color.red()
-        )
-        await interaction.response.send_message(embed=embed)
+    await download_comic_handler_force(interaction, comic_id)
 
-async def download_comic_handler_force(interaction: discord.Interaction, comic_id: str, option_path: str):
+async def download_comic_handler_force(interaction: discord.Interaction, comic_id: str):
     """强制下载处理函数"""
-    path = os.path.abspath(os.path.dirname(__file__))
-    pdf_path = f"{path}/pdf/{comic_id}.pdf"
-    
-    # 检查文件是否已存在
-    if os.path.exists(pdf_path):
-        embed = discord.Embed(
-            title="📁 文件已存在",
-            description=f"{comic_id}.pdf 已下载，直接发送",
-            color=discord.Color.green()
-        )
-        await interaction.response.send_message(embed=embed)
-        
-        # 发送PDF文件
-        try:
-            with open(pdf_path, 'rb') as f:
-                file = discord.File(f, filename=f"{comic_id}.pdf")
-                await interaction.followup.send(file=file)
-        except Exception as e:
-            embed = discord.Embed(
-                title="❌ 文件发送失败",
-                description=f"发送文件时出错: {str(e)}",
-                color=discord.Color.red()
-            )
-            await interaction.followup.send(embed=embed)
-        return
-    
-    # 检查是否正在下载
-    if comic_id in bot.downloading:
-        embed = discord.Embed(
-            title="⏳ 正在下载中",
-            description="该漫画正在下载中，请稍后再试",
-            color=discord.Color.orange()
-        )
-        await interaction.response.send_message(embed=embed)
-        return
-    
-    # 开始强制下载
-    embed = discord.Embed(
-        title="🚀 强制下载",
-        description=f"开始强制下载 {comic_id} (页数限制500页)，请稍候...",
-        color=discord.Color.purple()
-    )
-    await interaction.response.send_message(embed=embed)
-    status_message = await interaction.original_response()
-    
-    bot.downloading.add(comic_id)
-    
-    try:
-        option = jmcomic.create_option_by_file(option_path)
-        logger.info(f"开始强制下载漫画 {comic_id} (页数限制500页)")
-        success, error_msg = await download_comic_async(comic_id, option)
-        
-        if success == "partial":
-            # 部分下载失败，但可能有PDF生成
-            logger.warning(f"强制下载部分失败 {comic_id}: {error_msg}")
-            
-            if os.path.exists(pdf_path):
-                file_size = os.path.getsize(pdf_path)
-                logger.info(f"强制下载部分成功，PDF文件已生成，大小: {file_size} bytes")
-                
-                embed = discord.Embed(
-                    title="⚠️ 强制下载部分完成",
-                    description=f"{comic_id} {error_msg}\n文件大小: {file_size//1024}KB\n**注意：PDF可能不完整**",
-                    color=discord.Color.orange()
-                )
-                await status_message.edit(embed=embed)
-                
-                # 发送PDF文件
-                try:
-                    with open(pdf_path, 'rb') as f:
-                        file = discord.File(f, filename=f"{comic_id}_partial_force.pdf")
-                        await interaction.followup.send(file=file)
-                except Exception as e:
-                    logger.error(f"发送文件失败: {e}")
-                    embed = discord.Embed(
-                        title="❌ 文件发送失败",
-                        description=f"PDF已生成但发送失败: {str(e)}",
-                        color=discord.Color.red()
-                    )
-                    await interaction.followup.send(embed=embed)
-            else:
-                embed = discord.Embed(
-                    title="❌ 强制下载部分失败",
-                    description=f"{error_msg}，且未能生成PDF",
-                    color=discord.Color.red()
-                )
-                await status_message.edit(embed=embed)
-            return
-        elif not success:
-            logger.error(f"强制下载失败 {comic_id}: {error_msg}")
-            embed = discord.Embed(
-                title="❌ 强制下载失败",
-                description=error_msg,
-                color=discord.Color.red()
-            )
-            await status_message.edit(embed=embed)
-            return
-        
-        # 检查文件是否下载成功
-        if os.path.exists(pdf_path):
-            file_size = os.path.getsize(pdf_path)
-            logger.info(f"强制下载成功，PDF文件已生成，大小: {file_size} bytes")
-            
-            embed = discord.Embed(
-                title="✅ 强制下载完成",
-                description=f"{comic_id} 强制下载完成 (文件大小: {file_size//1024}KB)",
-                color=discord.Color.green()
-            )
-            await status_message.edit(embed=embed)
-            
-            # 发送PDF文件
-            try:
-                with open(pdf_path, 'rb') as f:
-                    file = discord.File(f, filename=f"{comic_id}.pdf")
-                    await interaction.followup.send(file=file)
-            except Exception as e:
-                logger.error(f"发送文件失败: {e}")
-                embed = discord.Embed(
-                    title="❌ 文件发送失败",
-                    description=f"下载完成但发送文件时出错: {str(e)}",
-                    color=discord.Color.red()
-                )
-                await interaction.followup.send(embed=embed)
-        else:
-            logger.warning(f"强制下载PDF转换失败 {comic_id}")
-            embed = discord.Embed(
-                title="⚠️ 强制下载转换失败",
-                description="即使提高页数限制，仍无法转为PDF",
-                color=discord.Color.orange()
-            )
-            await status_message.edit(embed=embed)
-            
-    except Exception as e:
-        logger.error(f"强制下载过程中出现错误 {comic_id}: {e}")
-        embed = discord.Embed(
-            title="❌ 强制下载出错",
-            description=f"强制下载过程中出现错误: {str(e)}",
-            color=discord.Color.red()
-        )
-        await status_message.edit(embed=embed)
-    finally:
-        bot.downloading.discard(comic_id)
+    await run_download_pipeline(interaction, comic_id, "force")
 
 @bot.tree.command(name="jm_retry", description="重试下载漫画（增强网络配置）")
 @app_commands.describe(comic_id="要重试下载的漫画ID")
 async def slash_retry_download_jm(interaction: discord.Interaction, comic_id: str):
     """重试下载指定ID的JM漫画（增强网络配置）"""
-    path = os.path.abspath(os.path.dirname(__file__))
-    
-    try:
-        with open(path + "/option.yml", 'r', encoding='utf-8') as f:
-            config_content = f.read()
-        
-        # 修改重试次数和线程数
-        modified_content = config_content.replace('retry_times: 5', 'retry_times: 10')
-        modified_content = modified_content.replace('image: 30', 'image: 15')  # 降低并发
-        modified_content = modified_content.replace('photo: 32', 'photo: 8')   # 降低并发
-        
-        temp_option_path = path + "/option_retry.yml"
-        with open(temp_option_path, 'w', encoding='utf-8') as f:
-            f.write(modified_content)
-        
-        await download_comic_handler_retry(interaction, comic_id, temp_option_path)
-        
-        # 清理临时文件
-        try:
-            os.remove(temp_option_path)
-        except:
-            pass
-            
-    except Exception as e:
-        embed = discord.Embed(
-            title="❌ 配置错误",
-            description=f"无法创建重试配置: {str(e)}",
-            color=discord.Color.red()
-        )
-        await interaction.response.send_message(embed=embed)
+    await download_comic_handler_retry(interaction, comic_id)
 
-async def download_comic_handler_retry(interaction: discord.Interaction, comic_id: str, option_path: str):
+async def download_comic_handler_retry(interaction: discord.Interaction, comic_id: str):
     """重试下载处理函数"""
-    path = os.path.abspath(os.path.dirname(__file__))
-    pdf_path = f"{path}/pdf/{comic_id}.pdf"
-    
-    # 检查是否正在下载
-    if comic_id in bot.downloading:
-        embed = discord.Embed(
-            title="⏳ 正在下载中",
-            description="该漫画正在下载中，请稍后再试",
-            color=discord.Color.orange()
-        )
-        await interaction.response.send_message(embed=embed)
-        return
-    
-    # 开始重试下载
-    embed = discord.Embed(
-        title="🔄 重试下载",
-        description=f"开始重试下载 {comic_id} (增强网络配置)，请稍候...",
-        color=discord.Color.blue()
-    )
-    await interaction.response.send_message(embed=embed)
-    status_message = await interaction.original_response()
-    
-    bot.downloading.add(comic_id)
-    
-    try:
-        # 使用增强网络配置
-        option = jmcomic.create_option_by_file(option_path)
-        logger.info(f"开始重试下载漫画 {comic_id} (增强网络配置)")
-        success, error_msg = await download_comic_async(comic_id, option)
-        
-        if success == "partial":
-            # 部分下载失败，但可能有PDF生成
-            logger.warning(f"重试下载部分失败 {comic_id}: {error_msg}")
-            
-            if os.path.exists(pdf_path):
-                file_size = os.path.getsize(pdf_path)
-                logger.info(f"重试下载部分成功，PDF文件已生成，大小: {file_size} bytes")
-                
-                embed = discord.Embed(
-                    title="⚠️ 重试下载部分完成",
-                    description=f"{comic_id} {error_msg}\n文件大小: {file_size//1024}KB\n**注意：PDF可能不完整，但已尽力下载**",
-                    color=discord.Color.orange()
-                )
-                await status_message.edit(embed=embed)
-                
-                # 发送PDF文件
-                try:
-                    with open(pdf_path, 'rb') as f:
-                        file = discord.File(f, filename=f"{comic_id}_retry.pdf")
-                        await interaction.followup.send(file=file)
-                except Exception as e:
-                    logger.error(f"发送文件失败: {e}")
-                    embed = discord.Embed(
-                        title="❌ 文件发送失败",
-                        description=f"PDF已生成但发送失败: {str(e)}",
-                        color=discord.Color.red()
-                    )
-                    await interaction.followup.send(embed=embed)
-            else:
-                embed = discord.Embed(
-                    title="❌ 重试下载失败",
-                    description=f"{error_msg}，且未能生成PDF",
-                    color=discord.Color.red()
-                )
-                await status_message.edit(embed=embed)
-            return
-        elif not success:
-            logger.error(f"重试下载失败 {comic_id}: {error_msg}")
-            embed = discord.Embed(
-                title="❌ 重试下载失败",
-                description=f"重试仍然失败: {error_msg}",
-                color=discord.Color.red()
-            )
-            await status_message.edit(embed=embed)
-            return
-        
-        # 检查文件是否下载成功
-        if os.path.exists(pdf_path):
-            file_size = os.path.getsize(pdf_path)
-            logger.info(f"重试下载成功，PDF文件已生成，大小: {file_size} bytes")
-            
-            embed = discord.Embed(
-                title="✅ 重试下载完成",
-                description=f"{comic_id} 重试下载成功 (文件大小: {file_size//1024}KB)",
-                color=discord.Color.green()
-            )
-            await status_message.edit(embed=embed)
-            
-            # 发送PDF文件
-            try:
-                with open(pdf_path, 'rb') as f:
-                    file = discord.File(f, filename=f"{comic_id}.pdf")
-                    await interaction.followup.send(file=file)
-            except Exception as e:
-                logger.error(f"发送文件失败: {e}")
-                embed = discord.Embed(
-                    title="❌ 文件发送失败",
-                    description=f"下载完成但发送文件时出错: {str(e)}",
-                    color=discord.Color.red()
-                )
-                await interaction.followup.send(embed=embed)
-        else:
-            logger.warning(f"重试下载PDF转换失败 {comic_id}")
-            embed = discord.Embed(
-                title="⚠️ 重试下载转换失败",
-                description="重试下载完成但无法转为PDF",
-                color=discord.Color.orange()
-            )
-            await status_message.edit(embed=embed)
-            
-    except Exception as e:
-        logger.error(f"重试下载过程中出现错误 {comic_id}: {e}")
-        embed = discord.Embed(
-            title="❌ 重试下载出错",
-            description=f"重试下载过程中出现错误: {str(e)}",
-            color=discord.Color.red()
-        )
-        await status_message.edit(embed=embed)
-    finally:
-        bot.downloading.discard(comic_id)
+    await run_download_pipeline(interaction, comic_id, "retry")
 
 if __name__ == "__main__":
     # 检查配置文件
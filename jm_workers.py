@@ -0,0 +1,114 @@
+"""进程池中运行的任务：JM图片解密、PDF页面扫描和重新编码
+
+这些函数单独放在这个模块里，进程池的子进程只需要导入本模块，
+不依赖 dc-jm.py 中的机器人、配置和缓存。
+"""
+import io
+import mmap
+import re
+import zlib
+from io import BytesIO
+
+import jmcomic
+
+DEFAULT_DPI = 96  # 图片没有记录dpi时使用，与 StreamingPdfWriter 一致
+
+PDF_IMAGE_OBJECT = re.compile(rb'\d+\s+0\s+obj\s*<<(.*?)>>\s*stream\r?\n', re.DOTALL)
+PDF_PAGE_COUNT = re.compile(rb'/Type\s*/Pages\b.*?/Count\s+(\d+)', re.DOTALL)
+PDF_PAGE_OBJECT = re.compile(rb'/Type\s*/Page\b')
+PDF_MEDIA_BOX = re.compile(rb'/MediaBox\s*\[\s*([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s*\]')
+PDF_COLOR_MODES = {'DeviceGray': 'L', 'DeviceRGB': 'RGB', 'DeviceCMYK': 'CMYK'}
+
+
+def scan_pdf_images(pdf_path):
+    """找出每页一张图的PDF中的图片对象（在进程池中运行）
+
+    返回按文件顺序排列的 [(数据偏移, 长度, 宽, 高, 滤镜, 色彩空间, 页面宽pt, 页面高pt)]，
+    第几张图片对应文件中的第几个页面对象。
+    遇到无法处理的图片、图片数与页数不一致或页面没有 MediaBox 时返回空列表。
+    """
+    pages = []
+    with open(pdf_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for match in PDF_IMAGE_OBJECT.finditer(data):
+            body = match.group(1)
+            if not re.search(rb'/Subtype\s*/Image\b', body):
+                continue
+            fields = {
+                key: re.search(pattern, body)
+                for key, pattern in (
+                    ('width', rb'/Width\s+(\d+)'),
+                    ('height', rb'/Height\s+(\d+)'),
+                    ('length', rb'/Length\s+(\d+)(?!\s+\d+\s+R)'),
+                    ('filter', rb'/Filter\s*/(DCTDecode|FlateDecode)\b'),
+                    ('colorspace', rb'/ColorSpace\s*/(Device(?:Gray|RGB|CMYK))\b'),
+                )
+            }
+            if None in fields.values() or b'/DecodeParms' in body or b'/BitsPerComponent 8' not in body:
+                return []
+            pages.append((
+                match.end(),
+                int(fields['length'].group(1)),
+                int(fields['width'].group(1)),
+                int(fields['height'].group(1)),
+                fields['filter'].group(1).decode(),
+                fields['colorspace'].group(1).decode(),
+            ))
+        counts = [int(count) for count in PDF_PAGE_COUNT.findall(data)]
+        # 页面对象是不含数据流的字典，在它所在的 obj ... endobj 之间找 MediaBox
+        boxes = []
+        for match in PDF_PAGE_OBJECT.finditer(data):
+            start = data.rfind(b'obj', 0, match.start())
+            end = data.find(b'endobj', match.end())
+            box = PDF_MEDIA_BOX.search(data, start, end)
+            if box is None:
+                return []
+            x1, y1, x2, y2 = (float(value) for value in box.groups())
+            boxes.append((x2 - x1, y2 - y1))
+    if not counts or max(counts) != len(pages) or len(boxes) != len(pages):
+        return []
+    return [page + box for page, box in zip(pages, boxes)]
+
+
+def encode_pdf_pages(pdf_path, pages, quality, scale, return_data):
+    """按给定JPEG质量和缩放比例重新编码页面图片（在进程池中运行）
+
+    return_data 为 False 时只返回每页大小，用于估算。缩放只改变像素数，页面尺寸保持不变，
+    写入的dpi按原页面宽度换算。
+    """
+    from PIL import Image
+    results = []
+    with open(pdf_path, 'rb') as f:
+        for offset, length, width, height, pdf_filter, colorspace, page_width, page_height in pages:
+            f.seek(offset)
+            data = f.read(length)
+            if pdf_filter == 'DCTDecode':
+                img = Image.open(BytesIO(data))
+            else:
+                img = Image.frombytes(PDF_COLOR_MODES[colorspace], (width, height), zlib.decompress(data))
+            if img.mode not in ('L', 'RGB'):
+                img = img.convert('RGB')
+            if scale < 1:
+                img = img.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+            dpi = max(1, round(img.width * 72 / page_width)) if page_width > 0 else DEFAULT_DPI
+            buffer = BytesIO()
+            img.save(buffer, 'JPEG', quality=quality, dpi=(dpi, dpi))
+            if pdf_filter == 'DCTDecode' and scale == 1 and length <= buffer.tell():
+                # 原图已经更小，保留原图
+                buffer = BytesIO(data)
+                buffer.seek(0, io.SEEK_END)
+            results.append(buffer.getvalue() if return_data else buffer.tell())
+    return results
+
+
+def decode_jm_image(data, num, save_path):
+    """解密并保存JM图片（在进程池中运行），num 为0时只转换格式"""
+    jmcomic.JmImageTool.decode_and_save(num, jmcomic.JmImageTool.open_image(data), save_path)
+
+
+def encode_jm_image(data, num, suffix):
+    """解密JM图片并编码为 suffix 对应的格式（在进程池中运行），返回编码后的字节，用于图片暂存"""
+    # decode_and_save 按保存路径的扩展名决定格式，传入带 name 的内存文件
+    buffer = BytesIO()
+    buffer.name = f"image{suffix}"
+    jmcomic.JmImageTool.decode_and_save(num, jmcomic.JmImageTool.open_image(data), buffer)
+    return buffer.getvalue()
@@ -0,0 +1,28 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def dc_jm(tmp_path_factory):
+    """加载 dc-jm.py
+
+    导入时会创建机器人并从当前目录读取 bot_config.json、建立缓存目录，
+    所以切换到临时目录中导入，不影响仓库里的配置和缓存。
+    """
+    work = tmp_path_factory.mktemp('bot')
+    cwd = os.getcwd()
+    os.chdir(work)
+    try:
+        spec = importlib.util.spec_from_file_location('dc_jm', os.path.join(ROOT, 'dc-jm.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['dc_jm'] = module
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+    return module
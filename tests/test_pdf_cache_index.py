@@ -0,0 +1,102 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+
+@pytest.fixture
+def file_io(dc_jm):
+    # 单线程，提交的任务按顺序执行
+    file_io = dc_jm.AsyncFileIO(1)
+    yield file_io
+    file_io.shutdown()
+
+
+def drain(file_io):
+    """等待之前提交的任务（如淘汰时的删除）完成"""
+    file_io.submit(lambda: None).result()
+
+
+def write_pdf(pdf_dir, comic_id, size):
+    with open(os.path.join(pdf_dir, f"{comic_id}.pdf"), 'wb') as f:
+        f.write(b'x' * size)
+
+
+def test_load_reconciles_with_directory(dc_jm, file_io, tmp_path):
+    pdf_dir = str(tmp_path)
+    write_pdf(pdf_dir, '1', 100)
+    write_pdf(pdf_dir, '2', 200)
+    with open(os.path.join(pdf_dir, dc_jm.PdfCacheIndex.INDEX_FILENAME), 'w') as f:
+        json.dump({'1': {'size': 100, 'last_access': 5, 'hits': 3, 'complete': False}, 'gone': {'size': 9}}, f)
+
+    cache = dc_jm.PdfCacheIndex(pdf_dir, file_io)
+    cache.load()
+    assert set(cache.entries) == {'1', '2'}
+    assert cache.total_bytes == 300
+    assert cache.entries['1']['hits'] == 3
+    assert cache.lookup('1') is None  # 不完整
+    assert cache.lookup('2') == os.path.join(pdf_dir, '2.pdf')
+    assert cache.lookup('3') is None
+    assert (cache.hits, cache.misses) == (1, 2)
+    cache.save()
+
+    reloaded = dc_jm.PdfCacheIndex(pdf_dir, file_io)
+    reloaded.load()
+    assert reloaded.entries['2']['hits'] == 1
+    assert reloaded.entries['1']['complete'] is False
+
+
+def test_evicts_least_recently_used(dc_jm, file_io, tmp_path):
+    pdf_dir = str(tmp_path)
+
+    async def main():
+        cache = dc_jm.PdfCacheIndex(pdf_dir, file_io, max_bytes=250, frequency_bonus=0)
+        for comic_id in ('1', '2'):
+            write_pdf(pdf_dir, comic_id, 100)
+            await cache.add(comic_id)
+        cache.entries['1']['last_access'] = 1
+        cache.entries['2']['last_access'] = 2
+        write_pdf(pdf_dir, '3', 100)
+        await cache.add('3')
+        return cache
+
+    cache = asyncio.run(main())
+    assert set(cache.entries) == {'2', '3'}
+    assert cache.total_bytes == 200
+    drain(file_io)
+    assert not os.path.exists(os.path.join(pdf_dir, '1.pdf'))
+    with open(cache.index_path) as f:
+        assert set(json.load(f)) == {'2', '3'}
+
+
+def test_hits_delay_eviction(dc_jm, file_io, tmp_path):
+    pdf_dir = str(tmp_path)
+
+    async def main():
+        cache = dc_jm.PdfCacheIndex(pdf_dir, file_io, max_bytes=250, frequency_bonus=3600)
+        for comic_id in ('1', '2'):
+            write_pdf(pdf_dir, comic_id, 100)
+            await cache.add(comic_id)
+        # 1 更早访问，但命中次数多，分数比 2 高
+        cache.entries['1'].update(last_access=1000, hits=7)
+        cache.entries['2'].update(last_access=2000, hits=0)
+        write_pdf(pdf_dir, '3', 100)
+        await cache.add('3')
+        return cache
+
+    cache = asyncio.run(main())
+    assert set(cache.entries) == {'1', '3'}
+
+
+def test_newly_added_file_is_never_evicted(dc_jm, file_io, tmp_path):
+    pdf_dir = str(tmp_path)
+
+    async def main():
+        cache = dc_jm.PdfCacheIndex(pdf_dir, file_io, max_bytes=50)
+        write_pdf(pdf_dir, '1', 100)
+        await cache.add('1')
+        return cache
+
+    cache = asyncio.run(main())
+    assert set(cache.entries) == {'1'}
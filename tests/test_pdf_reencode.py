@@ -0,0 +1,87 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import jm_workers
+
+
+def noise_jpeg(size, dpi=None, quality=95):
+    buffer = BytesIO()
+    kwargs = {'dpi': (dpi, dpi)} if dpi else {}
+    Image.effect_noise(size, 40).convert('RGB').save(buffer, 'JPEG', quality=quality, **kwargs)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def album_pdf(dc_jm, tmp_path):
+    """两页JPEG（300dpi）加一页PNG的PDF，返回 (路径, 第一页JPEG)"""
+    first = noise_jpeg((300, 450), dpi=300)
+    png = BytesIO()
+    Image.new('L', (64, 32), 7).save(png, 'PNG')
+    pdf_path = str(tmp_path / 'album.pdf')
+    writer = dc_jm.StreamingPdfWriter(pdf_path)
+    writer.add_page(first)
+    writer.add_page(noise_jpeg((200, 100), dpi=300))
+    writer.add_page(png.getvalue())
+    writer.close()
+    return pdf_path, first
+
+
+def test_scan_finds_every_page(album_pdf):
+    pdf_path, first = album_pdf
+    pages = jm_workers.scan_pdf_images(pdf_path)
+    assert [page[2:] for page in pages] == [
+        (300, 450, 'DCTDecode', 'DeviceRGB', 72.0, 108.0),
+        (200, 100, 'DCTDecode', 'DeviceRGB', 48.0, 24.0),
+        (64, 32, 'FlateDecode', 'DeviceGray', 48.0, 24.0),
+    ]
+    offset, length = pages[0][:2]
+    with open(pdf_path, 'rb') as f:
+        f.seek(offset)
+        assert f.read(length) == first
+
+
+@pytest.mark.parametrize('old, new', [
+    (b'/Count 3', b'/Count 4'),
+    (b'/MediaBox', b'/CropBox'),
+    (b'/BitsPerComponent 8', b'/BitsPerComponent 1'),
+])
+def test_scan_rejects_unsupported_structure(album_pdf, tmp_path, old, new):
+    pdf_path, _ = album_pdf
+    data = open(pdf_path, 'rb').read()
+    broken = tmp_path / 'broken.pdf'
+    broken.write_bytes(data.replace(old, new))
+    assert jm_workers.scan_pdf_images(str(broken)) == []
+
+
+def test_scaling_keeps_page_size(album_pdf):
+    pdf_path, _ = album_pdf
+    pages = jm_workers.scan_pdf_images(pdf_path)
+    results = jm_workers.encode_pdf_pages(pdf_path, pages, 80, 0.5, True)
+    for data, page in zip(results, pages):
+        with Image.open(BytesIO(data)) as img:
+            assert img.format == 'JPEG'
+            assert img.size == (round(page[2] * 0.5), round(page[3] * 0.5))
+            # 页面宽度不变，dpi 随像素数减半
+            assert img.info['dpi'][0] == pytest.approx(img.width * 72 / page[6], abs=0.5)
+
+
+def test_sizes_only_and_quality(album_pdf):
+    pdf_path, _ = album_pdf
+    pages = jm_workers.scan_pdf_images(pdf_path)[:2]
+    high = jm_workers.encode_pdf_pages(pdf_path, pages, 90, 1.0, False)
+    low = jm_workers.encode_pdf_pages(pdf_path, pages, 30, 1.0, False)
+    assert all(isinstance(size, int) for size in high)
+    assert all(l < h for l, h in zip(low, high))
+    assert high == [len(data) for data in jm_workers.encode_pdf_pages(pdf_path, pages, 90, 1.0, True)]
+
+
+def test_smaller_original_jpeg_is_kept(dc_jm, tmp_path):
+    original = noise_jpeg((120, 80), quality=20)
+    pdf_path = str(tmp_path / 'small.pdf')
+    writer = dc_jm.StreamingPdfWriter(pdf_path)
+    writer.add_page(original)
+    writer.close()
+    pages = jm_workers.scan_pdf_images(pdf_path)
+    assert jm_workers.encode_pdf_pages(pdf_path, pages, 95, 1.0, True) == [original]
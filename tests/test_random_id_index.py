@@ -0,0 +1,88 @@
+import random
+
+import pytest
+
+
+@pytest.fixture
+def index(dc_jm, tmp_path):
+    # 范围跨越多个块（每块4096个ID），且最后一块不满
+    index = dc_jm.RandomIdIndex(str(tmp_path), 100_000, 110_000)
+    index.open()
+    yield index
+    index.close()
+
+
+def test_mark_and_state(dc_jm, index):
+    Index = dc_jm.RandomIdIndex
+    assert index.state(100_000) == Index.UNKNOWN
+    index.mark(100_000, True)
+    index.mark(110_000, False)
+    index.mark(105_000, True)
+    assert index.state(100_000) == Index.VALID
+    assert index.state(110_000) == Index.INVALID
+    assert (index.valid_total, index.invalid_total) == (2, 1)
+
+    # 状态翻转时两个位图和计数同时更新
+    index.mark(105_000, False)
+    assert index.state(105_000) == Index.INVALID
+    assert (index.valid_total, index.invalid_total) == (1, 2)
+    index.mark(105_000, False)
+    assert (index.valid_total, index.invalid_total) == (1, 2)
+
+    # 范围外的ID忽略
+    index.mark(99_999, True)
+    index.mark(110_001, True)
+    assert index.state(99_999) == Index.UNKNOWN
+    assert index.valid_total == 1
+
+
+def test_block_counts_match_bitmap(index):
+    ids = random.Random(1).sample(range(100_000, 110_001), 500)
+    for album_id in ids:
+        index.mark(album_id, True)
+    assert sum(index.block_counts) == index.valid_total == 500
+    for block, count in enumerate(index.block_counts):
+        start = block * index.BLOCK_BYTES
+        assert index.count_bits(index.valid_offset, start, start + index.BLOCK_BYTES) == count
+
+
+def test_sample_returns_only_valid_ids(index):
+    valid = {100_003, 104_200, 108_191, 110_000}
+    for album_id in valid:
+        index.mark(album_id, True)
+    index.mark(100_004, False)
+    seen = {index.sample(explore_rate=0) for _ in range(400)}
+    assert seen == valid
+
+
+def test_sample_unknown_skips_known_ids(dc_jm, tmp_path):
+    index = dc_jm.RandomIdIndex(str(tmp_path), 1, 16)
+    index.open()
+    for album_id in range(1, 16):
+        index.mark(album_id, album_id % 2 == 0)
+    # 每次最多重试64次，固定随机数种子避免偶然失败
+    random.seed(0)
+    assert index.sample(explore_rate=1) == 16
+    assert index.sample_unknown() == 16
+    index.close()
+
+
+def test_bitmap_survives_reopen(dc_jm, tmp_path):
+    index = dc_jm.RandomIdIndex(str(tmp_path), 100_000, 110_000)
+    index.open()
+    index.mark(100_123, True)
+    index.mark(100_124, False)
+    index.close()
+
+    reopened = dc_jm.RandomIdIndex(str(tmp_path), 100_000, 110_000)
+    reopened.open()
+    assert reopened.state(100_123) == reopened.VALID
+    assert reopened.state(100_124) == reopened.INVALID
+    assert (reopened.valid_total, reopened.invalid_total) == (1, 1)
+    reopened.close()
+
+    # 范围变化时重新建立
+    changed = dc_jm.RandomIdIndex(str(tmp_path), 100_000, 120_000)
+    changed.open()
+    assert (changed.valid_total, changed.invalid_total) == (0, 0)
+    changed.close()
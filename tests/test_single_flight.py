@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+
+def test_concurrent_callers_share_one_call(dc_jm):
+    async def main():
+        flight = dc_jm.SingleFlight()
+        calls = 0
+        release = asyncio.Event()
+
+        async def work():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return 'pdf'
+
+        tasks = [asyncio.create_task(flight.run('350234', work)) for _ in range(5)]
+        await asyncio.sleep(0)
+        assert '350234' in flight
+        assert flight.waiters('350234') == 4
+        release.set()
+        results = await asyncio.gather(*tasks)
+        assert '350234' not in flight
+        return calls, results
+
+    calls, results = asyncio.run(main())
+    assert calls == 1
+    assert results == ['pdf'] * 5
+
+
+def test_different_keys_run_separately(dc_jm):
+    async def main():
+        flight = dc_jm.SingleFlight()
+        seen = []
+
+        async def work(key):
+            seen.append(key)
+            await asyncio.sleep(0)
+            return key
+
+        return await asyncio.gather(*(flight.run(key, lambda key=key: work(key)) for key in ('1', '2'))), seen
+
+    results, seen = asyncio.run(main())
+    assert results == ['1', '2']
+    assert sorted(seen) == ['1', '2']
+
+
+def test_exception_reaches_every_waiter(dc_jm):
+    async def main():
+        flight = dc_jm.SingleFlight()
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            raise ValueError('下载出错')
+
+        tasks = [asyncio.create_task(flight.run('1', work)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        return await asyncio.gather(*tasks, return_exceptions=True), flight
+
+    results, flight = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert '1' not in flight
+
+
+def test_rejected_result_is_recomputed_by_waiter(dc_jm):
+    async def main():
+        flight = dc_jm.SingleFlight()
+        release = asyncio.Event()
+        calls = []
+
+        async def work(tag, result):
+            calls.append(tag)
+            await release.wait()
+            return result
+
+        def accept(result, leader_tag):
+            return result[0] is True
+
+        leader = asyncio.create_task(flight.run('1', lambda: work('retry', (False, '失败')), tag='retry', accept=accept))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(flight.run('1', lambda: work('normal', (True, None)), tag='normal', accept=accept))
+        await asyncio.sleep(0)
+        release.set()
+        return await leader, await waiter, calls
+
+    leader, waiter, calls = asyncio.run(main())
+    assert leader == (False, '失败')
+    assert waiter == (True, None)
+    assert calls == ['retry', 'normal']
+
+
+def test_cancelled_leader_fails_waiters(dc_jm):
+    async def main():
+        flight = dc_jm.SingleFlight()
+
+        async def work():
+            await asyncio.Event().wait()
+
+        leader = asyncio.create_task(flight.run('1', work))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(flight.run('1', work))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        with pytest.raises(RuntimeError):
+            await waiter
+        return flight
+
+    flight = asyncio.run(main())
+    assert '1' not in flight
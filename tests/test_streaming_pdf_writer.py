@@ -0,0 +1,100 @@
+import os
+import re
+import zlib
+from io import BytesIO
+
+from PIL import Image
+
+
+def jpeg_bytes(size=(40, 60), mode='RGB', dpi=None):
+    buffer = BytesIO()
+    kwargs = {'dpi': (dpi, dpi)} if dpi else {}
+    Image.new(mode, size, 128).save(buffer, 'JPEG', **kwargs)
+    return buffer.getvalue()
+
+
+def png_bytes(size=(30, 20), mode='RGBA'):
+    buffer = BytesIO()
+    Image.new(mode, size, (10, 20, 30, 255) if mode == 'RGBA' else 100).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def parse_xref(data):
+    """返回 (对象号 -> 偏移, trailer 中的 Size)，并检查 startxref 指向 xref 表"""
+    startxref = int(re.search(rb'startxref\n(\d+)\n%%EOF\n$', data).group(1))
+    assert data[startxref:startxref + 5] == b'xref\n'
+    header = re.match(rb'xref\n0 (\d+)\n', data[startxref:])
+    count = int(header.group(1))
+    table = data[startxref + header.end():]
+    entries = [table[i * 20:(i + 1) * 20] for i in range(count)]
+    assert entries[0] == b'0000000000 65535 f \n'
+    offsets = {obj_id: int(entry[:10]) for obj_id, entry in enumerate(entries) if obj_id}
+    size = int(re.search(rb'/Size (\d+)', data[startxref:]).group(1))
+    return offsets, size
+
+
+def test_xref_points_at_every_object(dc_jm, tmp_path):
+    pdf_path = str(tmp_path / 'album.pdf')
+    writer = dc_jm.StreamingPdfWriter(pdf_path)
+    for _ in range(3):
+        writer.add_page(jpeg_bytes())
+    writer.close()
+
+    data = open(pdf_path, 'rb').read()
+    assert data.startswith(b'%PDF-1.4\n')
+    offsets, size = parse_xref(data)
+    assert size == len(offsets) + 1 == 3 * 3 + 3
+    for obj_id, offset in offsets.items():
+        assert data[offset:].startswith(f"{obj_id} 0 obj\n".encode())
+    assert re.search(rb'/Type /Pages /Kids \[5 0 R 8 0 R 11 0 R\] /Count 3', data)
+    assert not os.path.exists(pdf_path + '.part')
+
+
+def test_jpeg_is_embedded_unchanged(dc_jm, tmp_path):
+    pdf_path = str(tmp_path / 'album.pdf')
+    jpeg = jpeg_bytes()
+    writer = dc_jm.StreamingPdfWriter(pdf_path)
+    writer.add_page(jpeg)
+    writer.close()
+
+    data = open(pdf_path, 'rb').read()
+    assert b'/Filter /DCTDecode' in data
+    assert f"/Length {len(jpeg)} >>\nstream\n".encode() + jpeg + b"\nendstream" in data
+
+
+def test_other_formats_are_flate_encoded(dc_jm, tmp_path):
+    image_path = str(tmp_path / '00001.png')
+    with open(image_path, 'wb') as f:
+        f.write(png_bytes())
+    pdf_path = str(tmp_path / 'album.pdf')
+    writer = dc_jm.StreamingPdfWriter(pdf_path)
+    writer.add_page(image_path)
+    writer.close()
+
+    data = open(pdf_path, 'rb').read()
+    match = re.search(rb'/Width 30 /Height 20 /ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode /Length (\d+) >>\nstream\n', data)
+    assert match
+    pixels = zlib.decompress(data[match.end():match.end() + int(match.group(1))])
+    assert pixels == bytes((10, 20, 30)) * 30 * 20
+
+
+def test_page_size_follows_dpi(dc_jm, tmp_path):
+    pdf_path = str(tmp_path / 'album.pdf')
+    writer = dc_jm.StreamingPdfWriter(pdf_path)
+    writer.add_page(jpeg_bytes((300, 600), dpi=300))
+    writer.add_page(jpeg_bytes((96, 192)))
+    writer.add_page(jpeg_bytes((50, 50)), page_size=(100, 200.5))
+    writer.close()
+
+    boxes = re.findall(rb'/MediaBox \[0 0 ([\d.]+) ([\d.]+)\]', open(pdf_path, 'rb').read())
+    assert [(float(w), float(h)) for w, h in boxes] == [(72, 144), (72, 144), (100, 200.5)]
+
+
+def test_abort_removes_partial_file(dc_jm, tmp_path):
+    pdf_path = str(tmp_path / 'album.pdf')
+    writer = dc_jm.StreamingPdfWriter(pdf_path)
+    writer.add_page(jpeg_bytes())
+    assert os.path.exists(pdf_path + '.part')
+    writer.abort()
+    assert not os.path.exists(pdf_path + '.part')
+    assert not os.path.exists(pdf_path)
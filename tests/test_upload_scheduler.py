@@ -0,0 +1,134 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from yarl import URL
+
+
+class FakeFollowup:
+    def __init__(self, log, release=None):
+        self.log = log
+        self.release = release
+        self.running = 0
+        self.peak = 0
+
+    async def send(self, **kwargs):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            if self.release is not None:
+                await self.release.wait()
+            self.log.append((kwargs['name'], time.monotonic()))
+            return kwargs['name']
+        finally:
+            self.running -= 1
+
+
+def interaction(token, followup):
+    return SimpleNamespace(application_id=1, token=token, followup=followup)
+
+
+def response_params(token, status=200, **headers):
+    return SimpleNamespace(
+        method='POST',
+        url=URL(f'https://discord.com/api/v10/webhooks/1/{token}'),
+        response=SimpleNamespace(status=status, headers=headers),
+    )
+
+
+def test_parallel_limit(dc_jm):
+    async def main():
+        scheduler = dc_jm.UploadScheduler(max_parallel=2)
+        release = asyncio.Event()
+        followup = FakeFollowup([], release)
+        tasks = [asyncio.create_task(scheduler.send(interaction('a', followup), name=i)) for i in range(5)]
+        await asyncio.sleep(0.01)
+        assert scheduler.active == 2
+        assert scheduler.queued_count == 3
+        release.set()
+        results = await asyncio.gather(*tasks)
+        return scheduler, followup, results
+
+    scheduler, followup, results = asyncio.run(main())
+    assert results == list(range(5))
+    assert followup.peak == 2
+    assert scheduler.active == 0
+
+
+def test_single_files_go_before_parts(dc_jm):
+    async def main():
+        scheduler = dc_jm.UploadScheduler(max_parallel=1)
+        release = asyncio.Event()
+        log = []
+        followup = FakeFollowup(log, release)
+        first = asyncio.create_task(scheduler.send(interaction('a', followup), name='first'))
+        await asyncio.sleep(0)
+        parts = [
+            asyncio.create_task(scheduler.send(interaction('a', followup), dc_jm.UploadScheduler.PRIORITY_PART, name=f'part{i}'))
+            for i in range(2)
+        ]
+        single = asyncio.create_task(scheduler.send(interaction('b', followup), name='single'))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, single, *parts)
+        return [name for name, _ in log]
+
+    assert asyncio.run(main()) == ['first', 'single', 'part0', 'part1']
+
+
+def test_exhausted_route_waits_for_reset(dc_jm):
+    async def main():
+        scheduler = dc_jm.UploadScheduler(max_parallel=4)
+        log = []
+        followup = FakeFollowup(log)
+        await scheduler.on_request_end(None, None, response_params('a', **{
+            'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset-After': '0.2',
+        }))
+        started = time.monotonic()
+        # 另一个路由不受影响
+        await asyncio.gather(
+            scheduler.send(interaction('a', followup), name='a'),
+            scheduler.send(interaction('b', followup), name='b'),
+        )
+        return {name: at - started for name, at in log}
+
+    delays = asyncio.run(main())
+    assert delays['b'] < 0.1
+    assert delays['a'] >= 0.15
+
+
+def test_global_rate_limit_pauses_every_route(dc_jm):
+    async def main():
+        scheduler = dc_jm.UploadScheduler(max_parallel=4)
+        log = []
+        followup = FakeFollowup(log)
+        await scheduler.on_request_end(None, None, response_params('a', status=429, **{
+            'Retry-After': '0.2', 'X-RateLimit-Global': 'true',
+        }))
+        started = time.monotonic()
+        await asyncio.gather(*(scheduler.send(interaction(token, followup), name=token) for token in 'abc'))
+        return scheduler, [at - started for _, at in log]
+
+    scheduler, delays = asyncio.run(main())
+    assert scheduler.rate_limited == 1
+    assert min(delays) >= 0.15
+
+
+def test_cancelled_waiter_does_not_leak_slot(dc_jm):
+    async def main():
+        scheduler = dc_jm.UploadScheduler(max_parallel=1)
+        release = asyncio.Event()
+        followup = FakeFollowup([], release)
+        first = asyncio.create_task(scheduler.send(interaction('a', followup), name='first'))
+        waiting = asyncio.create_task(scheduler.send(interaction('a', followup), name='waiting'))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        await first
+        last = await scheduler.send(interaction('a', followup), name='last')
+        return scheduler, last
+
+    scheduler, last = asyncio.run(main())
+    assert last == 'last'
+    assert scheduler.active == 0
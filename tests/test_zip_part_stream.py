@@ -0,0 +1,82 @@
+import io
+import math
+import mmap
+import os
+import zipfile
+
+import pytest
+
+
+@pytest.fixture
+def mapped(tmp_path):
+    path = tmp_path / 'album.pdf'
+    path.write_bytes(os.urandom(100_000) + bytes(range(256)) * 10)
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        yield data
+
+
+def read_entry(stream):
+    stream.seek(0)
+    with zipfile.ZipFile(io.BytesIO(stream.read())) as archive:
+        assert archive.testzip() is None
+        [info] = archive.infolist()
+        assert info.compress_type == zipfile.ZIP_STORED
+        return info.filename, archive.read(info)
+
+
+@pytest.mark.parametrize('chunk_size', [1000, 4096, 33_333, 102_560, 200_000])
+def test_parts_reassemble_to_original(dc_jm, mapped, chunk_size):
+    size = len(mapped)
+    parts = []
+    for i in range(math.ceil(size / chunk_size)):
+        offset = i * chunk_size
+        length = min(chunk_size, size - offset)
+        stream = dc_jm.ZipPartStream(mapped, offset, length, f"album.pdf.part{i + 1}")
+        assert stream.size == len(stream.read())
+        name, data = read_entry(stream)
+        assert name == f"album.pdf.part{i + 1}"
+        assert len(data) == length
+        parts.append(data)
+        stream.release()
+    assert b''.join(parts) == mapped[:]
+
+
+def test_utf8_name(dc_jm, mapped):
+    stream = dc_jm.ZipPartStream(mapped, 0, 10, "漫画.pdf.part1")
+    assert read_entry(stream) == ("漫画.pdf.part1", mapped[:10])
+    stream.release()
+
+
+def test_small_reads_and_seek(dc_jm, mapped):
+    stream = dc_jm.ZipPartStream(mapped, 500, 3000, "a.part1")
+    whole = stream.read()
+    stream.seek(0)
+    pieces = []
+    while True:
+        piece = stream.read(7)
+        if not piece:
+            break
+        pieces.append(piece)
+    assert b''.join(pieces) == whole
+
+    stream.seek(-22, io.SEEK_END)
+    assert stream.read() == whole[-22:]
+    stream.seek(10)
+    stream.seek(5, io.SEEK_CUR)
+    assert stream.tell() == 15
+    assert stream.read(40) == whole[15:55]
+    with pytest.raises(ValueError):
+        stream.seek(-1)
+    stream.release()
+
+
+def test_release_lets_mmap_close(dc_jm, tmp_path):
+    path = tmp_path / 'a.pdf'
+    path.write_bytes(b'x' * 1000)
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        stream = dc_jm.ZipPartStream(data, 0, 1000, "a.part1")
+        stream.release()
+        stream.release()
+        data.close()
+        assert data.closed